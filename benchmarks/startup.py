@@ -0,0 +1,53 @@
+"""
+Start-up time of gmailsync.
+
+Each case runs in a new Python process, as gmailsync does under cron, and the median wall time
+of several runs is printed:
+  - help: `gmailsync --help`.
+  - import: import the command line entry point.
+  - first request: load the credentials and build the Gmail API service, i.e. everything done
+    before the first request is sent. No request is sent, the credentials are fake.
+
+Usage: python benchmarks/startup.py [runs]
+"""
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FIRST_REQUEST = """
+from google.oauth2.credentials import Credentials
+from gmailsync.client import build_service
+build_service(Credentials(token='fake'))
+"""
+
+CASES = [
+    ('help', ['-m', 'gmailsync', '--help']),
+    ('import', ['-c', 'import gmailsync.__main__']),
+    ('first request', ['-c', FIRST_REQUEST]),
+]
+
+
+def measure(args, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + args, cwd=ROOT, check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    # Warm up the bytecode and the filesystem caches
+    measure(CASES[-1][1], 1)
+    for name, args in CASES:
+        print('{:<15} {:8.1f} ms'.format(name, measure(args, runs) * 1000))
+
+
+if __name__ == '__main__':
+    main()
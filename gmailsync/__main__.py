@@ -5,6 +5,9 @@ import logging
 
 from .config import load_config, set_up_logger, get_default_config_file
 from .client import Client
+from .transport import Httplib2Transport, SessionTransport
+from .cache import MessageCache
+from .storage import BlobStore
 from .sync import Synchronizer
 from .channel import channel_factory
 from .cli import Status, cprint
@@ -17,6 +20,8 @@ def load_args():
     parser = argparse.ArgumentParser(description='gmailsync. Synchronize and save a backup of your gmail messages')
     parser.add_argument('-c', '--conf', help='Configuration file', metavar='file', default=get_default_config_file())
     parser.add_argument('-l', '--labels', help='List the available labels', action='store_true')
+    parser.add_argument('-r', '--rehydrate', help='Print a stored message with its attachments moved to the blob '
+                        'store put back', metavar='file')
     parser.add_argument('-v', '--verbose', help='Show debug log messages in the log', action='store_true')
     parser.add_argument('channels', help='List of channel names or group names to synchronize.'
                         'If none defined it will synchronize all channels', nargs='*')
@@ -34,9 +39,18 @@ def list_labels(client):
         print('  ', label)
 
 
-def sync_mailboxes(config, client, channels_to_sync):
-    channels = channel_factory(config, channels_to_sync)
-    synchronizer = Synchronizer(client, channels)
+def rehydrate(blob_store, path):
+    if blob_store is None:
+        raise ValueError('No blob_store defined in config file')
+    with open(path, 'rb') as f:
+        sys.stdout.buffer.write(blob_store.rehydrate(f.read()))
+
+
+def sync_mailboxes(config, client, channels_to_sync, blob_store=None):
+    channels = channel_factory(config, channels_to_sync, blob_store=blob_store)
+    synchronizer = Synchronizer(client, channels, workers=config.workers,
+                                max_inflight_bytes=config.max_inflight_bytes, routing=config.routing,
+                                batch_max_bytes=config.batch_max_bytes, large_message_size=config.large_message_size)
     synchronizer.sync()
 
 
@@ -48,12 +62,26 @@ def main():
 
         set_up_logger(args.verbose, config.logger_config)
 
-        client = Client(config.credentials, config.token)
+        blob_store = None
+        if config.blob_store is not None:
+            blob_store = BlobStore(config.blob_store, min_size=config.blob_min_size,
+                                   fsync=config.durability != 'none')
+
+        if args.rehydrate:
+            rehydrate(blob_store, args.rehydrate)
+            return
+
+        cache = MessageCache(config.cache, max_bytes=config.cache_max_bytes) if config.cache is not None else None
+        if config.transport == 'session':
+            transport = SessionTransport(pool_size=config.http_pool_size, timeout=config.http_timeout)
+        else:
+            transport = Httplib2Transport(timeout=config.http_timeout)
+        client = Client(config.credentials, config.token, cache=cache, transport=transport)
 
         if args.labels:
             list_labels(client)
         else:
-            sync_mailboxes(config, client, args.channels)
+            sync_mailboxes(config, client, args.channels, blob_store=blob_store)
 
     except (KeyboardInterrupt, SystemExit):
         # Do nothing
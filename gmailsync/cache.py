@@ -0,0 +1,167 @@
+"""
+Local cache of the raw messages fetched from Gmail.
+"""
+from collections import OrderedDict
+import base64
+import json
+import logging
+import os
+import tempfile
+import threading
+import zlib
+
+
+log = logging.getLogger('gmailsync')
+
+
+# Max size of the cache: 1 GB
+DEFAULT_MAX_BYTES = 1073741824
+
+# zlib compression level of the cached messages. Raw messages are mostly text and compress well
+DEFAULT_COMPRESSION_LEVEL = 6
+
+
+class MessageCache:
+    """
+    Persistent cache of decoded raw messages keyed by Gmail message id.
+
+    Messages never change once received, so a cached message is valid forever: adding a channel,
+    changing a query or rebuilding a mailbox reads the messages already fetched from the disk
+    instead of downloading them again.
+
+    Each message is stored compressed in its own file, with the metadata needed to format it.
+    The cache is bounded by size: when it grows over :param max_bytes the least recently used
+    messages are evicted. Recency is kept in the modification time of the files, so it survives
+    between executions.
+
+    It is thread-safe: several workers can share the same cache.
+
+    :param path: directory of the cache. It is created if it does not exist.
+
+    :param max_bytes: max size of the cache on disk.
+
+    :param compression_level: zlib compression level, from 0 (no compression) to 9.
+
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES, compression_level=DEFAULT_COMPRESSION_LEVEL):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.compression_level = compression_level
+        self.size = 0
+        # Cached message ids in LRU order: id -> size of the file
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        os.makedirs(path, exist_ok=True)
+        self._load()
+
+    def get(self, msg_id):
+        """
+        Get the message :param msg_id, or `None` if it is not cached.
+
+        The message has the same keys as a message of the API except `raw`, replaced by `decoded`
+        with the raw message already decoded.
+
+        """
+        with self._lock:
+            if msg_id not in self._entries:
+                return None
+            self._entries.move_to_end(msg_id)
+
+        try:
+            with open(self._entry_path(msg_id), 'rb') as f:
+                data = zlib.decompress(f.read())
+            os.utime(self._entry_path(msg_id))
+        except (OSError, zlib.error):
+            log.warning('Discarding corrupted cached message %s', msg_id, exc_info=True)
+            self._discard(msg_id)
+            return None
+
+        header, decoded = data.split(b'\n', 1)
+        message = json.loads(header)
+        message['id'] = msg_id
+        message['decoded'] = decoded
+        return message
+
+    def put(self, message):
+        """
+        Cache :param message, a message of the API with its `raw` content.
+
+        """
+        metadata = {'internalDate': message['internalDate'], 'labelIds': message.get('labelIds', [])}
+        decoded = base64.urlsafe_b64decode(message['raw'].encode('ASCII'))
+        data = zlib.compress(json.dumps(metadata).encode('UTF-8') + b'\n' + decoded, self.compression_level)
+
+        # Written to a temporary file first so an interrupted write never leaves a corrupted entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self._entry_path(message['id']))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        with self._lock:
+            self.size += len(data) - self._entries.pop(message['id'], 0)
+            self._entries[message['id']] = len(data)
+            evicted = self._evict()
+
+        for msg_id in evicted:
+            self._remove(msg_id)
+
+    def __contains__(self, msg_id):
+        with self._lock:
+            return msg_id in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def _load(self):
+        entries = []
+        with os.scandir(self.path) as it:
+            for entry in it:
+                if entry.name.startswith('.tmp-'):
+                    # Left by an interrupted write
+                    os.unlink(entry.path)
+                elif entry.is_file():
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, entry.name, stat.st_size))
+
+        for _, msg_id, size in sorted(entries):
+            self._entries[msg_id] = size
+            self.size += size
+
+        for msg_id in self._evict():
+            self._remove(msg_id)
+
+        log.debug('%s messages in the cache (%s bytes)', len(self._entries), self.size)
+
+    def _evict(self):
+        """
+        Drop the least recently used entries until the cache fits in `max_bytes`. Return the ids of
+        the evicted messages, whose files must be removed.
+
+        """
+        evicted = []
+        while self.size > self.max_bytes and self._entries:
+            msg_id, size = self._entries.popitem(last=False)
+            self.size -= size
+            evicted.append(msg_id)
+        return evicted
+
+    def _discard(self, msg_id):
+        with self._lock:
+            self.size -= self._entries.pop(msg_id, 0)
+        self._remove(msg_id)
+
+    def _remove(self, msg_id):
+        try:
+            os.unlink(self._entry_path(msg_id))
+        except FileNotFoundError:
+            pass
+
+    def _entry_path(self, msg_id):
+        return os.path.join(self.path, msg_id)
@@ -1,12 +1,13 @@
 import logging
 
 from .mailbox import Mailbox
+from .storage import MessageLinker
 
 
 log = logging.getLogger('gmailsync')
 
 
-def channel_factory(config, channels_to_sync):
+def channel_factory(config, channels_to_sync, blob_store=None):
     """
     Create Channel objects from configurations.
 
@@ -17,8 +18,11 @@ def channel_factory(config, channels_to_sync):
 
     :param channels_to_sync: list of channel names or group names to synchronize
 
+    :param blob_store: optional BlobStore shared by the mailboxes of all channels.
+
     """
     channels = []
+    linker = MessageLinker() if config.hardlinks else None
     for channel_config in config.get_channels(channels_to_sync):
         if channel_config.box_type is None:
             # Default box_type
@@ -26,18 +30,46 @@ def channel_factory(config, channels_to_sync):
         else:
             # Channel explicit box-type
             box_type = channel_config.box_type
-        mailbox = Mailbox(box_type, channel_config.mailbox_path)
-        channel = Channel(channel_config.name, mailbox, channel_config.query)
+        if channel_config.sync_mode is None:
+            sync_mode = config.sync_mode
+        else:
+            sync_mode = channel_config.sync_mode
+        if channel_config.backfill is None:
+            backfill = config.backfill
+        else:
+            backfill = channel_config.backfill
+        if channel_config.durability is None:
+            durability = config.durability
+        else:
+            durability = channel_config.durability
+        if channel_config.maildir_shards is None:
+            maildir_shards = config.maildir_shards
+        else:
+            maildir_shards = channel_config.maildir_shards
+        if channel_config.compression is None:
+            compression = config.compression
+        else:
+            compression = channel_config.compression
+        mailbox = Mailbox(box_type, channel_config.mailbox_path, checkpoint_messages=config.checkpoint_messages,
+                          checkpoint_interval=config.checkpoint_interval, fsync_state=config.fsync_state,
+                          durability=durability, maildir_shards=maildir_shards,
+                          maildir_shard_size=config.maildir_shard_size, sqlite_compress=config.sqlite_compress,
+                          sqlite_full_text=config.sqlite_full_text, compression=compression,
+                          compression_dictionary=config.compression_dictionary, blob_store=blob_store,
+                          linker=linker)
+        channel = Channel(channel_config.name, mailbox, channel_config.query, sync_mode=sync_mode, backfill=backfill)
         channels.append(channel)
     return channels
 
 
 class Channel:
 
-    def __init__(self, name, mailbox, query):
+    def __init__(self, name, mailbox, query, sync_mode='query', backfill='none'):
         self.name = name
         self.mailbox = mailbox
         self.query = query
+        self.sync_mode = sync_mode
+        self.backfill = backfill
 
         if query is not None and 'after:' in query:
             log.warn("'after:' will be overwritten in query to do incremental queries based on the saved state")
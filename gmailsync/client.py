@@ -1,12 +1,12 @@
 import pickle
 import os.path
 import logging
-import time
+import threading
 
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-# from apiclient import errors  # TODO
+from googleapiclient.errors import HttpError
+
+from .ratelimit import RateLimiter, QUOTA_UNITS
+from .transport import Httplib2Transport
 
 
 log = logging.getLogger('gmailsync')
@@ -15,40 +15,181 @@ log = logging.getLogger('gmailsync')
 # If modifying these scopes, delete the file token.pickle.
 SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
 
+# Max page size allowed by `users.messages.list`
+LIST_PAGE_SIZE = 500
+
+# Partial response: only the ids of the messages and the token of the next page are needed
+LIST_FIELDS = 'messages(id),nextPageToken'
+
+# Partial response: only the ids of the messages added to the mailbox
+HISTORY_FIELDS = 'history(messagesAdded(message(id))),historyId,nextPageToken'
+
+# Partial response of `users.messages.get` with the minimal format: only the estimated size
+SIZE_FIELDS = 'id,sizeEstimate'
+
+# Max attempts of a request rejected because of the rate limit
+MAX_ATTEMPTS = 5
+
+# Gmail API discovery document, read once and shared by the services of all the threads. It is
+# kept as JSON: the Google API client modifies the parsed document while it builds a service, so
+# each service parses its own copy
+_discovery_document = None
+_discovery_lock = threading.Lock()
+
+
+class HistoryExpired(Exception):
+    """
+    The history record is too old or invalid to list the changes since it. A full
+    synchronization is required.
+
+    """
+
+
+def is_rate_limit_error(exception):
+    """
+    Check if :param exception is an HttpError caused by the rate limit or the quota of the API.
+
+    Gmail returns 429 but also 403 with a `rateLimitExceeded` or `userRateLimitExceeded` reason.
+
+    """
+    if not isinstance(exception, HttpError):
+        return False
+    if exception.resp.status == 429:
+        return True
+    return exception.resp.status == 403 and b'ratelimitexceeded' in (exception.content or b'').lower()
+
+
+def get_retry_after(exception):
+    """
+    Get the seconds to wait before retrying from the `Retry-After` header of the response of
+    :param exception, or `None` if it is not defined.
+
+    """
+    try:
+        return int(exception.resp.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+
+def load_discovery_document():
+    """
+    Get the discovery document of the Gmail API packaged with the Google API client, or `None`
+    if this version of the client does not include it.
+
+    It is read once per process, as a JSON string. Building the service from it does not request
+    the document to the discovery service.
+
+    """
+    global _discovery_document
+    with _discovery_lock:
+        if _discovery_document is None:
+            from googleapiclient.discovery_cache import get_static_doc
+            document = get_static_doc('gmail', 'v1')
+            if document is None:
+                return None
+            _discovery_document = document
+        return _discovery_document
+
+
+def build_service(credentials, transport=None):
+    """
+    Build a Gmail API service authorized with :param credentials.
+
+    :param transport: optional transport of the requests of the service. By default, an
+    Httplib2Transport.
+
+    """
+    # Imported here, it takes longer than the rest of gmailsync and is not needed by the commands
+    # that do not use the API
+    from googleapiclient.discovery import build, build_from_document
+
+    if transport is None:
+        transport = Httplib2Transport()
+    http = transport.http(credentials)
+    document = load_discovery_document()
+    if document is None:
+        return build('gmail', 'v1', http=http)
+    return build_from_document(document, http=http)
+
 
 class MessageFetcher:
+    """
+    Callback of the batches of requests that collects the result of each message.
+
+    The results are recorded per message id: the fetched messages, the ids of the messages that
+    could not be fetched but can be retried and the ids of the messages that no longer exist.
+
+    """
 
     def __init__(self):
         self.messages = []
+        self.failed = set()
+        self.missing = set()
+        self.rate_limited = False
+        self.retry_after = None
 
     def fetch_message(self, request_id, response, exception):
         if exception is not None:
-            if exception.resp.status in [429, 403]:
-                log.error(
-                    'Batch rate limit hit: request_id: %s, response: %s, exception: %s - applying backoff...',
-                    request_id,
-                    response,
-                    exception,
-                )
-                time.sleep(5)  # Cooldown before returning
+            if is_rate_limit_error(exception):
+                log.warning('Batch rate limit hit: request_id: %s, response: %s, exception: %s',
+                            request_id, response, exception)
+                # The limiter is notified once per batch by the client, no cooldown here
+                self.rate_limited = True
+                retry_after = get_retry_after(exception)
+                if retry_after is not None:
+                    self.retry_after = max(self.retry_after or 0, retry_after)
+                self.failed.add(request_id)
+            elif isinstance(exception, HttpError) and exception.resp.status == 404:
+                # Deleted after being listed, retrying is pointless
+                log.warning('Message not found: request_id: %s', request_id)
+                self.missing.add(request_id)
             else:
                 log.error('Error fetching a message: server exception. request_id: %s, response: %s, exception: %s',
                           request_id, response, exception)
+                self.failed.add(request_id)
             return
 
         if 'raw' not in response:
             log.error('Error fetching a message: malformed response. request_id: %s, response: %s',
                       request_id, response)
+            self.failed.add(request_id)
             return
 
         self.messages.append(response)
 
 
 class Client:
+    """
+    Client of the Gmail API.
+
+    It can be shared by several threads: each thread gets its own service, as the Google API
+    client is not thread-safe, while all of them share the same credentials and rate limiter.
 
-    def __init__(self, credentials_path, token_path):
-        creds = self._authenticate(credentials_path, token_path)
-        self.service = build('gmail', 'v1', credentials=creds)
+    :param limiter: optional RateLimiter shared by all the requests. By default, one with the
+    rate of the per-user quota.
+
+    :param cache: optional MessageCache. Cached messages are not fetched again.
+
+    :param transport: optional transport of the requests, e.g. a SessionTransport to share a
+    pool of connections between the threads. By default, an Httplib2Transport: one httplib2
+    connection per thread.
+
+    """
+
+    def __init__(self, credentials_path, token_path, limiter=None, cache=None, transport=None):
+        self.credentials = self._authenticate(credentials_path, token_path)
+        self.limiter = limiter if limiter is not None else RateLimiter()
+        self.cache = cache
+        self.transport = transport if transport is not None else Httplib2Transport()
+        self._local = threading.local()
+
+    @property
+    def service(self):
+        service = getattr(self._local, 'service', None)
+        if service is None:
+            service = build_service(self.credentials, transport=self.transport)
+            self._local.service = service
+        return service
 
     def _authenticate(self, credentials_path, token_path):
         creds = None
@@ -61,8 +202,12 @@ class Client:
         # If there are no (valid) credentials available, let the user log in.
         if not creds or not creds.valid:
             if creds and creds.expired and creds.refresh_token:
-                creds.refresh(Request())
+                # Refreshed through httplib2, already used by the service, instead of requests
+                from google_auth_httplib2 import Request
+                from googleapiclient.http import build_http
+                creds.refresh(Request(build_http()))
             else:
+                from google_auth_oauthlib.flow import InstalledAppFlow
                 flow = InstalledAppFlow.from_client_secrets_file(credentials_path, SCOPES)
                 creds = flow.run_local_server(port=0)
             # Save the credentials for the next run
@@ -71,50 +216,223 @@ class Client:
         return creds
 
     def labels(self):
-        response = self.service.users().labels().list(userId='me').execute()
+        response = self._execute(self.service.users().labels().list(userId='me'), 'labels.list')
         return response.get('labels', [])
 
-    def list(self, query=None, since=None):
+    def list(self, query=None, since=None, until=None):
+        """
+        Iterate over the descriptors of the messages matching :param query, newest first.
+
+        Pages are requested lazily as the caller consumes the generator, so the caller can start
+        processing the first messages while the rest of pages have not been listed yet. Only the
+        id of each message is requested to keep the responses and the memory footprint small.
+
+        :param query: optional query with the same format as the Gmail search box.
+
+        :param since: optional timestamp (seconds since epoch). Only messages received after it
+        will be listed.
+
+        :param until: optional timestamp (seconds since epoch). Only messages received before it
+        will be listed.
+
+        """
         if not query:
             # If not specified explicitly in the query, discard hangout chats
             query = '!in:chat'
         if since:
             query += ' AND after:{}'.format(since)
+        if until:
+            query += ' AND before:{}'.format(until)
 
-        response = self.service.users().messages().list(userId='me', q=query).execute()
-        messages = []
-        if 'messages' in response:
-            messages.extend(response['messages'])
-        else:
-            log.error('Error fetching listing messages: malformed response. response: %s, page_token: %s',
-                      response, None)
-
-        while 'nextPageToken' in response:
-            page_token = response['nextPageToken']
-            response = self.service.users().messages().list(userId='me', q=query, pageToken=page_token).execute()
-            if 'messages' in response:
-                messages.extend(response['messages'])
-            else:
-                log.error('Error fetching listing messages: malformed response. response: %s, page_token: %s',
-                          response, page_token)
-            time.sleep(1)  # avoid rate limit
+        page_token = None
+        while True:
+            request = self.service.users().messages().list(userId='me', q=query, maxResults=LIST_PAGE_SIZE,
+                                                           fields=LIST_FIELDS, pageToken=page_token)
+            response = self._execute(request, 'messages.list')
+            # No 'messages' key at all when the page is empty
+            yield from response.get('messages', [])
+
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                break
+
+    def profile(self):
+        return self._execute(self.service.users().getProfile(userId='me'), 'getProfile')
+
+    def history(self, start_history_id):
+        """
+        List the messages added to the mailbox after :param start_history_id.
+
+        Return a tuple with the set of ids of the added messages and the id of the most recent
+        history record of the mailbox.
+
+        Raise `HistoryExpired` if :param start_history_id is no longer available (history records
+        are typically available for at least one week).
+
+        """
+        msg_ids = set()
+
+        page_token = None
+        while True:
+            request = self.service.users().history().list(userId='me', startHistoryId=start_history_id,
+                                                          historyTypes=['messageAdded'], maxResults=LIST_PAGE_SIZE,
+                                                          fields=HISTORY_FIELDS, pageToken=page_token)
+            try:
+                response = self._execute(request, 'history.list')
+            except HttpError as e:
+                if e.resp.status == 404:
+                    raise HistoryExpired('History record {} is no longer available'.format(start_history_id))
+                raise
+
+            for record in response.get('history', []):
+                for added in record.get('messagesAdded', []):
+                    msg_ids.add(added['message']['id'])
 
-        return messages
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                return msg_ids, response['historyId']
 
     def get(self, message_id):
-        response = self.service.users().messages().get(userId='me', id=message_id, format='raw').execute()
-        return response
+        request = self.service.users().messages().get(userId='me', id=message_id, format='raw')
+        return self._execute(request, 'messages.get')
+
+    def fetch(self, msg_descs):
+        """
+        Fetch the messages of :param msg_descs in a single batch.
+
+        Return a tuple with the list of fetched messages and the list of descriptors of the
+        messages that failed and can be retried. Messages that no longer exist are in none of them.
+
+        Messages found in the cache are not requested. They are returned with their raw content
+        already decoded in `decoded` instead of `raw`.
+
+        """
+        cached = []
+        if self.cache is not None:
+            for msg_desc in msg_descs:
+                message = self.cache.get(msg_desc['id'])
+                if message is not None:
+                    cached.append(message)
+            if cached:
+                log.debug('%s messages found in the cache', len(cached))
+                cached_ids = {message['id'] for message in cached}
+                msg_descs = [msg_desc for msg_desc in msg_descs if msg_desc['id'] not in cached_ids]
+
+        if not msg_descs:
+            return cached, []
 
-    def fetch(self, msg_ids):
         fetcher = MessageFetcher()
 
         batch = self.service.new_batch_http_request(callback=fetcher.fetch_message)
-        for msg_desc in msg_ids:
-            batch.add(self.service.users().messages().get(userId='me', id=msg_desc['id'], format='raw'))
-        batch.execute()
+        for msg_desc in msg_descs:
+            batch.add(self.service.users().messages().get(userId='me', id=msg_desc['id'], format='raw'),
+                      request_id=msg_desc['id'])
+        # Each request of the batch is charged as an individual request
+        self._execute(batch, 'messages.get', units=len(msg_descs) * QUOTA_UNITS['messages.get'])
+
+        if fetcher.rate_limited:
+            self.limiter.throttled(fetcher.retry_after)
+
+        if self.cache is not None:
+            for message in fetcher.messages:
+                self.cache.put(message)
+
+        failed = [msg_desc for msg_desc in msg_descs if msg_desc['id'] in fetcher.failed]
+        return cached + fetcher.messages, failed
+
+    def fetch_one(self, msg_desc):
+        """
+        Fetch the message of :param msg_desc on its own, outside of a batch, e.g. a big message
+        that would delay the messages of its batch.
 
-        if len(fetcher.messages) < len(msg_ids):
-            # likely hit a rate limit. retry later.
-            raise Exception('fewer messages fetched than requested')
+        Return a tuple like `fetch`. Errors other than the message no longer existing are raised.
 
-        return fetcher.messages
+        """
+        if self.cache is not None:
+            message = self.cache.get(msg_desc['id'])
+            if message is not None:
+                return [message], []
+
+        try:
+            message = self.get(msg_desc['id'])
+        except HttpError as e:
+            if e.resp.status != 404:
+                raise
+            log.warning('Message not found: %s', msg_desc['id'])
+            return [], []
+
+        if self.cache is not None:
+            self.cache.put(message)
+        return [message], []
+
+    def estimate_sizes(self, msg_descs):
+        """
+        Add the estimated size in bytes of the messages of :param msg_descs to their descriptors,
+        as `sizeEstimate`. The sizes are requested in a single batch.
+
+        Only the size is requested, with the minimal format, but each request costs the same
+        quota units as fetching the message. Messages found in the cache are not requested, as
+        they are not fetched either. The descriptors of the messages whose size cannot be got
+        are not modified.
+
+        """
+        if self.cache is not None:
+            msg_descs = [msg_desc for msg_desc in msg_descs if msg_desc['id'] not in self.cache]
+        if not msg_descs:
+            return
+
+        sizes = {}
+        rate_limited = []
+
+        def size_estimate(request_id, response, exception):
+            if exception is not None:
+                log.debug('Error getting the size of message %s: %s', request_id, exception)
+                if is_rate_limit_error(exception):
+                    rate_limited.append(get_retry_after(exception))
+            elif 'sizeEstimate' in response:
+                sizes[request_id] = response['sizeEstimate']
+
+        batch = self.service.new_batch_http_request(callback=size_estimate)
+        for msg_desc in msg_descs:
+            batch.add(self.service.users().messages().get(userId='me', id=msg_desc['id'], format='minimal',
+                                                          fields=SIZE_FIELDS),
+                      request_id=msg_desc['id'])
+        self._execute(batch, 'messages.get', units=len(msg_descs) * QUOTA_UNITS['messages.get'])
+
+        if rate_limited:
+            retry_afters = [retry_after for retry_after in rate_limited if retry_after is not None]
+            self.limiter.throttled(max(retry_afters) if retry_afters else None)
+
+        for msg_desc in msg_descs:
+            if msg_desc['id'] in sizes:
+                msg_desc['sizeEstimate'] = sizes[msg_desc['id']]
+
+    def _execute(self, request, method, units=None):
+        """
+        Execute :param request once the rate limiter allows it.
+
+        Requests rejected because of the rate limit are retried after the cooldown of the limiter
+        up to MAX_ATTEMPTS times.
+
+        :param method: name of the method of the API, used to know the quota units it costs.
+
+        :param units: optional quota units the request costs, if they are not the units of
+        :param method.
+
+        """
+        if units is None:
+            units = QUOTA_UNITS[method]
+
+        attempt = 1
+        while True:
+            self.limiter.acquire(units)
+            try:
+                response = request.execute()
+            except HttpError as e:
+                if not is_rate_limit_error(e) or attempt >= MAX_ATTEMPTS:
+                    raise
+                self.limiter.throttled(get_retry_after(e))
+                attempt += 1
+            else:
+                self.limiter.success()
+                return response
@@ -2,7 +2,6 @@ import os
 from pathlib import Path
 import logging
 import logging.handlers
-import httplib2
 
 from .parser import EnhancedConfigParser
 from .loader import ConfigLoader
@@ -67,5 +66,6 @@ def set_up_logger(verbose, config=None):
         logger.addHandler(handler)
 
     if os.getenv('GMAILSYNC_DEBUG'):
+        import httplib2
         httplib2.debuglevel = 1
         logging.getLogger('googleapiclient.discovery').setLevel(logging.DEBUG)
@@ -17,6 +17,32 @@ class ConfigLoader:
             credentials = self.parser.getpath('general', 'credentials', is_file=True, readable=True, fallback=None)
             token = self.parser.getpath('general', 'token', fallback=None)
             box_type = self.parser.get('general', 'box_type', fallback=None)
+            sync_mode = self.parser.get('general', 'sync_mode', fallback=None)
+            backfill = self.parser.get('general', 'backfill', fallback=None)
+            durability = self.parser.get('general', 'durability', fallback=None)
+            maildir_shards = self.parser.get('general', 'maildir_shards', fallback=None)
+            maildir_shard_size = self.parser.getint('general', 'maildir_shard_size', fallback=None)
+            sqlite_compress = self.parser.getboolean('general', 'sqlite_compress', fallback=None)
+            sqlite_full_text = self.parser.getboolean('general', 'sqlite_full_text', fallback=None)
+            compression = self.parser.get('general', 'compression', fallback=None)
+            compression_dictionary = self.parser.getpath('general', 'compression_dictionary', is_file=True,
+                                                         readable=True, fallback=None)
+            workers = self.parser.getint('general', 'workers', fallback=None)
+            max_inflight_bytes = self.parser.getint('general', 'max_inflight_bytes', fallback=None)
+            batch_max_bytes = self.parser.getint('general', 'batch_max_bytes', fallback=None)
+            large_message_size = self.parser.getint('general', 'large_message_size', fallback=None)
+            transport = self.parser.get('general', 'transport', fallback=None)
+            http_pool_size = self.parser.getint('general', 'http_pool_size', fallback=None)
+            http_timeout = self.parser.getint('general', 'http_timeout', fallback=None)
+            routing = self.parser.get('general', 'routing', fallback=None)
+            cache = self.parser.getpath('general', 'cache', fallback=None)
+            cache_max_bytes = self.parser.getint('general', 'cache_max_bytes', fallback=None)
+            blob_store = self.parser.getpath('general', 'blob_store', fallback=None)
+            blob_min_size = self.parser.getint('general', 'blob_min_size', fallback=None)
+            hardlinks = self.parser.getboolean('general', 'hardlinks', fallback=None)
+            checkpoint_messages = self.parser.getint('general', 'checkpoint_messages', fallback=None)
+            checkpoint_interval = self.parser.getint('general', 'checkpoint_interval', fallback=None)
+            fsync_state = self.parser.getboolean('general', 'fsync_state', fallback=None)
 
             channels = {}
             groups = {}
@@ -38,6 +64,31 @@ class ConfigLoader:
             config = Config(credentials=credentials,
                             token=token,
                             box_type=box_type,
+                            sync_mode=sync_mode,
+                            backfill=backfill,
+                            durability=durability,
+                            maildir_shards=maildir_shards,
+                            maildir_shard_size=maildir_shard_size,
+                            sqlite_compress=sqlite_compress,
+                            sqlite_full_text=sqlite_full_text,
+                            compression=compression,
+                            compression_dictionary=compression_dictionary,
+                            workers=workers,
+                            max_inflight_bytes=max_inflight_bytes,
+                            batch_max_bytes=batch_max_bytes,
+                            large_message_size=large_message_size,
+                            transport=transport,
+                            http_pool_size=http_pool_size,
+                            http_timeout=http_timeout,
+                            routing=routing,
+                            cache=cache,
+                            cache_max_bytes=cache_max_bytes,
+                            blob_store=blob_store,
+                            blob_min_size=blob_min_size,
+                            hardlinks=hardlinks,
+                            checkpoint_messages=checkpoint_messages,
+                            checkpoint_interval=checkpoint_interval,
+                            fsync_state=fsync_state,
                             channels=channels,
                             groups=groups,
                             logger_config=logger_config,
@@ -55,7 +106,14 @@ class ConfigLoader:
         mailbox_path = self.parser.getpath(section, 'mailbox')
         query = self.parser.get(section, 'query', fallback=None)
         box_type = self.parser.get(section, 'box_type', fallback=None)
-        return ChannelConfig(name=name, mailbox_path=mailbox_path, query=query, box_type=box_type)
+        sync_mode = self.parser.get(section, 'sync_mode', fallback=None)
+        backfill = self.parser.get(section, 'backfill', fallback=None)
+        durability = self.parser.get(section, 'durability', fallback=None)
+        maildir_shards = self.parser.get(section, 'maildir_shards', fallback=None)
+        compression = self.parser.get(section, 'compression', fallback=None)
+        return ChannelConfig(name=name, mailbox_path=mailbox_path, query=query, box_type=box_type,
+                             sync_mode=sync_mode, backfill=backfill, durability=durability,
+                             maildir_shards=maildir_shards, compression=compression)
 
     def _parse_group(self, section):
         name = self._extract_name(section, prefix='group-')
@@ -3,6 +3,12 @@ Models to represent the configuration and its subconfigurations.
 """
 import os
 
+from ..cache import DEFAULT_MAX_BYTES as DEFAULT_CACHE_MAX_BYTES
+from ..state import DEFAULT_CHECKPOINT_INTERVAL, DEFAULT_CHECKPOINT_MESSAGES
+from ..storage.blobs import DEFAULT_MIN_SIZE as DEFAULT_BLOB_MIN_SIZE
+from ..storage.maildir import DEFAULT_SHARD_SIZE as DEFAULT_MAILDIR_SHARD_SIZE
+from ..sync import DEFAULT_MAX_INFLIGHT_BYTES
+from ..transport import DEFAULT_HTTP_TIMEOUT, DEFAULT_POOL_SIZE as DEFAULT_HTTP_POOL_SIZE
 from ..utils import expand_path
 
 
@@ -12,6 +18,32 @@ TOKEN_FILENAME = 'token.pickle'
 
 DEFAULT_BOX_TYPE = 'maildir'
 
+SYNC_MODES = ('query', 'history')
+DEFAULT_SYNC_MODE = 'query'
+
+BACKFILLS = ('none', 'year', 'month')
+DEFAULT_BACKFILL = 'none'
+
+ROUTINGS = ('channel', 'shared')
+DEFAULT_ROUTING = 'channel'
+
+DURABILITIES = ('none', 'batch', 'message')
+DEFAULT_DURABILITY = 'batch'
+
+MAILDIR_SHARDS = ('none', 'month', 'hash')
+DEFAULT_MAILDIR_SHARDS = 'none'
+
+DEFAULT_SQLITE_COMPRESS = False
+DEFAULT_SQLITE_FULL_TEXT = False
+
+DEFAULT_COMPRESSION = 'none'
+
+DEFAULT_WORKERS = 1
+
+DEFAULT_TRANSPORT = 'httplib2'
+
+DEFAULT_HARDLINKS = False
+
 DEFAULT_LOG_MAX_BYTES = 104857600  # 100 MB
 DEFAULT_LOG_BACKUP_COUNT = 50  # 50 files
 DEFAULT_LOG_FORMAT = '%(asctime)s %(levelname)s [%(name)s] %(message)s'
@@ -41,13 +73,34 @@ class ChannelConfig(BaseConfig):
     :param box_type: optional mailbox type. If it is not defined, the default one defined in
     Config will be used.
 
+    :param sync_mode: optional synchronization mode. If it is not defined, the default one defined
+    in Config will be used.
+
+    :param backfill: optional backfill mode of the first synchronization. If it is not defined,
+    the default one defined in Config will be used.
+
+    :param durability: optional durability of the mailbox. If it is not defined, the default one
+    defined in Config will be used.
+
+    :param maildir_shards: optional sharding of the Maildir mailbox. If it is not defined, the
+    default one defined in Config will be used.
+
+    :param compression: optional compression of the mailbox. If it is not defined, the default one
+    defined in Config will be used.
+
     """
 
-    def __init__(self, name, mailbox_path, query=None, box_type=None):
+    def __init__(self, name, mailbox_path, query=None, box_type=None, sync_mode=None, backfill=None,
+                 durability=None, maildir_shards=None, compression=None):
         self.name = name
         self.mailbox_path = expand_path(mailbox_path)
         self.query = query
         self.box_type = box_type
+        self.sync_mode = sync_mode
+        self.backfill = backfill
+        self.durability = durability
+        self.maildir_shards = maildir_shards
+        self.compression = compression
 
     def __str__(self):
         return 'ChannelConfig <{!r}>'.format(self.name)
@@ -107,6 +160,95 @@ class Config(BaseConfig):
     :param box_type: default mailbox type. It will the mailbox type of the channels if they do
     not define a different one explicitly.
 
+    :param sync_mode: default synchronization mode. It will be the synchronization mode of the
+    channels if they do not define a different one explicitly:
+      - query: list the messages of the channel received after the last synchronized one.
+      - history: list the changes in the mailbox since the last synchronization and only fall
+        back to the query if the history has expired.
+
+    :param backfill: default backfill mode of the first synchronization of the channels. It will
+    be the backfill mode of the channels if they do not define a different one explicitly:
+      - none: all the messages of the channel are listed at once, newest first.
+      - year: the history of the channel is split in a window per year, listed in parallel.
+      - month: the history of the channel is split in a window per month, listed in parallel.
+
+    :param durability: default durability of the mailboxes. It will be the durability of the
+    channels if they do not define a different one explicitly:
+      - none: messages are never flushed to the disk explicitly.
+      - batch: messages are flushed to the disk before saving the state of the mailbox, at least
+        once per fetched batch.
+      - message: each message is flushed to the disk after storing it.
+
+    :param maildir_shards: default sharding of the Maildir mailboxes. It will be the sharding of
+    the channels if they do not define a different one explicitly:
+      - none: all messages are stored in the Maildir itself.
+      - month: messages are stored in a sub-folder per month in which they were received.
+      - hash: messages are stored in a sub-folder per prefix of the hash of their Gmail id.
+
+    :param maildir_shard_size: max messages in a sub-folder of a sharded Maildir before rotating
+    to a new one.
+
+    :param sqlite_compress: if True, the messages of the SQLite mailboxes are stored compressed.
+
+    :param sqlite_full_text: if True, the subject, sender and body of the messages of the SQLite
+    mailboxes are indexed to search them locally.
+
+    :param compression: default compression of the messages of the Maildir, mbox and MMDF
+    mailboxes. It will be the compression of the channels if they do not define a different one
+    explicitly:
+      - none: messages are stored uncompressed.
+      - gzip: each message is compressed with gzip.
+      - zstd: each message is compressed with zstd. It requires the `zstandard` package.
+
+    :param compression_dictionary: optional path of a dictionary used by zstd compression.
+
+    :param workers: number of batches of messages fetched concurrently, each one with its own
+    connection.
+
+    :param max_inflight_bytes: max bytes of fetched messages waiting to be decoded and stored.
+
+    :param batch_max_bytes: optional max estimated bytes of the messages fetched in a batch. If it
+    is not defined, batches are only limited by their number of messages.
+
+    :param large_message_size: optional estimated size from which a message is fetched on its own
+    by a dedicated worker instead of in a batch.
+
+    :param transport: HTTP transport of the requests to the Gmail API:
+      - httplib2: each worker has its own connection.
+      - session: all the workers share a pool of keep-alive connections and the responses are
+        requested compressed.
+
+    :param http_pool_size: max connections kept open by the session transport.
+
+    :param http_timeout: timeout of the requests to the Gmail API, in seconds.
+
+    :param routing: how the fetched messages are routed to the channels:
+      - channel: each channel lists and fetches its own messages.
+      - shared: the messages of all the channels are listed first and each message is fetched
+        once and stored in every channel that matches it.
+
+    :param cache: optional path of the directory where to cache the fetched messages. If it is
+    not defined, messages are not cached.
+
+    :param cache_max_bytes: max size of the cache. The least recently used messages are evicted
+    when it is exceeded.
+
+    :param blob_store: optional path of the directory where to store the attachments of the
+    messages once, however many messages or channels contain them. If it is not defined,
+    attachments are stored in the messages.
+
+    :param blob_min_size: min size of an attachment to be moved to the blob store.
+
+    :param hardlinks: if True, a message stored in several Maildir mailboxes is written once and
+    hard linked in the rest of them.
+
+    :param checkpoint_messages: max messages stored in a mailbox between two writes of its state.
+
+    :param checkpoint_interval: max seconds between two writes of the state of a mailbox.
+
+    :param fsync_state: if True, the state of the mailboxes is flushed to the disk each time it
+    is written.
+
     :param channels: dict, list or tuple of ChannelConfig objects. If dict: key=name, value=object.
 
     :param groups: dict, list or tuple of GroupConfig objects. If dict: key=name, value=object.
@@ -116,8 +258,14 @@ class Config(BaseConfig):
 
     """
 
-    def __init__(self, credentials=None, token=None, box_type=None, channels=None, groups=None,
-                 logger_config=None, default_config_dir=None):
+    def __init__(self, credentials=None, token=None, box_type=None, sync_mode=None, backfill=None,
+                 durability=None, maildir_shards=None, maildir_shard_size=None, sqlite_compress=None,
+                 sqlite_full_text=None, compression=None, compression_dictionary=None, workers=None,
+                 max_inflight_bytes=None, batch_max_bytes=None, large_message_size=None, transport=None,
+                 http_pool_size=None, http_timeout=None, routing=None, cache=None, cache_max_bytes=None,
+                 blob_store=None, blob_min_size=None, hardlinks=None, checkpoint_messages=None,
+                 checkpoint_interval=None, fsync_state=None, channels=None, groups=None, logger_config=None,
+                 default_config_dir=None):
         default_credentials_file = None
         default_token_file = None
 
@@ -131,6 +279,32 @@ class Config(BaseConfig):
         self.credentials = expand_path(credentials_file) if credentials_file is not None else None
         self.token = expand_path(token_file) if token_file is not None else None
         self.box_type = self._get(box_type, default=DEFAULT_BOX_TYPE)
+        self.sync_mode = self._get(sync_mode, default=DEFAULT_SYNC_MODE)
+        self.backfill = self._get(backfill, default=DEFAULT_BACKFILL)
+        self.durability = self._get(durability, default=DEFAULT_DURABILITY)
+        self.maildir_shards = self._get(maildir_shards, default=DEFAULT_MAILDIR_SHARDS)
+        self.maildir_shard_size = self._get(maildir_shard_size, default=DEFAULT_MAILDIR_SHARD_SIZE)
+        self.sqlite_compress = self._get(sqlite_compress, default=DEFAULT_SQLITE_COMPRESS)
+        self.sqlite_full_text = self._get(sqlite_full_text, default=DEFAULT_SQLITE_FULL_TEXT)
+        self.compression = self._get(compression, default=DEFAULT_COMPRESSION)
+        self.compression_dictionary = (expand_path(compression_dictionary)
+                                       if compression_dictionary is not None else None)
+        self.workers = self._get(workers, default=DEFAULT_WORKERS)
+        self.max_inflight_bytes = self._get(max_inflight_bytes, default=DEFAULT_MAX_INFLIGHT_BYTES)
+        self.batch_max_bytes = batch_max_bytes
+        self.large_message_size = large_message_size
+        self.transport = self._get(transport, default=DEFAULT_TRANSPORT)
+        self.http_pool_size = self._get(http_pool_size, default=DEFAULT_HTTP_POOL_SIZE)
+        self.http_timeout = self._get(http_timeout, default=DEFAULT_HTTP_TIMEOUT)
+        self.routing = self._get(routing, default=DEFAULT_ROUTING)
+        self.cache = expand_path(cache) if cache is not None else None
+        self.cache_max_bytes = self._get(cache_max_bytes, default=DEFAULT_CACHE_MAX_BYTES)
+        self.blob_store = expand_path(blob_store) if blob_store is not None else None
+        self.blob_min_size = self._get(blob_min_size, default=DEFAULT_BLOB_MIN_SIZE)
+        self.hardlinks = self._get(hardlinks, default=DEFAULT_HARDLINKS)
+        self.checkpoint_messages = self._get(checkpoint_messages, default=DEFAULT_CHECKPOINT_MESSAGES)
+        self.checkpoint_interval = self._get(checkpoint_interval, default=DEFAULT_CHECKPOINT_INTERVAL)
+        self.fsync_state = self._get(fsync_state, default=False)
 
         self.logger_config = self._get(logger_config, default=LoggerConfig())
 
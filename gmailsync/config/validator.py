@@ -1,3 +1,8 @@
+from ..storage.compression import COMPRESSIONS, zstandard
+from ..transport import TRANSPORTS
+from .models import SYNC_MODES, BACKFILLS, ROUTINGS, DURABILITIES, MAILDIR_SHARDS
+
+
 class ConfigurationError(ValueError):
     pass
 
@@ -8,10 +13,61 @@ class ConfigValidator:
         if not config.channels:
             raise ConfigurationError('No channels found in config')
 
+        self._validate_choice('sync_mode', config.sync_mode, SYNC_MODES)
+        self._validate_choice('backfill', config.backfill, BACKFILLS)
+        self._validate_choice('durability', config.durability, DURABILITIES)
+        self._validate_choice('maildir_shards', config.maildir_shards, MAILDIR_SHARDS)
+        self._validate_positive('maildir_shard_size', config.maildir_shard_size)
+        self._validate_compression(config.compression)
+        self._validate_positive('workers', config.workers)
+        self._validate_positive('max_inflight_bytes', config.max_inflight_bytes)
+        if config.batch_max_bytes is not None:
+            self._validate_positive('batch_max_bytes', config.batch_max_bytes)
+        if config.large_message_size is not None:
+            self._validate_positive('large_message_size', config.large_message_size)
+        self._validate_choice('transport', config.transport, TRANSPORTS)
+        self._validate_positive('http_pool_size', config.http_pool_size)
+        self._validate_positive('http_timeout', config.http_timeout)
+        self._validate_choice('routing', config.routing, ROUTINGS)
+        self._validate_positive('cache_max_bytes', config.cache_max_bytes)
+        self._validate_positive('blob_min_size', config.blob_min_size)
+        self._validate_positive('checkpoint_messages', config.checkpoint_messages)
+        self._validate_positive('checkpoint_interval', config.checkpoint_interval)
+
+        for channel in config.channels.values():
+            self._validate_channel(channel)
+
         for group in config.groups.values():
             self._validate_group(config, group)
 
+    def _validate_channel(self, channel):
+        if channel.sync_mode is not None:
+            self._validate_choice('sync_mode', channel.sync_mode, SYNC_MODES, channel=channel)
+        if channel.backfill is not None:
+            self._validate_choice('backfill', channel.backfill, BACKFILLS, channel=channel)
+        if channel.durability is not None:
+            self._validate_choice('durability', channel.durability, DURABILITIES, channel=channel)
+        if channel.maildir_shards is not None:
+            self._validate_choice('maildir_shards', channel.maildir_shards, MAILDIR_SHARDS, channel=channel)
+        if channel.compression is not None:
+            self._validate_compression(channel.compression, channel=channel)
+
     def _validate_group(self, config, group):
         for channel in group.channels:
             if channel not in config.channels:
                 raise ConfigurationError('Channel {!r} in group {!r} is not defined'.format(channel, group.name))
+
+    def _validate_choice(self, option, value, choices, channel=None):
+        if value not in choices:
+            if channel is None:
+                raise ConfigurationError('Invalid {}: {!r}'.format(option, value))
+            raise ConfigurationError('Invalid {} in channel {!r}: {!r}'.format(option, channel.name, value))
+
+    def _validate_compression(self, value, channel=None):
+        self._validate_choice('compression', value, COMPRESSIONS, channel=channel)
+        if value == 'zstd' and zstandard is None:
+            raise ConfigurationError('zstd compression requires the zstandard package: pip install zstandard')
+
+    def _validate_positive(self, option, value):
+        if value < 1:
+            raise ConfigurationError('Invalid {}: {!r}. It must be greater than 0'.format(option, value))
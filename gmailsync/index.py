@@ -0,0 +1,87 @@
+"""
+Index of the messages stored in a mailbox.
+"""
+import sqlite3
+import threading
+
+
+class MessageIndex:
+    """
+    Persistent index of the messages stored in a mailbox: Gmail message id -> mailbox key, size
+    and timestamp of the message.
+
+    It is used to know whether a message is already in the mailbox without fetching it again or
+    reading the mailbox, so the synchronization can be repeated or resumed without storing
+    duplicates.
+
+    It is backed by SQLite, so lookups by id stay fast for millions of entries without loading
+    the index in memory. Additions are not persisted until `commit` is called, so they can be
+    grouped in a single transaction.
+
+    It is thread-safe: messages can be looked up while they are being added from another thread.
+
+    :param path: path of the index file. It is created if it does not exist.
+
+    :param durable: if True, each commit is flushed to the disk. Otherwise, the last commits can be
+    lost on a power failure, although the index is never corrupted.
+
+    """
+
+    def __init__(self, path, durable=False):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous={}'.format('FULL' if durable else 'NORMAL'))
+            self._connection.execute('CREATE TABLE IF NOT EXISTS messages ('
+                                     'id TEXT PRIMARY KEY, key TEXT, size INTEGER, timestamp INTEGER'
+                                     ') WITHOUT ROWID')
+            self._connection.commit()
+
+    def add(self, msg_id, key, size, timestamp):
+        """
+        Register the message :param msg_id stored with :param key in the mailbox.
+
+        """
+        with self._lock:
+            self._connection.execute('INSERT OR REPLACE INTO messages (id, key, size, timestamp) VALUES (?, ?, ?, ?)',
+                                     (msg_id, key, size, timestamp))
+
+    def get(self, msg_id):
+        """
+        Get a tuple (key, size, timestamp) of the message :param msg_id, or `None` if it is not
+        in the index.
+
+        """
+        with self._lock:
+            return self._connection.execute('SELECT key, size, timestamp FROM messages WHERE id = ?',
+                                            (msg_id,)).fetchone()
+
+    def items(self):
+        """
+        Get a list of tuples (msg_id, key, size, timestamp) of all the messages in the index.
+
+        """
+        with self._lock:
+            return self._connection.execute('SELECT id, key, size, timestamp FROM messages').fetchall()
+
+    def commit(self):
+        """
+        Persist the messages added since the last commit.
+
+        """
+        with self._lock:
+            self._connection.commit()
+
+    def close(self):
+        with self._lock:
+            self._connection.commit()
+            self._connection.close()
+
+    def __contains__(self, msg_id):
+        return self.get(msg_id) is not None
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
@@ -1,39 +1,189 @@
-from mailbox import Maildir
-from mailbox import mbox
-from mailbox import MH
-from mailbox import Babyl
-from mailbox import MMDF
+from mailbox import Babyl, MMDF, mbox
+import json
+import logging
 import os
 
+from .index import MessageIndex
 from .message import MessageFormatter
+from .state import StateWriter, DEFAULT_CHECKPOINT_MESSAGES, DEFAULT_CHECKPOINT_INTERVAL
+from .storage import AppendOnlyMaildir, AppendOnlyMbox, AppendOnlyMMDF, AppendOnlyMH, Compressor, OffsetIndex
+from .storage import OffsetRecord, ShardedMaildir, SQLiteMailbox
+from .storage.maildir import DEFAULT_SHARD_SIZE
+
+
+log = logging.getLogger('gmailsync')
+
+
+# Box types stored in a directory. The rest are stored in a single file
+DIRECTORY_BOX_TYPES = ('maildir', 'mh')
+
+# Box types whose messages can be compressed
+COMPRESSED_BOX_TYPES = ('maildir', 'mbox', 'mmdf')
+
+# Readers of the standard library of the box types stored in a single file
+SINGLE_FILE_READERS = {'mbox': mbox, 'mmdf': MMDF, 'babyl': Babyl}
+
+STATE_FILENAME = '.gmailsyncstate'
+INDEX_FILENAME = '.gmailsyncindex'
+OFFSET_FILENAME = '.gmailsyncoffset'
+OFFSET_INDEX_FILENAME = '.gmailsyncoffsets'
+
+
+class SyncWindow:
+    """
+    Range of time of a channel whose messages are being synchronized.
+
+    Gmail lists the messages newest first, so a window is synchronized from its upper bound
+    down to its lower bound. Once all the messages listed before one are stored, the upper bound
+    is moved to the timestamp of that message, so if the synchronization is interrupted it can be
+    resumed listing only the messages that are still pending.
+
+    :param after: timestamp (seconds since epoch) of the lower bound, exclusive. `None` if the
+    window has no lower bound.
+
+    :param before: timestamp (seconds since epoch) of the upper bound, inclusive. `None` if the
+    window has no upper bound yet.
+
+    """
+
+    def __init__(self, after=None, before=None):
+        self.after = after
+        self.before = before
+
+    def to_json(self):
+        return [self.after, self.before]
+
+    @classmethod
+    def from_json(cls, value):
+        after, before = value
+        return cls(after, before)
+
+    def __str__(self):
+        return 'SyncWindow <{}, {}>'.format(self.after, self.before)
 
 
 class Mailbox:
     """
     Mailbox storage with state.
+
+    The state keeps the timestamp of the most recent message stored, the windows of time whose
+    synchronization has been started but not finished yet, whether the backfill of the mailbox
+    has been started and, optionally, the id of the last synchronized record of the Gmail
+    history.
+
+    The index keeps the Gmail ids of the messages stored, so messages already in the mailbox
+    are not fetched and stored again.
+
+    Single-file mailboxes (mbox, MMDF, Babyl) also keep an OffsetIndex with the position of each
+    message in the file, next to it. It is rebuilt from the mailbox if it does not exist.
+
+    The changes of the state caused by new messages are written in checkpoints, see StateWriter.
+    `flush` writes the pending changes.
+
+    :param checkpoint_messages: max messages stored between two writes of the state.
+
+    :param checkpoint_interval: max seconds between two writes of the state.
+
+    :param fsync_state: if True, the state is flushed to the disk each time it is written.
+
+    :param durability: when the stored messages are flushed to the disk:
+      - none: never, the operating system decides.
+      - batch: before each write of the state, so the state never refers to messages that could
+        be lost by a crash. It implies `fsync_state`.
+      - message: after storing each message. It implies `fsync_state`.
+    Babyl mailboxes are always written as the standard library does.
+
+    :param maildir_shards: how the messages of a Maildir mailbox are spread across sub-folders:
+      - none: all messages are stored in the mailbox itself.
+      - month, hash: see ShardedMaildir.
+    It is ignored by the rest of box types.
+
+    :param maildir_shard_size: max messages in a sub-folder of a Maildir mailbox before rotating
+    to a new one.
+
+    :param sqlite_compress: if True, the messages of a SQLite mailbox are stored compressed.
+
+    :param sqlite_full_text: if True, the messages of a SQLite mailbox are indexed to be searched.
+
+    :param compression: compression of the messages of Maildir, mbox and MMDF mailboxes: `none`,
+    `gzip` or `zstd`, see Compressor. It is ignored by the rest of box types.
+
+    :param compression_dictionary: optional path of the dictionary used by zstd compression.
+
+    :param blob_store: optional BlobStore where to move the attachments of the messages before
+    storing them.
+
+    :param linker: optional MessageLinker shared by several Maildir mailboxes, to hard link the
+    messages already stored in another one instead of writing them again. It is ignored by the
+    rest of box types.
+
     """
-    def __init__(self, box_type, path, formatter=None):
+    def __init__(self, box_type, path, formatter=None, checkpoint_messages=DEFAULT_CHECKPOINT_MESSAGES,
+                 checkpoint_interval=DEFAULT_CHECKPOINT_INTERVAL, fsync_state=False, durability='batch',
+                 maildir_shards='none', maildir_shard_size=DEFAULT_SHARD_SIZE, sqlite_compress=False,
+                 sqlite_full_text=False, compression='none', compression_dictionary=None,
+                 blob_store=None, linker=None):
         self.path = path
+        self.box_type = box_type
         self.formatter = formatter
+        self.blob_store = blob_store
+        self.linker = linker if box_type == 'maildir' else None
+        # Only mailboxes that write the same content for a message can share its file
+        self.link_group = (compression, compression_dictionary) if compression != 'none' else None
         if self.formatter is None:
             self.formatter = MessageFormatter()
 
-        self.state_file = os.path.join(path, '.gmailsyncstate')
-        self.state = self._load_state()
+        self.state_file = self._meta_path(STATE_FILENAME)
+        state = self._load_state()
+        self.state = state.get('timestamp')
+        self.windows = [SyncWindow.from_json(w) for w in state.get('windows', [])]
+        self.history_id = state.get('history_id')
+        self.backfilled = state.get('backfilled', False)
+        durable = durability != 'none'
+        self.state_writer = StateWriter(self.state_file, checkpoint_messages=checkpoint_messages,
+                                        checkpoint_interval=checkpoint_interval, fsync=fsync_state or durable)
 
-        if box_type == 'maildir':
-            self.mailbox = Maildir(path)
+        self.compressor = None
+        if compression != 'none' and box_type in COMPRESSED_BOX_TYPES:
+            self.compressor = Compressor(compression,
+                                         dictionary=compression_dictionary if compression == 'zstd' else None)
+
+        sharded = box_type == 'maildir' and maildir_shards != 'none'
+        # Writers that store the timestamp and the Gmail id of the messages too
+        self.add_metadata = sharded or box_type == 'sqlite'
+        if sharded:
+            self.mailbox = ShardedMaildir(path, shards=maildir_shards, shard_size=maildir_shard_size,
+                                          durability=durability, compressor=self.compressor)
+        elif box_type == 'maildir':
+            self.mailbox = AppendOnlyMaildir(path, durability=durability, compressor=self.compressor)
         elif box_type == 'mbox':
-            self.mailbox = mbox(path)
+            self.mailbox = AppendOnlyMbox(path, self._meta_path(OFFSET_FILENAME), durability=durability,
+                                          compressor=self.compressor)
         elif box_type == 'mh':
-            self.mailbox = MH(path)
+            self.mailbox = AppendOnlyMH(path, durability=durability)
         elif box_type == 'babyl':
             self.mailbox = Babyl(path)
         elif box_type == 'mmdf':
-            self.mailbox = MMDF(path)
+            self.mailbox = AppendOnlyMMDF(path, self._meta_path(OFFSET_FILENAME), durability=durability,
+                                          compressor=self.compressor)
+        elif box_type == 'sqlite':
+            self.mailbox = SQLiteMailbox(path, compress=sqlite_compress, full_text=sqlite_full_text,
+                                         durability=durability)
         else:
             raise NotImplementedError('Unsupported mailbox: {!r}'.format(box_type))
 
+        # Once the mailbox exists, as it may be created inside it
+        self.index = MessageIndex(self._meta_path(INDEX_FILENAME), durable=durable)
+
+        self.offsets = None
+        if box_type in SINGLE_FILE_READERS:
+            offsets_path = self._meta_path(OFFSET_INDEX_FILENAME)
+            missing = not os.path.isfile(offsets_path)
+            self.offsets = OffsetIndex(offsets_path, fsync=durable)
+            # Compressed mailboxes cannot be parsed to find the messages again
+            if missing and os.path.isfile(path) and len(self.index) > 0 and self.compressor is None:
+                self.rebuild_offsets()
+
     def add(self, message):
         """
         Store a message in the mailbox.
@@ -47,34 +197,236 @@ class Mailbox:
             ordering in the inbox. It is used to track the state of the mailbox.
           - labelIds: list of labels with which the message has been labeled.
 
+        Return the timestamp of the message (seconds since epoch).
+
+        """
+        return self.store(self.format(message), msg_id=message['id'])
+
+    def format(self, message):
+        """
+        Decode and fix a Gmail API message to be stored with `store`.
+
+        It does not modify the mailbox, so it can run in a different thread than `store`.
+
+        Maildir mailboxes decode the messages while they are stored, without decoding them here,
+        unless their attachments are moved to a blob store.
+
+        """
+        return self.formatter.format(message, lazy=self.box_type == 'maildir' and self.blob_store is None)
+
+    def store(self, formatted, msg_id=None):
         """
-        formatted = self.formatter.format(message)
-        self.mailbox.add(formatted['message'])
+        Store a message already formatted with `format`.
+
+        :param msg_id: optional Gmail id of the message, to register it in the index.
+
+        Return the timestamp of the message (seconds since epoch).
+
+        """
+        message = formatted['message']
+        if self.blob_store is not None:
+            message = self.blob_store.split(message)
+        kwargs = {}
+        if self.add_metadata:
+            kwargs.update(timestamp=formatted['timestamp'], msg_id=msg_id)
+        if self.linker is not None and msg_id is not None:
+            kwargs['source'] = self.linker.find(msg_id, group=self.link_group)
+
+        key = self.mailbox.add(message, **kwargs)
+
+        if self.linker is not None and msg_id is not None:
+            self.linker.register(msg_id, self.mailbox, key, group=self.link_group)
+        if msg_id is not None:
+            self.index.add(msg_id, str(key), len(formatted['message']), formatted['timestamp'])
+            if self.offsets is not None:
+                start, stop = self._span(key)
+                self.offsets.append(msg_id, start, stop - start, formatted['timestamp'])
         self._update_state(formatted['timestamp'])
+        return formatted['timestamp']
+
+    def contains(self, msg_id):
+        """
+        Check if the message with Gmail id :param msg_id is already stored in the mailbox.
+
+        """
+        return msg_id in self.index
+
+    def rebuild_offsets(self):
+        """
+        Rebuild the offset index of a single-file mailbox from the mailbox and the index.
+
+        Messages of the mailbox not stored by gmailsync are not in the index, so they are left out.
+
+        """
+        log.info('Rebuilding the offset index of %s', self)
+        self.mailbox.flush()
+        self.index.commit()
+        stored = {key: (msg_id, timestamp) for msg_id, key, _, timestamp in self.index.items()}
+
+        reader = SINGLE_FILE_READERS[self.box_type](self.path, create=False)
+        records = []
+        try:
+            for key in reader.keys():
+                # The standard library keeps the position of each message in its table of contents
+                start, stop = reader._toc[key]
+                msg_id, timestamp = stored.get(str(key if self.box_type == 'babyl' else start), (None, None))
+                if msg_id is not None:
+                    records.append(OffsetRecord(msg_id, start, stop - start, timestamp))
+        finally:
+            reader.close()
+        self.offsets.rewrite(records)
 
     def get_last_timestamp(self):
         return self.state
 
+    def get_history_id(self):
+        return self.history_id
+
+    def set_history_id(self, history_id):
+        """
+        Save the id of the history record up to which all messages of the mailbox have been
+        synchronized.
+
+        """
+        self.history_id = history_id
+        self._save_state()
+
+    def get_pending_windows(self):
+        """
+        Get the windows whose synchronization was interrupted, oldest first.
+
+        """
+        return sorted(self.windows, key=lambda w: (w.after or 0))
+
+    def open_window(self, after):
+        """
+        Start the synchronization of all messages received after :param after.
+
+        The window is saved in the state before storing any message so the synchronization can be
+        resumed if it is interrupted.
+
+        """
+        window = SyncWindow(after)
+        self.windows.append(window)
+        self._save_state()
+        return window
+
+    def is_backfilled(self):
+        return self.backfilled
+
+    def open_windows(self, bounds):
+        """
+        Start the backfill of the mailbox: the synchronization of several windows at once, one per
+        tuple (after, before) of :param bounds.
+
+        The backfill is recorded in the state together with its windows, so it is done once even
+        if no message is stored: an interrupted backfill is resumed from its pending windows.
+
+        """
+        windows = [SyncWindow(after, before) for after, before in bounds]
+        self.windows.extend(windows)
+        self.backfilled = True
+        self._save_state()
+        return windows
+
+    def advance_window(self, window, timestamp):
+        """
+        Move the upper bound of :param window to :param timestamp once all the messages of the
+        window received after it have been stored.
+
+        """
+        window.before = timestamp if window.before is None else min(window.before, timestamp)
+        self._checkpoint_state(messages=0)
+
+    def close_window(self, window):
+        """
+        Finish the synchronization of :param window once all its messages have been stored.
+
+        """
+        self.windows.remove(window)
+        self._save_state()
+
+    def flush(self):
+        """
+        Write the changes of the state not written yet by a checkpoint.
+
+        """
+        if self.state_writer.dirty:
+            self._save_state()
+
+    def close(self):
+        """
+        Write the pending changes of the state and release the files and the databases of the
+        mailbox.
+
+        """
+        self.flush()
+        self.mailbox.close()
+        if self.offsets is not None:
+            self.offsets.close()
+        self.index.close()
+
     def _update_state(self, timestamp):
         """
-        Save the state of the already stored messages before to continue storing more messages
-        to be able to recover the synchronization in case of failure.
+        Update the state with an already stored message, to be able to recover the synchronization
+        in case of failure from the next checkpoint.
 
         """
         if self.state is None:
             self.state = timestamp
         else:
             self.state = max(self.state, timestamp)
-        self._save_state(self.state)
+        self._checkpoint_state()
+
+    def _checkpoint_state(self, messages=1):
+        if self.state_writer.changed(messages):
+            self._save_state()
+
+    def _meta_path(self, filename):
+        """
+        Path of a file of gmailsync with metadata of the mailbox: inside the directory of the
+        mailbox, or next to the file of the mailbox for single-file box types.
+
+        """
+        if self.box_type in DIRECTORY_BOX_TYPES:
+            return os.path.join(self.path, filename)
+        return self.path + filename
+
+    def _span(self, key):
+        """
+        Get the offset and the end of the message :param key in a single-file mailbox.
+
+        """
+        if self.box_type == 'babyl':
+            return self.mailbox._toc[key]
+        return self.mailbox.last_span
 
     def _load_state(self):
         if os.path.isfile(self.state_file):
             with open(self.state_file, 'r') as f:
-                return int(f.read().strip())
+                state = json.loads(f.read().strip())
+            if isinstance(state, int):
+                # Legacy state: just the timestamp of the last message
+                return {'timestamp': state}
+            return state
+        return {}
+
+    def _save_state(self):
+        # Messages and index are persisted first, so they always contain at least the messages
+        # the state knows
+        self.mailbox.flush()
+        if self.offsets is not None:
+            self.offsets.flush()
+        self.index.commit()
 
-    def _save_state(self, state):
-        with open(self.state_file, 'w') as f:
-            f.write(str(state))
+        state = {'timestamp': self.state}
+        if self.windows:
+            state['windows'] = [w.to_json() for w in self.windows]
+        if self.history_id is not None:
+            state['history_id'] = self.history_id
+        if self.backfilled:
+            state['backfilled'] = True
+        self.state_writer.write(state)
 
     def __str__(self):
         return 'Mailbox <{}>'.format(self.path)
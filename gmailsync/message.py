@@ -4,6 +4,42 @@ import base64
 import datetime
 
 
+# Characters of a base64 encoded message decoded at once. Multiple of 4 so chunks can be decoded
+# independently
+DECODE_CHUNK_SIZE = 262144
+
+
+class EncodedMessage:
+    """
+    Raw message still base64url encoded, to be decoded by chunks while it is written instead of
+    being decoded in memory at once.
+
+    :param data: the entire email message in an RFC 2822 formatted and base64url encoded string.
+
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+    def chunks(self, size=DECODE_CHUNK_SIZE):
+        """
+        Iterate over the decoded message in chunks decoded from :param size characters.
+
+        """
+        for i in range(0, len(self.data), size):
+            yield base64.urlsafe_b64decode(self.data[i:i + size])
+
+    def decode(self):
+        return base64.urlsafe_b64decode(self.data)
+
+    def __len__(self):
+        """
+        Size of the decoded message.
+
+        """
+        return len(self.data.rstrip('=')) * 3 // 4
+
+
 class MessageFormatter:
     """
     Fixer to format malformed messages according to the RFC 2822 specification:
@@ -63,7 +99,7 @@ class MessageFormatter:
     def __init__(self):
         self.parser = email.parser.HeaderParser()
 
-    def format(self, message_entity):
+    def format(self, message_entity, lazy=False):
         """
         Format a message according to the RFC 2822 specification and try to fix malformed
         messages.
@@ -77,16 +113,25 @@ class MessageFormatter:
             ordering in the inbox. It is used to track the state of the mailbox.
           - labelIds: list of labels with which the message has been labeled.
 
+        :param lazy: if True, well-formed messages are not decoded but returned as EncodedMessage,
+        to be decoded by chunks while they are written.
+
         """
-        message = self._decode(message_entity)
         timestamp = self._get_timestamp(message_entity)
 
         if 'CHAT' in message_entity['labelIds']:
-            message = self._fix_message(message, timestamp)
+            message = self._fix_message(self._decode(message_entity), timestamp)
+        elif lazy and 'raw' in message_entity:
+            message = EncodedMessage(message_entity['raw'])
+        else:
+            message = self._decode(message_entity)
 
         return {'message': message, 'timestamp': timestamp}
 
     def _decode(self, message):
+        if 'decoded' in message:
+            # Already decoded, e.g. read from the cache
+            return message['decoded']
         return base64.urlsafe_b64decode(message['raw'].encode('ASCII'))
 
     def _get_timestamp(self, message):
@@ -0,0 +1,152 @@
+"""
+Producer/consumer pipeline to overlap the stages of the synchronization in different threads.
+"""
+import logging
+import queue
+import threading
+
+
+log = logging.getLogger('gmailsync')
+
+
+class ByteBudget:
+    """
+    Semaphore of bytes to limit the memory used by the items in flight in a pipeline.
+
+    An item larger than the whole budget is allowed when nothing else is in flight, so it
+    never blocks forever.
+
+    :param max_bytes: max bytes in flight.
+
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, size, abort=None):
+        """
+        Block until :param size bytes are available and reserve them.
+
+        :param abort: optional threading.Event to stop waiting.
+
+        """
+        with self._condition:
+            while self.used > 0 and self.used + size > self.max_bytes:
+                if abort is not None and abort.is_set():
+                    return
+                self._condition.wait(timeout=0.1)
+            self.used += size
+
+    def release(self, size):
+        with self._condition:
+            self.used -= size
+            self._condition.notify_all()
+
+
+class Pipeline:
+    """
+    Chain of stages, each one running in its own thread, joined by queues.
+
+    Each stage is a function that receives the result of the previous stage. The result of the
+    last stage is discarded. Items are processed in the order they are put in the pipeline.
+
+    Backpressure is applied by bytes: `put` blocks while the items in flight in any stage add
+    up to more than :param max_bytes.
+
+    If a stage fails the pipeline stops processing items and the error is raised in the thread
+    that feeds the pipeline, in the next call to `put` or in `close`.
+
+    It can be used as a context manager, which closes the pipeline on exit.
+
+    :param stages: functions of the stages, in order.
+
+    :param max_bytes: max bytes in flight.
+
+    :param name: name of the pipeline, used to name its threads.
+
+    """
+
+    _END = object()
+
+    def __init__(self, stages, max_bytes, name='pipeline'):
+        self.budget = ByteBudget(max_bytes)
+        self.error = None
+        self._failed = threading.Event()
+        self._queues = [queue.Queue() for _ in stages]
+        self._threads = []
+
+        for i, stage in enumerate(stages):
+            output = self._queues[i + 1] if i + 1 < len(stages) else None
+            thread = threading.Thread(target=self._run, args=(stage, self._queues[i], output),
+                                      name='{}-{}'.format(name, getattr(stage, '__name__', i)), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def put(self, item, size=0):
+        """
+        Put :param item in the first stage.
+
+        :param size: bytes of the item accounted in the budget until the last stage processes it.
+
+        """
+        self._raise_error()
+        self.budget.acquire(size, abort=self._failed)
+        self._raise_error()
+        self._queues[0].put((item, size))
+
+    def close(self):
+        """
+        Wait until all the items have been processed and stop the threads.
+
+        """
+        self._queues[0].put(self._END)
+        for thread in self._threads:
+            thread.join()
+        self._raise_error()
+
+    def abort(self):
+        """
+        Discard the items in flight and stop the threads.
+
+        """
+        self._failed.set()
+        self._queues[0].put(self._END)
+        for thread in self._threads:
+            thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _run(self, stage, input, output):
+        while True:
+            envelope = input.get()
+            if envelope is self._END:
+                if output is not None:
+                    output.put(envelope)
+                return
+
+            item, size = envelope
+            if not self._failed.is_set():
+                try:
+                    item = stage(item)
+                except BaseException as e:
+                    log.debug('Pipeline stage %s failed', stage, exc_info=True)
+                    self.error = e
+                    self._failed.set()
+
+            if output is not None and not self._failed.is_set():
+                output.put((item, size))
+            else:
+                self.budget.release(size)
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise self.error
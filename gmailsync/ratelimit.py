@@ -0,0 +1,126 @@
+"""
+Client-side rate limiting based on the quota units of the Gmail API.
+
+https://developers.google.com/workspace/gmail/api/reference/quota
+"""
+import logging
+import secrets
+import threading
+import time
+
+
+log = logging.getLogger('gmailsync')
+
+
+# Quota units consumed by each method of the API
+QUOTA_UNITS = {
+    'getProfile': 1,
+    'labels.list': 1,
+    'history.list': 2,
+    'messages.list': 5,
+    'messages.get': 5,
+}
+
+# Per-user rate limit: 250 quota units per second
+DEFAULT_RATE = 250
+
+# The rate never goes below this value however many rate limit errors are received
+MIN_RATE = 10
+
+# Units per second recovered with each successful request after a rate limit error
+RATE_INCREASE = 5
+
+# Fraction of the rate kept after a rate limit error
+RATE_DECREASE = 0.5
+
+# Max cooldown (in seconds) after consecutive rate limit errors without `Retry-After`
+MAX_COOLDOWN = 64
+
+
+class RateLimiter:
+    """
+    Token bucket of quota units shared by all requests to the API.
+
+    Each request must acquire the quota units it costs before being sent. The bucket is refilled
+    at `rate` units per second up to `capacity` units, so short bursts are allowed while the
+    average stays below the quota.
+
+    The rate adapts to the responses of the API (AIMD): it is halved with each rate limit error
+    and increased additively with each successful request, up to the max rate.
+
+    It is thread-safe: several threads can share the same limiter.
+
+    :param rate: max rate in quota units per second.
+
+    :param capacity: max units in the bucket. By default, the units of one second at max rate.
+
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, capacity=None):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._blocked_until = 0
+        self._consecutive_errors = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, units):
+        """
+        Block until :param units quota units are available and consume them.
+
+        Units are reserved immediately, so requests are served in order of arrival and a request
+        larger than the capacity of the bucket just waits longer.
+
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens -= units
+            wait = max(self._blocked_until - now, 0) + max(-self._tokens / self.rate, 0)
+
+        if wait > 0:
+            log.debug('Waiting %.2f seconds to respect the quota', wait)
+            time.sleep(wait)
+
+    def success(self):
+        """
+        Notify a successful request. The rate is increased additively.
+
+        """
+        with self._lock:
+            self._consecutive_errors = 0
+            self.rate = min(self.rate + RATE_INCREASE, self.max_rate)
+
+    def throttled(self, retry_after=None):
+        """
+        Notify a rate limit error (HTTP 429 or 403 with a rate limit reason).
+
+        The rate is decreased multiplicatively and no units are served until :param retry_after
+        seconds have passed. If the API did not send `Retry-After`, an exponential cooldown is
+        applied instead.
+
+        """
+        with self._lock:
+            self._consecutive_errors += 1
+            self.rate = max(self.rate * RATE_DECREASE, MIN_RATE)
+
+            if retry_after is None:
+                retry_after = min(2 ** self._consecutive_errors, MAX_COOLDOWN) + secrets.SystemRandom().uniform(0, 1)
+            self._block(retry_after)
+
+            log.warning('Rate limit exceeded. Cooling down for %.2f seconds, new rate: %.0f units/s',
+                        retry_after, self.rate)
+
+    def _block(self, seconds):
+        now = time.monotonic()
+        self._refill(now)
+        self._tokens = min(self._tokens, 0)
+        self._blocked_until = max(self._blocked_until, now + seconds)
+
+    def _refill(self, now):
+        elapsed = max(now - max(self._updated_at, self._blocked_until), 0)
+        self._tokens = min(self._tokens + elapsed * self.rate, self.capacity)
+        self._updated_at = max(now, self._updated_at)
@@ -0,0 +1,77 @@
+"""
+Persistence of the state of the mailboxes.
+"""
+import json
+import logging
+import time
+
+from .utils import write_atomically
+
+
+log = logging.getLogger('gmailsync')
+
+
+# Changes of the state kept in memory before writing it to disk
+DEFAULT_CHECKPOINT_MESSAGES = 100
+
+# Max seconds the changes of the state are kept in memory before writing it to disk
+DEFAULT_CHECKPOINT_INTERVAL = 5
+
+
+class StateWriter:
+    """
+    Writer of the state file of a mailbox with checkpoints.
+
+    Writing the state after each stored message costs an extra write per message, so changes are
+    accumulated in memory and the state is only written once every :param checkpoint_messages
+    messages or :param checkpoint_interval seconds, whichever comes first. The owner of the state
+    decides when a change is a checkpoint with `changed`, and when the state must be written
+    anyway (e.g. at the end of a batch) with `write`.
+
+    The state is written atomically: it is written to a temporary file which then replaces the
+    state file, so a crash in the middle of a write never leaves an empty or half-written state.
+    As the state is always written after the messages it refers to, a crash can only lose the
+    last changes, never move the state past the messages stored.
+
+    :param path: path of the state file.
+
+    :param checkpoint_messages: max messages stored between two writes of the state.
+
+    :param checkpoint_interval: max seconds between two writes of the state.
+
+    :param fsync: if True, the state is flushed to the disk before replacing the previous one, so
+    it also survives power failures.
+
+    """
+
+    def __init__(self, path, checkpoint_messages=DEFAULT_CHECKPOINT_MESSAGES,
+                 checkpoint_interval=DEFAULT_CHECKPOINT_INTERVAL, fsync=False):
+        self.path = path
+        self.checkpoint_messages = checkpoint_messages
+        self.checkpoint_interval = checkpoint_interval
+        self.fsync = fsync
+        self.dirty = False
+        self._messages = 0
+        self._written_at = time.monotonic()
+
+    def changed(self, messages=1):
+        """
+        Notify a change of the state caused by :param messages new messages.
+
+        Return `True` if a checkpoint is due and the state must be written.
+
+        """
+        self.dirty = True
+        self._messages += messages
+        return (self._messages >= self.checkpoint_messages
+                or time.monotonic() - self._written_at >= self.checkpoint_interval)
+
+    def write(self, state):
+        """
+        Write :param state atomically, replacing the previous one.
+
+        """
+        write_atomically(self.path, json.dumps(state).encode('UTF-8'), fsync=self.fsync)
+        self.dirty = False
+        self._messages = 0
+        self._written_at = time.monotonic()
@@ -0,0 +1,16 @@
+"""
+Writers of mailboxes optimized for the synchronization: they only add messages.
+"""
+from .blobs import BlobStore
+from .compression import Compressor
+from .mbox import AppendOnlyMbox, AppendOnlyMMDF, TruncatedMailboxError
+from .mh import AppendOnlyMH
+from .offsets import OffsetIndex, OffsetRecord
+from .sqlite import SQLiteMailbox
+from .maildir import AppendOnlyMaildir, MessageLinker, ShardedMaildir
+
+
+__all__ = [
+    'AppendOnlyMaildir', 'AppendOnlyMbox', 'AppendOnlyMMDF', 'AppendOnlyMH', 'BlobStore', 'Compressor',
+    'MessageLinker', 'OffsetIndex', 'OffsetRecord', 'ShardedMaildir', 'SQLiteMailbox', 'TruncatedMailboxError'
+]
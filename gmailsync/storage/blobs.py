@@ -0,0 +1,165 @@
+"""
+Content-addressed store of the attachments split out of the messages.
+"""
+from email.parser import BytesHeaderParser
+from email.policy import compat32
+import hashlib
+import os
+import re
+
+from ..utils import write_atomically
+
+
+# Parts smaller than this are kept in the message: 64 KB
+DEFAULT_MIN_SIZE = 65536
+
+# Header added to a message for each part moved to the store: offset where the part was and its hash
+BLOB_HEADER = b'X-Gmailsync-Blob'
+
+# Main content types kept in the message however big they are: text is unique to each message,
+# and the parts of multiparts and attached messages are split on their own
+KEPT_MAINTYPES = ('text', 'multipart', 'message')
+
+# End of the headers of a message or a part
+HEADERS_END = re.compile(rb'\r?\n\r?\n')
+
+
+class BlobStore:
+    """
+    Store of the big MIME parts of the messages (attachments), each one stored once however many
+    messages contain it.
+
+    `split` moves the bodies of the big parts of a message to the store and `rehydrate` puts them
+    back. Parts are stored as they appear in the message (i.e. still encoded), in a file named by
+    the SHA-256 of its content, so the same attachment received in many messages, or stored in
+    several channels, takes the space of one.
+
+    A message split keeps its MIME structure with the bodies of the parts moved out empty, and
+    one `X-Gmailsync-Blob` header per part moved at its beginning, with the offset of the part
+    and its hash. `rehydrate` reproduces the original message byte by byte.
+
+    Parts are never removed from the store.
+
+    :param path: directory of the store. It is created if it does not exist.
+
+    :param min_size: min size of a part to be moved to the store. Text parts are always kept in
+    the message.
+
+    :param fsync: if True, the parts are flushed to the disk before the message that references
+    them is written.
+
+    """
+
+    def __init__(self, path, min_size=DEFAULT_MIN_SIZE, fsync=False):
+        self.path = path
+        self.min_size = min_size
+        self.fsync = fsync
+        os.makedirs(path, exist_ok=True)
+
+    def split(self, message):
+        """
+        Move the big parts of :param message (bytes) to the store and return the message without
+        them.
+
+        """
+        parts = []
+        self._find_parts(message, 0, len(message), parts)
+        if not parts:
+            return message
+
+        eol = b'\r\n' if b'\r\n' in message[:message.find(b'\n') + 1] else b'\n'
+        headers = []
+        pieces = []
+        position = 0
+        removed = 0
+        for start, end in parts:
+            digest = self.put(message[start:end])
+            pieces.append(message[position:start])
+            removed += end - start
+            headers.append(b'%s: %d sha256:%s%s' % (BLOB_HEADER, end - removed, digest.encode('ASCII'), eol))
+            position = end
+        pieces.append(message[position:])
+        return b''.join(headers + pieces)
+
+    def rehydrate(self, message):
+        """
+        Put back in :param message (bytes) the parts moved to the store by `split`.
+
+        """
+        references = []
+        prefix = BLOB_HEADER + b': '
+        while message.startswith(prefix):
+            line_end = message.index(b'\n') + 1
+            offset, digest = message[len(prefix):line_end].split()
+            references.append((int(offset), digest[len(b'sha256:'):].decode('ASCII')))
+            message = message[line_end:]
+
+        pieces = []
+        position = 0
+        for offset, digest in references:
+            pieces.append(message[position:offset])
+            pieces.append(self.get(digest))
+            position = offset
+        pieces.append(message[position:])
+        return b''.join(pieces)
+
+    def put(self, data):
+        """
+        Store :param data, if it is not stored yet, and return its hash.
+
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._blob_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            write_atomically(path, data, fsync=self.fsync)
+        return digest
+
+    def get(self, digest):
+        """
+        Get the content stored with hash :param digest.
+
+        """
+        with open(self._blob_path(digest), 'rb') as f:
+            return f.read()
+
+    def __contains__(self, digest):
+        return os.path.exists(self._blob_path(digest))
+
+    def _find_parts(self, message, start, end, parts):
+        """
+        Add to :param parts the ranges of the bodies of the parts to move to the store found in
+        the entity (message or part) between :param start and :param end of :param message.
+
+        """
+        if message.startswith((b'\r\n', b'\n'), start):
+            # Without headers: text/plain
+            return
+        match = HEADERS_END.search(message, start, end)
+        if match is None:
+            return
+        headers = BytesHeaderParser(policy=compat32).parsebytes(message[start:match.start()])
+        body_start = match.end()
+
+        if headers.get_content_maintype() == 'multipart':
+            boundary = headers.get_boundary()
+            if boundary is None:
+                return
+            # The line break before a delimiter belongs to the delimiter
+            delimiter = re.compile(rb'(?:\r?\n|^)--' + re.escape(boundary.encode('ASCII', 'replace')) +
+                                   rb'(--)?[ \t]*(?:\r?\n|$)', re.MULTILINE)
+            part_start = None
+            for delimiter_match in delimiter.finditer(message, body_start, end):
+                if part_start is not None:
+                    self._find_parts(message, part_start, delimiter_match.start(), parts)
+                if delimiter_match.group(1):
+                    break
+                part_start = delimiter_match.end()
+        elif headers.get_content_type() == 'message/rfc822':
+            self._find_parts(message, body_start, end, parts)
+        elif (headers.get_content_maintype() not in KEPT_MAINTYPES
+                and end - body_start >= self.min_size):
+            parts.append((body_start, end))
+
+    def _blob_path(self, digest):
+        return os.path.join(self.path, digest[:2], digest)
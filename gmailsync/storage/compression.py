@@ -0,0 +1,79 @@
+"""
+Compression of the messages written to the mailboxes.
+"""
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+COMPRESSIONS = ('none', 'gzip', 'zstd')
+
+# Default levels of the command line tools: a good ratio without slowing down the synchronization
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# zlib window bits to write the gzip format
+GZIP_WBITS = 31
+
+
+class Compressor:
+    """
+    Compressor of messages, each one into an independent gzip member or zstd frame.
+
+    Both formats allow to concatenate members or frames: a file made of compressed messages
+    appended one after another is a valid compressed file, which decompresses into the messages
+    concatenated. So a compressed mbox can still be read with `zcat` or `zstdcat`, and each
+    message can be decompressed on its own knowing where its member or frame starts and ends.
+
+    :param compression: `gzip` or `zstd`. zstd requires the `zstandard` package.
+
+    :param dictionary: optional path of a zstd dictionary, e.g. trained with `zstd --train` on
+    messages of the mailbox. Small messages compress much better with it, but the same dictionary
+    is required to decompress them.
+
+    """
+
+    def __init__(self, compression, dictionary=None):
+        if compression not in COMPRESSIONS[1:]:
+            raise ValueError('Unsupported compression: {!r}'.format(compression))
+        if compression == 'zstd' and zstandard is None:
+            raise ImportError('zstd compression requires the zstandard package')
+        self.compression = compression
+
+        self._dictionary = None
+        if dictionary is not None:
+            if compression != 'zstd':
+                raise ValueError('Dictionaries are only supported by zstd compression')
+            with open(dictionary, 'rb') as f:
+                self._dictionary = zstandard.ZstdCompressionDict(f.read())
+
+    def compress(self, data):
+        """
+        Compress :param data into a single member or frame.
+
+        """
+        compressor = self.compressobj()
+        return compressor.compress(data) + compressor.flush()
+
+    def compressobj(self):
+        """
+        Get an object to compress a message by chunks into a single member or frame, with
+        `compress(chunk)` and `flush()` methods like `zlib.compressobj`.
+
+        """
+        if self.compression == 'gzip':
+            return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, GZIP_WBITS)
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL, dict_data=self._dictionary).compressobj()
+
+    def decompress(self, data):
+        """
+        Decompress a single member or frame.
+
+        """
+        if self.compression == 'gzip':
+            return zlib.decompress(data, GZIP_WBITS)
+        # Frames compressed by chunks do not include the size of the content
+        return zstandard.ZstdDecompressor(dict_data=self._dictionary).decompressobj().decompress(data)
@@ -0,0 +1,344 @@
+"""
+Writer of Maildir mailboxes.
+"""
+from mailbox import ExternalClashError
+from collections import OrderedDict
+import errno
+import hashlib
+import logging
+import mailbox
+import os
+import threading
+import time
+
+from ..message import EncodedMessage
+from ..utils import fsync_path
+
+
+log = logging.getLogger('gmailsync')
+
+
+# Max messages in a shard of a ShardedMaildir before rotating to a new one
+DEFAULT_SHARD_SIZE = 100000
+
+# Hex characters of the hash of the Gmail id used as name of the shard: 256 shards
+HASH_SHARD_CHARS = 2
+
+# Messages remembered by a MessageLinker
+DEFAULT_LINKER_ENTRIES = 100000
+
+
+class AppendOnlyMaildir(mailbox.Maildir):
+    """
+    Maildir mailbox that writes new messages without intermediate copies.
+
+    `mailbox.Maildir.add` receives the message already decoded and copies it again to translate
+    its line endings, which is a no-op on POSIX systems. Messages are written as they are instead,
+    and messages still encoded (EncodedMessage) are decoded by chunks straight into the temporary
+    file, so a big message is never held decoded in memory.
+
+    Messages are written in `tmp/` and then moved to `new/` with the same unique names as
+    `mailbox.Maildir`, so the mailbox stays Maildir-compliant and readable by any client.
+
+    :param durability: when the messages are flushed to the disk:
+      - none: never, the operating system decides.
+      - batch: in each call to `flush`. Messages are kept in `tmp/` until then, so clients never
+        see a message that could be lost or truncated by a crash.
+      - message: after adding each message.
+
+    :param compressor: optional Compressor to write each message compressed in its file, as
+    read by e.g. the zlib plugin of Dovecot.
+
+    """
+
+    def __init__(self, dirname, factory=None, create=True, durability='batch', compressor=None):
+        super().__init__(dirname, factory=factory, create=create)
+        self.durability = durability
+        self.compressor = compressor
+        # Temporary files of the messages added but not flushed to the disk yet
+        self._unsynced = []
+
+    def add(self, message, source=None):
+        """
+        Add :param message, as bytes or as an EncodedMessage, and return its key.
+
+        :param source: optional path of a file with the same content that the message would have
+        in this mailbox, e.g. the same message stored in another mailbox. It is hard linked
+        instead of writing the message again. If it cannot be linked, e.g. it is in another file
+        system, the message is written.
+
+        """
+        tmp_file = self._create_tmp()
+        if source is not None:
+            tmp_file.close()
+            if self._link(source, tmp_file.name):
+                return self._added(tmp_file.name)
+            tmp_file = open(tmp_file.name, 'wb')
+
+        try:
+            chunks = message.chunks() if isinstance(message, EncodedMessage) else [message]
+            if self.compressor is not None:
+                compressor = self.compressor.compressobj()
+                for chunk in chunks:
+                    tmp_file.write(compressor.compress(chunk))
+                tmp_file.write(compressor.flush())
+            else:
+                for chunk in chunks:
+                    tmp_file.write(chunk)
+            if self.durability == 'message':
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+        except BaseException:
+            tmp_file.close()
+            os.remove(tmp_file.name)
+            raise
+        tmp_file.close()
+        return self._added(tmp_file.name)
+
+    def message_path(self, key):
+        """
+        Get the path of the file of the message :param key added by this writer, whether it has
+        already been moved to `new/` or not.
+
+        """
+        tmp_path = os.path.join(self._path, 'tmp', key)
+        if os.path.exists(tmp_path):
+            return tmp_path
+        return os.path.join(self._path, 'new', key)
+
+    def flush(self):
+        """
+        Flush the messages added since the last call to the disk and move them to `new/`, if the
+        durability is `batch`.
+
+        """
+        super().flush()
+        if self._unsynced:
+            for tmp_path in self._unsynced:
+                fsync_path(tmp_path)
+            for tmp_path in self._unsynced:
+                self._deliver(tmp_path)
+            fsync_path(os.path.join(self._path, 'new'))
+            self._unsynced = []
+
+    def _link(self, source, tmp_path):
+        """
+        Replace the empty temporary file :param tmp_path with a hard link to :param source.
+        Return whether it has been linked.
+
+        """
+        link_path = tmp_path + '.link'
+        try:
+            os.link(source, link_path)
+        except OSError as e:
+            log.debug('Cannot link %s, writing the message instead: %s', source, e)
+            return False
+        os.replace(link_path, tmp_path)
+        if self.durability == 'message':
+            fsync_path(tmp_path)
+        return True
+
+    def _added(self, tmp_path):
+        """
+        Deliver the message written in :param tmp_path according to the durability and return
+        its key.
+
+        """
+        if self.durability == 'batch':
+            self._unsynced.append(tmp_path)
+        else:
+            self._deliver(tmp_path)
+            if self.durability == 'message':
+                fsync_path(os.path.join(self._path, 'new'))
+        return os.path.basename(tmp_path)
+
+    def _deliver(self, tmp_path):
+        """
+        Move the message written in :param tmp_path to `new/`.
+
+        """
+        dest = os.path.join(self._path, 'new', os.path.basename(tmp_path))
+        # Linked instead of renamed to never overwrite an existing message
+        try:
+            try:
+                os.link(tmp_path, dest)
+            except (AttributeError, PermissionError):
+                os.rename(tmp_path, dest)
+            else:
+                os.remove(tmp_path)
+        except OSError as e:
+            os.remove(tmp_path)
+            if e.errno == errno.EEXIST:
+                raise ExternalClashError('Name clash with existing message: {}'.format(dest))
+            raise
+
+
+class ShardedMaildir:
+    """
+    Maildir mailbox whose messages are spread across Maildir++ sub-folders (shards), so no
+    directory grows to millions of files.
+
+    Each shard is a regular Maildir inside the root one, named as in Maildir++ (`.<name>`), so
+    clients supporting Maildir++ show it as a folder. Messages are assigned to a shard by:
+      - month: the month (UTC) in which the message was received, e.g. `.2024.03`.
+      - hash: the first characters of the hash of its Gmail id, e.g. `.3f`.
+
+    Once a shard holds :param shard_size messages, new messages of that shard go to a new one
+    with a numeric suffix, e.g. `.2024.03-1`.
+
+    Keys are `<shard>/<key in the shard>`, so they stay unique across shards.
+
+    :param dirname: path of the root Maildir.
+
+    :param shards: how messages are assigned to shards: `month` or `hash`.
+
+    :param shard_size: max messages in a shard before rotating to a new one.
+
+    :param durability: see AppendOnlyMaildir.
+
+    :param compressor: see AppendOnlyMaildir.
+
+    """
+
+    def __init__(self, dirname, shards='month', shard_size=DEFAULT_SHARD_SIZE, durability='batch',
+                 compressor=None):
+        self._path = os.path.abspath(dirname)
+        self.shards = shards
+        self.shard_size = shard_size
+        self.durability = durability
+        self.compressor = compressor
+        # Root Maildir, created so the mailbox is valid even before storing any message
+        self._root = AppendOnlyMaildir(dirname, durability=durability)
+        # Writers of the shards opened: name -> AppendOnlyMaildir
+        self._writers = {}
+        # Shard currently written for each shard name without suffix: base -> [name, messages]
+        self._current = {}
+
+    def add(self, message, timestamp=None, msg_id=None, source=None):
+        """
+        Add :param message, as bytes or as an EncodedMessage, and return its key.
+
+        :param timestamp: timestamp of the message (seconds since epoch), to shard by month.
+
+        :param msg_id: Gmail id of the message, to shard by hash. Messages without id are
+        sharded by their timestamp.
+
+        :param source: see AppendOnlyMaildir.add.
+
+        """
+        current = self._current_shard(self._shard_base(timestamp, msg_id))
+        if current[1] >= self.shard_size:
+            current[0] = self._next_shard_name(current[0])
+            current[1] = 0
+
+        key = self._writer(current[0]).add(message, source=source)
+        current[1] += 1
+        return '{}/{}'.format(current[0], key)
+
+    def message_path(self, key):
+        """
+        See AppendOnlyMaildir.message_path.
+
+        """
+        shard, key = key.split('/', 1)
+        return self._writer(shard).message_path(key)
+
+    def flush(self):
+        for writer in self._writers.values():
+            writer.flush()
+
+    def close(self):
+        self.flush()
+
+    def _shard_base(self, timestamp, msg_id):
+        if self.shards == 'hash':
+            value = msg_id if msg_id is not None else str(timestamp)
+            return hashlib.sha1(value.encode('UTF-8')).hexdigest()[:HASH_SHARD_CHARS]
+        return time.strftime('%Y.%m', time.gmtime(timestamp or 0))
+
+    def _current_shard(self, base):
+        """
+        Get the shard where the messages of :param base are being written, looking for the last
+        one rotated in previous executions the first time.
+
+        """
+        if base not in self._current:
+            name = base
+            while os.path.isdir(self._shard_path(self._next_shard_name(name))):
+                name = self._next_shard_name(name)
+            self._current[base] = [name, self._count(name)]
+        return self._current[base]
+
+    def _next_shard_name(self, name):
+        base, sep, rotation = name.rpartition('-')
+        if not sep or not rotation.isdigit():
+            return '{}-1'.format(name)
+        return '{}-{}'.format(base, int(rotation) + 1)
+
+    def _count(self, name):
+        path = self._shard_path(name)
+        if not os.path.isdir(path):
+            return 0
+        return sum(len(os.listdir(os.path.join(path, subdir))) for subdir in ('new', 'cur'))
+
+    def _writer(self, name):
+        if name not in self._writers:
+            path = self._shard_path(name)
+            writer = AppendOnlyMaildir(path, durability=self.durability, compressor=self.compressor)
+            # Maildir++ marker of a folder, as `mailbox.Maildir.add_folder` does
+            with open(os.path.join(path, 'maildirfolder'), 'ab'):
+                pass
+            self._writers[name] = writer
+        return self._writers[name]
+
+    def _shard_path(self, name):
+        return os.path.join(self._path, '.' + name)
+
+
+class MessageLinker:
+    """
+    Registry of the files of the messages stored in Maildir mailboxes, to store a message in
+    several mailboxes with a single copy: the first mailbox writes it and the rest hard link
+    that file.
+
+    Messages are identified by their Gmail id and by a group: only the mailboxes in the same
+    group store a message with the same content (e.g. with the same compression), so only them
+    can share its file.
+
+    Only the last :param max_entries messages are remembered, which is enough to link the
+    messages stored in several mailboxes during the same synchronization.
+
+    It is thread-safe: mailboxes stored from different threads can share the same linker.
+
+    """
+
+    def __init__(self, max_entries=DEFAULT_LINKER_ENTRIES):
+        self.max_entries = max_entries
+        # (msg_id, group) -> (writer, key)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def find(self, msg_id, group=None):
+        """
+        Get the path of a file of the message :param msg_id stored in a mailbox of :param group,
+        or `None` if it is not known.
+
+        """
+        with self._lock:
+            entry = self._entries.get((msg_id, group))
+        if entry is None:
+            return None
+        writer, key = entry
+        return writer.message_path(key)
+
+    def register(self, msg_id, writer, key, group=None):
+        """
+        Register the message :param msg_id stored with :param key by :param writer, an
+        AppendOnlyMaildir or a ShardedMaildir.
+
+        """
+        with self._lock:
+            self._entries[(msg_id, group)] = (writer, key)
+            self._entries.move_to_end((msg_id, group))
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
@@ -0,0 +1,208 @@
+"""
+Append-only writers of single-file mailboxes.
+"""
+import json
+import logging
+import mailbox
+import os
+import time
+
+from ..utils import write_atomically
+
+
+log = logging.getLogger('gmailsync')
+
+
+class TruncatedMailboxError(Exception):
+    """
+    The mailbox file is smaller than when it was last written by gmailsync, so messages already
+    synchronized have been lost.
+
+    """
+
+
+class AppendOnlyMbox:
+    """
+    Writer of mbox files that only appends messages.
+
+    The mailbox classes of the standard library read the whole file to build a table of contents
+    before adding the first message, which takes longer the bigger the archive is. This writer
+    never reads the file: each message is written at its end.
+
+    The file is locked as the standard library does, with `fcntl` and a `.lock` dot lock file,
+    from the first message added until `flush` is called, so other programs do not write to the
+    file meanwhile.
+
+    The size of the file after the last flush is kept in :param offset_path. When the file is
+    opened again, a file smaller than that size means it has been truncated and
+    `TruncatedMailboxError` is raised instead of appending messages to a broken mailbox.
+
+    Messages are written in the same format as `mailbox.mbox` of the standard library. A message
+    that already starts with a `From ` line keeps it as its envelope.
+
+    :param path: path of the mbox file. It is created if it does not exist.
+
+    :param offset_path: path of the file where to keep the end offset of the mailbox.
+
+    :param durability: when the messages are flushed to the disk:
+      - none: never, the operating system decides.
+      - batch: in each call to `flush`.
+      - message: after adding each message.
+
+    :param compressor: optional Compressor. If defined, each message is appended compressed
+    into its own member or frame, so the file is a compressed mbox (e.g. readable with `zcat`)
+    that is still only appended.
+
+    """
+
+    def __init__(self, path, offset_path, durability='batch', compressor=None):
+        self.path = path
+        self.offset_path = offset_path
+        self.durability = durability
+        self.compressor = compressor
+        # Offset and end of the last message added, as the standard library indexes it, or of
+        # the compressed message
+        self.last_span = None
+        self._file = None
+
+    def add(self, message):
+        """
+        Append :param message (bytes) to the mailbox.
+
+        Return its key: the offset of the message in the file. If the mailbox is compressed, the
+        offset of the compressed message.
+
+        """
+        if self._file is None:
+            self._open()
+
+        start = self._file.tell()
+        data = self._format(message)
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+            self.last_span = (start, start + len(data))
+        else:
+            self.last_span = self._span(start, start + len(data))
+        self._file.write(data)
+        if self.durability == 'message':
+            self._sync()
+        return self.last_span[0]
+
+    def flush(self):
+        """
+        Flush the messages added to the file, save its end offset and release the lock.
+
+        """
+        if self._file is None:
+            return
+
+        if self.durability == 'none':
+            self._file.flush()
+        else:
+            self._sync()
+        self._save_offset(self._file.tell())
+        self._unlock()
+        self._file.close()
+        self._file = None
+
+    def close(self):
+        self.flush()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _format(self, message):
+        from_line, message = self._split_from_line(message)
+        if not message.endswith(b'\n'):
+            message += b'\n'
+        return from_line + message + b'\n'
+
+    def _split_from_line(self, message):
+        """
+        Split :param message into its envelope `From ` line and its content, with the lines
+        starting with `From ` escaped, as they would be taken as the beginning of a new message.
+
+        """
+        if message.startswith(b'From '):
+            # Already in mbox format, as `mailbox.mbox` its first line is kept as the envelope
+            from_line, _, message = message.partition(b'\n')
+            from_line = from_line.rstrip(b'\r') + b'\n'
+        else:
+            from_line = self._from_line()
+        if message.startswith(b'From '):
+            message = b'>' + message
+        return from_line, message.replace(b'\nFrom ', b'\n>From ')
+
+    def _span(self, start, end):
+        # Without the empty line that separates it from the next message
+        return start, end - 1
+
+    def _from_line(self):
+        return b'From MAILER-DAEMON ' + time.asctime(time.gmtime()).encode('ASCII') + b'\n'
+
+    def _open(self):
+        self._file = open(self.path, 'ab')
+        try:
+            self._lock()
+        except BaseException:
+            self._file.close()
+            self._file = None
+            raise
+        # Locks held by other programs must not be released if it fails
+        try:
+            # Position of the end of the file, as it may have been appended by others until locked
+            self._file.seek(0, os.SEEK_END)
+            self._check_offset(self._file.tell())
+        except BaseException:
+            self._unlock()
+            self._file.close()
+            self._file = None
+            raise
+
+    def _check_offset(self, size):
+        offset = self._load_offset()
+        if offset is None:
+            return
+        if size < offset:
+            raise TruncatedMailboxError('Mailbox {!r} has been truncated: {} bytes expected, {} found'.format(
+                self.path, offset, size))
+        if size > offset:
+            # Written after the last flush, e.g. by another program or by an interrupted synchronization
+            log.debug('Mailbox %s has grown %s bytes since the last synchronization', self.path, size - offset)
+
+    def _load_offset(self):
+        if not os.path.isfile(self.offset_path):
+            return None
+        with open(self.offset_path, 'r') as f:
+            return json.loads(f.read())['end']
+
+    def _save_offset(self, offset):
+        # Also makes durable the directory entry of a new mailbox, as both are in the same directory
+        write_atomically(self.offset_path, json.dumps({'end': offset}).encode('UTF-8'),
+                         fsync=self.durability != 'none')
+
+    def _lock(self):
+        mailbox._lock_file(self._file)
+
+    def _unlock(self):
+        mailbox._unlock_file(self._file)
+
+
+class AppendOnlyMMDF(AppendOnlyMbox):
+    """
+    Writer of MMDF files that only appends messages. See `AppendOnlyMbox`.
+
+    Messages are written in the same format as `mailbox.MMDF` of the standard library.
+
+    """
+
+    _DELIMITER = b'\x01\x01\x01\x01\n'
+
+    def _format(self, message):
+        from_line, message = self._split_from_line(message)
+        return self._DELIMITER + from_line + message + b'\n' + self._DELIMITER
+
+    def _span(self, start, end):
+        # Without the delimiters and the line break before the last one
+        return start + len(self._DELIMITER), end - len(self._DELIMITER) - 1
@@ -0,0 +1,87 @@
+"""
+Writer of MH mailboxes.
+"""
+import mailbox
+import os
+
+from ..utils import fsync_path
+
+
+class AppendOnlyMH(mailbox.MH):
+    """
+    MH mailbox that allocates the keys of new messages in constant time.
+
+    `mailbox.MH.add` lists the whole folder to find the last key before adding each message, so
+    adding n messages costs O(n²). The next key is cached instead: the folder is only listed once,
+    before adding the first message, or again if another program has taken the cached key.
+
+    The layout of the folder is the same as `mailbox.MH`, so it can still be read by it or by any
+    other MH client.
+
+    :param durability: when the messages are flushed to the disk:
+      - none: never, the operating system decides.
+      - batch: in each call to `flush`, with a single flush of the folder.
+      - message: after adding each message.
+
+    """
+
+    def __init__(self, path, factory=None, create=True, durability='batch'):
+        super().__init__(path, factory=factory, create=create)
+        self.durability = durability
+        self._next_key = None
+        # Messages added but not flushed to the disk yet
+        self._unsynced = []
+
+    def add(self, message):
+        """
+        Add :param message (bytes) and return its key.
+
+        """
+        if self._next_key is None:
+            self._next_key = self._last_key() + 1
+
+        while True:
+            path = os.path.join(self._path, str(self._next_key))
+            try:
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+            except FileExistsError:
+                # Added by another program since the folder was listed
+                self._next_key = self._last_key() + 1
+            else:
+                break
+
+        key = self._next_key
+        self._next_key += 1
+
+        with os.fdopen(fd, 'wb') as f:
+            try:
+                self._dump_message(message, f)
+                if self.durability == 'message':
+                    f.flush()
+                    os.fsync(f.fileno())
+            except BaseException:
+                f.close()
+                os.remove(path)
+                raise
+
+        if self.durability == 'message':
+            fsync_path(self._path)
+        elif self.durability == 'batch':
+            self._unsynced.append(path)
+
+        return key
+
+    def flush(self):
+        """
+        Flush the messages added since the last call to the disk, if the durability is `batch`.
+
+        """
+        super().flush()
+        if self._unsynced:
+            for path in self._unsynced:
+                fsync_path(path)
+            fsync_path(self._path)
+            self._unsynced = []
+
+    def _last_key(self):
+        return max(self.iterkeys(), default=0)
@@ -0,0 +1,139 @@
+"""
+Sidecar index of the offsets of the messages in single-file mailboxes.
+"""
+from collections import namedtuple
+import mmap
+import os
+import struct
+
+from ..utils import fsync_path, write_atomically
+
+
+# Identifies the file and the version of its format
+MAGIC = b'GMSOFF01'
+
+# Max length of a Gmail id: 16 hex digits
+MAX_ID_LENGTH = 16
+
+# Gmail id (ASCII, padded with NUL bytes), offset, length and timestamp of a message, little-endian
+RECORD = struct.Struct('<{}sQQq'.format(MAX_ID_LENGTH))
+
+
+OffsetRecord = namedtuple('OffsetRecord', ['msg_id', 'offset', 'length', 'timestamp'])
+
+
+class OffsetIndex:
+    """
+    Index of the position of each message in a single-file mailbox (mbox, MMDF, Babyl), so a
+    message can be read without parsing the whole file.
+
+    The file is a header (`MAGIC`) followed by fixed-size records (`RECORD`) in the order the
+    messages were added to the mailbox. Record `i` is always at `len(MAGIC) + i * RECORD.size`,
+    so the file can be memory-mapped by any tool and a record is found and checked against the
+    mailbox in constant time. The offset and length of a message are the same that the mailbox
+    classes of the standard library use for it.
+
+    Records are only appended. The index can be rebuilt from scratch with `rewrite`.
+
+    :param path: path of the index file. It is created if it does not exist.
+
+    :param fsync: if True, the records are flushed to the disk on `flush`.
+
+    """
+
+    def __init__(self, path, fsync=False):
+        self.path = path
+        self.fsync = fsync
+        self._file = None
+        self._count = self._load()
+
+    def append(self, msg_id, offset, length, timestamp):
+        """
+        Add the record of the message :param msg_id, :param length bytes long at :param offset of
+        the mailbox. It is written to the file on `flush`.
+
+        """
+        encoded_id = msg_id.encode('ASCII')
+        if len(encoded_id) > MAX_ID_LENGTH:
+            raise ValueError('Message id too long for the offset index: {!r}'.format(msg_id))
+        if self._file is None:
+            self._file = open(self.path, 'ab')
+        self._file.write(RECORD.pack(encoded_id, offset, length, timestamp))
+        self._count += 1
+
+    def flush(self):
+        if self._file is None:
+            return
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        if self._file is not None:
+            self.flush()
+            self._file.close()
+            self._file = None
+
+    def rewrite(self, records):
+        """
+        Replace all the records of the index with :param records, an iterable of OffsetRecord.
+
+        """
+        self.close()
+        data = bytearray(MAGIC)
+        count = 0
+        for record in records:
+            data += RECORD.pack(record.msg_id.encode('ASCII'), record.offset, record.length, record.timestamp)
+            count += 1
+        write_atomically(self.path, bytes(data), fsync=self.fsync)
+        self._count = count
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError('Offset index out of range')
+        # Records still buffered must be in the file to be mapped
+        if self._file is not None:
+            self._file.flush()
+        with open(self.path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            return self._unpack(m, i)
+
+    def __iter__(self):
+        if self._count == 0:
+            return
+        if self._file is not None:
+            self._file.flush()
+        with open(self.path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            for i in range(self._count):
+                yield self._unpack(m, i)
+
+    def _unpack(self, buffer, i):
+        msg_id, offset, length, timestamp = RECORD.unpack_from(buffer, len(MAGIC) + i * RECORD.size)
+        return OffsetRecord(msg_id.rstrip(b'\0').decode('ASCII'), offset, length, timestamp)
+
+    def _load(self):
+        """
+        Create the index file if it does not exist and return the number of records.
+
+        """
+        if not os.path.isfile(self.path):
+            with open(self.path, 'wb') as f:
+                f.write(MAGIC)
+            if self.fsync:
+                fsync_path(self.path)
+            return 0
+
+        with open(self.path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError('{!r} is not an offset index'.format(self.path))
+
+        size = os.path.getsize(self.path) - len(MAGIC)
+        if size % RECORD.size:
+            # Half-written record left by an interrupted write
+            with open(self.path, 'r+b') as f:
+                f.truncate(len(MAGIC) + size - size % RECORD.size)
+        return size // RECORD.size
@@ -0,0 +1,153 @@
+"""
+Writer of mailboxes stored in a SQLite database.
+"""
+from email.parser import BytesParser
+from email.policy import default as default_policy
+import logging
+import sqlite3
+import zlib
+
+from ..message import EncodedMessage
+
+
+log = logging.getLogger('gmailsync')
+
+
+# zlib compression level of the messages, as in the cache
+COMPRESSION_LEVEL = 6
+
+
+class SQLiteMailbox:
+    """
+    Mailbox stored in a single SQLite database, one row per message.
+
+    Each row keeps the raw RFC 2822 message, optionally compressed with zlib, and the headers
+    most used to look messages up (Message-ID, Date, From, To, Subject) already decoded, so
+    millions of messages can be stored and queried without parsing them again.
+
+    The database is in WAL mode and the messages added are not committed until `flush` is
+    called, so each fetched batch is written in a single transaction.
+
+    Optionally, the subject, the sender and the text of the body of the messages are indexed
+    with FTS5 to search the mailbox with `search`. The full text index is contentless: it does
+    not store a second copy of the messages.
+
+    :param path: path of the database. It is created if it does not exist.
+
+    :param compress: if True, the messages are stored compressed.
+
+    :param full_text: if True, the messages are indexed to be searched with `search`. It is
+    ignored, with a warning, if SQLite was built without FTS5.
+
+    :param durability: when the messages are flushed to the disk:
+      - none: never, the operating system decides.
+      - batch: in each call to `flush`.
+      - message: after adding each message.
+
+    """
+
+    def __init__(self, path, compress=False, full_text=False, durability='batch'):
+        self.path = path
+        self.compress = compress
+        self.durability = durability
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous={}'.format('NORMAL' if durability == 'none' else 'FULL'))
+        self._connection.execute('CREATE TABLE IF NOT EXISTS messages ('
+                                 'key INTEGER PRIMARY KEY, msg_id TEXT, timestamp INTEGER, message_id TEXT, '
+                                 'date TEXT, sender TEXT, recipients TEXT, subject TEXT, size INTEGER, '
+                                 'compressed INTEGER, raw BLOB)')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS messages_msg_id ON messages (msg_id)')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS messages_timestamp ON messages (timestamp)')
+        self.full_text = full_text and self._create_full_text_index()
+        self._connection.commit()
+
+    def add(self, message, timestamp=None, msg_id=None):
+        """
+        Add :param message, as bytes or as an EncodedMessage, and return its key.
+
+        :param timestamp: timestamp of the message (seconds since epoch).
+
+        :param msg_id: Gmail id of the message.
+
+        """
+        if isinstance(message, EncodedMessage):
+            message = message.decode()
+
+        parsed = BytesParser(policy=default_policy).parsebytes(message, headersonly=not self.full_text)
+        raw = zlib.compress(message, COMPRESSION_LEVEL) if self.compress else message
+        cursor = self._connection.execute(
+            'INSERT INTO messages (msg_id, timestamp, message_id, date, sender, recipients, subject, size, '
+            'compressed, raw) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (msg_id, timestamp, self._header(parsed, 'Message-ID'), self._header(parsed, 'Date'),
+             self._header(parsed, 'From'), self._header(parsed, 'To'), self._header(parsed, 'Subject'),
+             len(message), int(self.compress), raw))
+        key = cursor.lastrowid
+
+        if self.full_text:
+            self._connection.execute('INSERT INTO messages_fts (rowid, subject, sender, body) VALUES (?, ?, ?, ?)',
+                                     (key, self._header(parsed, 'Subject'), self._header(parsed, 'From'),
+                                      self._body(parsed)))
+
+        if self.durability == 'message':
+            self._connection.commit()
+        return key
+
+    def get_bytes(self, key):
+        """
+        Get the raw message :param key.
+
+        """
+        row = self._connection.execute('SELECT compressed, raw FROM messages WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            raise KeyError('No message with key: {}'.format(key))
+        compressed, raw = row
+        return zlib.decompress(raw) if compressed else bytes(raw)
+
+    def search(self, query):
+        """
+        Get the keys of the messages matching the FTS5 :param query, best matches first.
+
+        """
+        if not self.full_text:
+            raise ValueError('Mailbox {!r} has no full text index'.format(self.path))
+        rows = self._connection.execute('SELECT rowid FROM messages_fts WHERE messages_fts MATCH ? ORDER BY rank',
+                                        (query,))
+        return [key for key, in rows]
+
+    def flush(self):
+        self._connection.commit()
+
+    def close(self):
+        self._connection.commit()
+        self._connection.close()
+
+    def __len__(self):
+        return self._connection.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+
+    def _create_full_text_index(self):
+        try:
+            self._connection.execute('CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts '
+                                     "USING fts5(subject, sender, body, content='')")
+        except sqlite3.OperationalError:
+            log.warning('SQLite was built without FTS5. Messages of %s will not be indexed for search', self.path,
+                        exc_info=True)
+            return False
+        return True
+
+    def _header(self, parsed, name):
+        try:
+            value = parsed[name]
+        except (ValueError, IndexError):
+            # Malformed header the parser cannot decode
+            log.debug('Malformed header %s', name, exc_info=True)
+            return None
+        return str(value) if value is not None else None
+
+    def _body(self, parsed):
+        try:
+            body = parsed.get_body(preferencelist=('plain', 'html'))
+            return body.get_content() if body is not None else ''
+        except (LookupError, ValueError, AttributeError):
+            log.debug('Body of the message cannot be decoded', exc_info=True)
+            return ''
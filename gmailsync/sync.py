@@ -1,8 +1,18 @@
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import calendar
+import contextlib
+import datetime
+import heapq
+import itertools
 import logging
 import secrets
+import threading
 import time
 
-from .utils import chunked
+from .client import HistoryExpired
+from .pipeline import Pipeline
+from .utils import chunked, merge, prefetch
 
 
 log = logging.getLogger('gmailsync')
@@ -10,57 +20,744 @@ log = logging.getLogger('gmailsync')
 
 # Sending batches larger than 50 requests is not recommended.
 # https://developers.google.com/gmail/api/v1/reference/quota
-# however, quota limits translate to about max 12 messages.get()
-# requests per second, so we play safe with 10.
+# The rate of requests is controlled by the rate limiter of the client, but each request of a
+# batch is processed concurrently by Gmail, so big batches hit the concurrency limit of the API.
 # https://developers.google.com/workspace/gmail/api/reference/quota
-CHUNK_SIZE = 10
+CHUNK_SIZE = 25
+
+# Max number of message descriptors listed in advance while the previous ones are being fetched.
+# It matches the size of two pages of `users.messages.list`.
+LIST_PREFETCH_SIZE = 1000
+
+# Windows of a backfill listed at the same time. Each one is listed by its own thread, while
+# their messages are fetched by the same workers
+BACKFILL_LISTERS = 4
+
+# Year of the oldest window of a backfill. The window also includes all the messages before it.
+# Gmail was launched in 2004
+BACKFILL_START_YEAR = 2004
+
+# Max bytes of fetched messages waiting to be decoded and stored
+DEFAULT_MAX_INFLIGHT_BYTES = 67108864  # 64 MB
+
+# Marker sent through the pipeline after the messages of each fetched batch
+BATCH_END = object()
+
+# Big messages fetched concurrently, each one on its own, besides the batches of the workers
+LARGE_MESSAGE_WORKERS = 1
+
+# Max big messages waiting to be fetched. Once reached, no more messages are taken until one of
+# them is fetched
+MAX_PENDING_LARGE_MESSAGES = 100
+
+# Max attempts to fetch a message before giving up
+MAX_ATTEMPTS = 5
+
+# Max delay (in seconds) before retrying to fetch a message that failed
+MAX_RETRY_DELAY = 64
+
+
+def backfill_bounds(backfill, now):
+    """
+    Get the bounds (after, before) of the windows in which a backfill splits the history of a
+    channel, newest first.
+
+    :param backfill: `year` or `month`: one window per year or per month (UTC).
+
+    :param now: current timestamp (seconds since epoch).
+
+    """
+    current = datetime.datetime.fromtimestamp(now, datetime.timezone.utc)
+    months = 12 if backfill == 'year' else 1
+    # Start of each window, from the second oldest one to the newest one
+    starts = []
+    year, month = BACKFILL_START_YEAR, 1
+    while True:
+        month += months
+        if month > 12:
+            year, month = year + (month - 1) // 12, (month - 1) % 12 + 1
+        if (year, month) > (current.year, current.month):
+            break
+        starts.append(calendar.timegm((year, month, 1, 0, 0, 0)))
+
+    # Windows include their upper bound but not their lower bound
+    afters = [None] + [start - 1 for start in starts]
+    befores = [start - 1 for start in starts] + [None]
+    return list(reversed(list(zip(afters, befores))))
 
 
 class Synchronizer:
+    """
+    Synchronize the messages of the channels with their mailboxes.
+
+    :param client: Client of the Gmail API.
+
+    :param channels: list of Channel objects to synchronize.
+
+    :param workers: number of batches of messages fetched concurrently. Messages are always
+    stored by a single thread in the same order the batches were sent.
 
-    def __init__(self, client, channels):
+    :param max_inflight_bytes: max bytes of fetched messages waiting to be decoded and stored.
+    Fetching is paused when the limit is reached.
+
+    :param routing: how the messages are routed to the channels. With `channel` each channel
+    fetches its own messages. With `shared` the messages of all the channels are listed first and
+    each message is fetched once and stored in every channel that matches it.
+
+    :param batch_max_bytes: optional max estimated bytes of the messages fetched in a batch. If
+    it is defined, the size of the messages is requested before fetching them, and the batches
+    are packed so that their messages add up to at most that size. Otherwise, batches are only
+    limited by their number of messages.
+
+    :param large_message_size: optional estimated size from which a message is big. If it is
+    defined, the size of the messages is requested before fetching them, and the big ones are
+    fetched on their own by a dedicated worker, so they do not delay the batches of small
+    messages.
+
+    """
+
+    def __init__(self, client, channels, workers=1, max_inflight_bytes=DEFAULT_MAX_INFLIGHT_BYTES,
+                 routing='channel', batch_max_bytes=None, large_message_size=None):
         self.client = client
         self.channels = channels
+        self.workers = workers
+        self.max_inflight_bytes = max_inflight_bytes
+        self.routing = routing
+        self.batch_max_bytes = batch_max_bytes
+        self.large_message_size = large_message_size
+        self._executor = None
+        self._large_executor = None
 
     def sync(self):
-        # TODO: optimize routing for messages tagged with multiple labels
-        for channel in self.channels:
-            self.sync_channel(channel)
+        # Workers are reused by all channels to reuse their HTTP connections
+        with self._fetchers():
+            try:
+                if self.routing == 'shared':
+                    self.sync_shared()
+                else:
+                    for channel in self.channels:
+                        self.sync_channel(channel)
+            finally:
+                # Keep the progress of the messages already stored if the synchronization fails
+                for channel in self.channels:
+                    channel.mailbox.flush()
+                    channel.mailbox.close()
+
+    @contextlib.contextmanager
+    def _fetchers(self):
+        """
+        Start the workers that fetch the messages, unless they are already running, e.g. when
+        `sync_channel` or `sync_shared` are called by `sync`, and stop them on exit.
+
+        """
+        if self._executor is not None:
+            yield
+            return
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='gmailsync-fetcher') as executor, \
+                ThreadPoolExecutor(max_workers=LARGE_MESSAGE_WORKERS,
+                                   thread_name_prefix='gmailsync-large-fetcher') as large_executor:
+            self._executor = executor
+            self._large_executor = large_executor
+            try:
+                yield
+            finally:
+                self._executor = None
+                self._large_executor = None
 
     def sync_channel(self, channel):
-        last_timestamp = channel.mailbox.get_last_timestamp()
+        """
+        Synchronize the messages of :param channel on its own.
+
+        """
+        with self._fetchers():
+            self._sync_channel(channel)
+
+    def _sync_channel(self, channel):
+        total = self._resume_windows(channel)
+
+        # Mailboxes synchronized before enabling the backfill are not backfilled
+        if (channel.backfill != 'none' and not channel.mailbox.is_backfilled()
+                and channel.mailbox.get_last_timestamp() is None):
+            windows, history_id = self._open_backfill_windows(channel)
+            total += self._sync_windows(channel, windows)
+        else:
+            window, msg_ids, history_id = self._open_window(channel)
+            if window is not None:
+                total += self._sync_window(channel, window, msg_ids=msg_ids)
+        if history_id is not None:
+            channel.mailbox.set_history_id(history_id)
+
+        log.info('Channel [%s] - %s new messages synchronized', channel.name, total)
+
+    def sync_shared(self):
+        """
+        Synchronize all the channels fetching each message only once.
+
+        The messages of every channel are listed before fetching any of them, so the messages
+        matched by several channels are known in advance and stored in all of them.
+
+        """
+        with self._fetchers():
+            self._sync_shared()
+
+    def _sync_shared(self):
+        totals = {channel.name: self._resume_windows(channel) for channel in self.channels}
+
+        routes = OrderedDict()
+        opened = []
+        total_listed = 0
+        for channel in self.channels:
+            window, msg_ids, history_id = self._open_window(channel)
+            progress = None
+            if window is not None:
+                progress = WindowProgress(channel.mailbox, window)
+                # Listed in the order of the channel, which is the order its window is shrunk
+                for msg_desc in self._list(channel, window, msg_ids):
+                    progress.listed(msg_desc['id'])
+                    total_listed += 1
+                    routes.setdefault(msg_desc['id'], (msg_desc, []))[1].append((channel, progress))
+            opened.append((channel, progress, history_id))
+
+        log.debug('%s messages listed, %s unique', total_listed, len(routes))
+
+        msg_descs = (msg_desc for msg_desc, _ in routes.values())
+        self._fetch(msg_descs, lambda msg_id: routes[msg_id][1], name='shared')
+
+        for channel, progress, history_id in opened:
+            if progress is not None:
+                channel.mailbox.close_window(progress.window)
+                totals[channel.name] += progress.total
+            if history_id is not None:
+                channel.mailbox.set_history_id(history_id)
+
+        for channel in self.channels:
+            log.info('Channel [%s] - %s new messages synchronized', channel.name, totals[channel.name])
+
+    def _resume_windows(self, channel):
+        """
+        Synchronize the windows of the channel interrupted in previous synchronizations.
+
+        """
+        windows = channel.mailbox.get_pending_windows()
+        if channel.backfill != 'none' and len(windows) > 1:
+            log.debug('Channel [%s] - Resuming interrupted backfill: %s windows', channel.name, len(windows))
+            return self._sync_windows(channel, windows)
+
+        total = 0
+        for window in windows:
+            log.debug('Channel [%s] - Resuming interrupted synchronization: %s', channel.name, window)
+            total += self._sync_window(channel, window)
+        return total
+
+    def _open_backfill_windows(self, channel):
+        """
+        Open the windows in which the backfill of the channel splits its history, newest first.
+
+        Return a tuple with the windows and the history id to save once they have been
+        synchronized.
+
+        """
+        history_id = None
+        if channel.sync_mode == 'history':
+            # Taken before listing, so messages added meanwhile will be in the next history
+            history_id = self.client.profile()['historyId']
+
+        bounds = backfill_bounds(channel.backfill, time.time())
+        log.debug('Channel [%s] - Backfilling %s windows', channel.name, len(bounds))
+        return channel.mailbox.open_windows(bounds), history_id
+
+    def _open_window(self, channel):
+        """
+        Open the window with the new messages of the channel.
+
+        Return a tuple with the window, the optional set of ids of the messages to fetch from it,
+        and the history id to save once the window has been synchronized. The window is `None` if
+        there are no new messages.
+
+        """
+        if channel.sync_mode == 'history' and channel.mailbox.get_history_id() is not None:
+            # The history only tells which messages have been added, not whether they match the
+            # query of the channel, so if there are new messages the query is listed again and
+            # filtered by them. Quiet mailboxes cost just one call to the API.
+            log.debug('Channel [%s] - Getting history of changes', channel.name)
+            try:
+                msg_ids, history_id = self.client.history(channel.mailbox.get_history_id())
+            except HistoryExpired:
+                log.info('Channel [%s] - History expired, falling back to a query', channel.name)
+            else:
+                if not msg_ids:
+                    return None, None, history_id
+                log.debug('Channel [%s] - %s messages added to the mailbox', channel.name, len(msg_ids))
+                return channel.mailbox.open_window(channel.mailbox.get_last_timestamp()), msg_ids, history_id
+
+        history_id = None
+        if channel.sync_mode == 'history':
+            # Taken before listing, so messages added meanwhile will be in the next history
+            history_id = self.client.profile()['historyId']
 
         log.debug('Channel [%s] - Getting new messages', channel.name)
-        msg_descs = self.client.list(query=channel.query, since=last_timestamp)
-        msg_descs.reverse()  # ASC order, oldest first
+        return channel.mailbox.open_window(channel.mailbox.get_last_timestamp()), None, history_id
+
+    def _list(self, channel, window, msg_ids=None):
+        """
+        List the messages of the channel in :param window, newest first.
+
+        Messages already stored in the mailbox of the channel are not listed, e.g. the ones
+        received in the same second as the last synchronized message, or the ones stored before
+        an interrupted synchronization.
+
+        :param msg_ids: optional set of message ids. If defined, only the messages with these ids
+        will be listed.
+
+        """
+        # `before:` is exclusive but the upper bound of the window is inclusive
+        until = window.before + 1 if window.before is not None else None
+        msg_descs = self.client.list(query=channel.query, since=window.after, until=until)
+        if msg_ids is not None:
+            msg_descs = (msg_desc for msg_desc in msg_descs if msg_desc['id'] in msg_ids)
+        return (msg_desc for msg_desc in msg_descs if not channel.mailbox.contains(msg_desc['id']))
+
+    def _sync_window(self, channel, window, msg_ids=None):
+        """
+        Fetch and store the messages of a window of time of the channel.
+
+        Messages are listed in background, newest first, while the pages already listed are
+        fetched, and the window is shrunk as the messages are stored.
+
+        :param msg_ids: optional set of message ids. If defined, only the listed messages with
+        these ids will be fetched.
+
+        """
+        msg_descs = prefetch(self._list(channel, window, msg_ids), LIST_PREFETCH_SIZE)
+        progress = WindowProgress(channel.mailbox, window)
+        routes = [(channel, progress)]
+        self._fetch(msg_descs, lambda msg_id: routes, on_listed=progress.listed, name=channel.name)
+
+        channel.mailbox.close_window(window)
+        return progress.total
+
+    def _sync_windows(self, channel, windows):
+        """
+        Fetch and store the messages of several windows of time of the channel.
+
+        Up to `BACKFILL_LISTERS` windows are listed in parallel, and their messages are fetched
+        and stored together as they are listed. Each window is shrunk on its own as its messages
+        are stored, and closed once all the windows have been synchronized.
+
+        """
+        progresses = [WindowProgress(channel.mailbox, window) for window in windows]
+        # Window of each message listed and not routed yet
+        listed = {}
+
+        # A message received in the second on the bound of two neighbouring windows may be listed
+        # by both of them. The ids listed by each window are kept until its neighbours have been
+        # listed too
+        order = sorted(range(len(windows)), key=lambda i: windows[i].after or 0)
+        neighbours = [[] for _ in windows]
+        for i, j in zip(order, order[1:]):
+            neighbours[i].append(j)
+            neighbours[j].append(i)
+        window_ids = [set() for _ in windows]
+        finished = set()
+
+        def list_window(window):
+            yield from self._list(channel, window)
+            # End of the window
+            yield None
+
+        def list_windows():
+            lists = [list_window(window) for window in windows]
+            for i, msg_desc in merge(lists, LIST_PREFETCH_SIZE, BACKFILL_LISTERS):
+                if msg_desc is None:
+                    finished.add(i)
+                    for j in [i] + neighbours[i]:
+                        if finished.issuperset(neighbours[j]):
+                            window_ids[j] = set()
+                    continue
+                msg_id = msg_desc['id']
+                if any(msg_id in window_ids[j] for j in [i] + neighbours[i]):
+                    log.debug('Message %s listed by several windows', msg_id)
+                    continue
+                if not finished.issuperset(neighbours[i]):
+                    window_ids[i].add(msg_id)
+                listed[msg_id] = progresses[i]
+                yield msg_desc
+
+        def on_listed(msg_id):
+            listed[msg_id].listed(msg_id)
+
+        def routes(msg_id):
+            # Each message is routed once: by the format stage if it has been fetched, or by the
+            # store stage if it has been skipped. A message dispatched again is not stored twice
+            progress = listed.pop(msg_id, None)
+            return [(channel, progress)] if progress is not None else []
 
-        log.debug('Channel [%s] - Fetching %s new messages', channel.name, len(msg_descs))
+        self._fetch(list_windows(), routes, on_listed=on_listed, name=channel.name)
 
-        time.sleep(1)  # avoid rate limit
+        for window in windows:
+            channel.mailbox.close_window(window)
+        return sum(progress.total for progress in progresses)
 
+    def _fetch(self, msg_descs, routes, on_listed=None, name=None):
+        """
+        Fetch the messages of :param msg_descs and store them in their channels.
+
+        :param routes: function that returns the list of tuples (channel, WindowProgress) where
+        the message with the given id must be stored.
+
+        :param on_listed: optional function called with the id of each message taken from
+        :param msg_descs, before fetching it.
+
+        :param name: name used in the logs.
+
+        """
+        if self.batch_max_bytes is not None or self.large_message_size is not None:
+            # Sizes are requested in background while the previous batches are fetched
+            msg_descs = prefetch(self._estimate_sizes(msg_descs), LIST_PREFETCH_SIZE)
+        queue = FetchQueue(msg_descs, on_listed, large_size=self.large_message_size)
+        in_flight = deque()
+        large_in_flight = []
         total = 0
 
-        for chunk in chunked(msg_descs, CHUNK_SIZE):
-            # Retry loop for 429 'Too Many Requests'
-            retries = 0
-            max_retries = 5
-            while retries < max_retries:
-                try:
+        # Decoding and writing to disk overlap with the fetching of the next messages
+        stages = [self._format_stage(routes), self._store_stage(routes)]
+        with Pipeline(stages, self.max_inflight_bytes, name='gmailsync-{}'.format(name)) as pipeline:
+            while True:
+                # Keep all the workers busy
+                while len(in_flight) < self.workers:
+                    chunk = queue.next_chunk(CHUNK_SIZE, max_bytes=self.batch_max_bytes)
+                    if not chunk:
+                        break
                     log.debug('Fetching %s messages', len(chunk))
-                    messages = self.client.fetch(chunk)
-                    for message in messages:
-                        channel.mailbox.add(message)
-                        total += 1
+                    in_flight.append((chunk, self._executor.submit(self.client.fetch, chunk)))
+
+                while len(large_in_flight) < LARGE_MESSAGE_WORKERS:
+                    msg_desc = queue.next_large()
+                    if msg_desc is None:
+                        break
+                    log.debug('Fetching big message %s (%s bytes)', msg_desc['id'], msg_desc['sizeEstimate'])
+                    large_in_flight.append(((msg_desc,), self._large_executor.submit(self.client.fetch_one, msg_desc)))
+
+                if in_flight or large_in_flight:
+                    # Results of the batches are stored in the same order the batches were sent,
+                    # while big messages are stored as soon as they are fetched
+                    futures = [future for _, future in large_in_flight]
+                    if in_flight:
+                        futures.append(in_flight[0][1])
+                    wait(futures, return_when=FIRST_COMPLETED)
+
+                    for chunk, future in [entry for entry in large_in_flight if entry[1].done()]:
+                        large_in_flight.remove((chunk, future))
+                        total += self._dispatch(name, chunk, future, queue, pipeline)
+                    if in_flight and in_flight[0][1].done():
+                        chunk, future = in_flight.popleft()
+                        total += self._dispatch(name, chunk, future, queue, pipeline)
+                    log.debug('Channel [%s] - %s new messages fetched', name, total)
+                elif queue.done():
                     break
-                except Exception:
-                    retries += 1
-                    # Exponential Backoff with Jitter
-                    delay = (2**retries) + secrets.SystemRandom().uniform(0, 1)
-                    log.warning(f'Rate limit exceeded. Retrying in {delay:.2f} seconds... ({retries}/{max_retries})')
-                    time.sleep(delay)
-            # Throttle between chunks to maintain a safe per-second quota
-            time.sleep(1)
+                else:
+                    queue.wait()
 
-            log.debug('Channel [%s] - %s new messages stored', channel.name, total)
+    def _estimate_sizes(self, msg_descs):
+        """
+        Iterate over :param msg_descs with the estimated size of their messages.
 
-        log.info('Channel [%s] - %s new messages synchronized', channel.name, total)
+        """
+        for chunk in chunked(msg_descs, CHUNK_SIZE):
+            try:
+                self.client.estimate_sizes(chunk)
+            except Exception:
+                # Messages without size are packed as if they were empty, as without a byte budget
+                log.warning('Error getting the size of %s messages', len(chunk), exc_info=True)
+            yield from chunk
+
+    def _dispatch(self, name, chunk, future, queue, pipeline):
+        """
+        Send the messages fetched by :param future to be stored and schedule the retry of the
+        failed ones.
+
+        Return the number of messages fetched.
+
+        """
+        try:
+            messages, failed = future.result()
+        except Exception:
+            # The limiter of the client has already been notified if it was caused by the rate limit
+            log.warning('Error fetching %s messages', len(chunk), exc_info=True)
+            messages, failed = [], chunk
+
+        # Store the messages already fetched even if others of the same chunk failed
+        for message in messages:
+            # Cached messages are already decoded
+            size = len(message['raw']) if 'raw' in message else len(message['decoded'])
+            pipeline.put((message['id'], message), size=size)
+
+        # Skipped messages go through the pipeline too, so the progress is only updated by the
+        # thread that stores the messages
+        for msg_desc in failed:
+            if not queue.retry(msg_desc):
+                log.error('Channel [%s] - Giving up fetching message %s after %s attempts',
+                          name, msg_desc['id'], MAX_ATTEMPTS)
+                pipeline.put((msg_desc['id'], None))
+
+        # Messages neither fetched nor failed no longer exist
+        done_ids = {message['id'] for message in messages} | {msg_desc['id'] for msg_desc in failed}
+        for msg_desc in chunk:
+            if msg_desc['id'] not in done_ids:
+                pipeline.put((msg_desc['id'], None))
+
+        # The state of the mailboxes is written once the whole batch has been stored
+        pipeline.put(BATCH_END)
+
+        return len(messages)
+
+    def _format_stage(self, routes):
+        def format(item):
+            if item is BATCH_END:
+                return item
+            msg_id, message = item
+            if message is None:
+                return item
+            # The same message is formatted once per channel as each mailbox has its own format
+            return msg_id, [(progress, channel.mailbox.format(message)) for channel, progress in routes(msg_id)]
+        return format
+
+    def _store_stage(self, routes):
+        # Mailboxes modified since the end of the last batch
+        modified = set()
+
+        def store(item):
+            if item is BATCH_END:
+                while modified:
+                    modified.pop().flush()
+                return
+
+            msg_id, formatted = item
+            if formatted is None:
+                for _, progress in routes(msg_id):
+                    progress.skipped(msg_id)
+                    modified.add(progress.mailbox)
+            else:
+                for progress, message in formatted:
+                    progress.stored(msg_id, progress.mailbox.store(message, msg_id=msg_id))
+                    modified.add(progress.mailbox)
+        return store
+
+
+class FetchQueue:
+    """
+    Messages waiting to be fetched: the new ones, in listing order, and the ones that failed and
+    are waiting for their backoff to be retried.
+
+    :param msg_descs: iterable of descriptors of the new messages.
+
+    :param on_listed: optional function called with the id of each new message taken from the queue.
+
+    :param large_size: optional `sizeEstimate` from which a message is big. Big messages are not
+    returned in chunks, but one by one by `next_large`.
+
+    """
+
+    def __init__(self, msg_descs, on_listed=None, large_size=None):
+        self.on_listed = on_listed
+        self.large_size = large_size
+        self._msg_descs = iter(msg_descs)
+        self._exhausted = False
+        self._retries = RetryQueue()
+        # Message taken that did not fit in the previous chunk
+        self._held = None
+        # Big messages taken, waiting to be fetched on their own
+        self._large = deque()
+
+    def next_chunk(self, size, max_bytes=None):
+        """
+        Get up to :param size messages to fetch.
+
+        Messages whose retry is due are taken first, and the chunk is filled with new messages.
+        It may return an empty chunk if the rest of messages are waiting for their backoff.
+
+        :param max_bytes: optional max bytes of the messages of the chunk, according to the
+        `sizeEstimate` of their descriptors. Messages without it count as empty. A message
+        bigger than :param max_bytes is fetched alone.
+
+        Big messages found are set aside for `next_large`, and no more messages are taken while
+        `MAX_PENDING_LARGE_MESSAGES` of them are waiting.
+
+        """
+        chunk = []
+        chunk_bytes = 0
+        while len(chunk) < size and len(self._large) < MAX_PENDING_LARGE_MESSAGES:
+            msg_desc = self._next()
+            if msg_desc is None:
+                break
+            msg_size = msg_desc.get('sizeEstimate', 0)
+            if self.large_size is not None and msg_size >= self.large_size:
+                self._large.append(msg_desc)
+                continue
+            if max_bytes is not None and chunk and chunk_bytes + msg_size > max_bytes:
+                self._held = msg_desc
+                break
+            chunk.append(msg_desc)
+            chunk_bytes += msg_size
+        return tuple(chunk)
+
+    def retry(self, msg_desc):
+        """
+        Schedule a retry of :param msg_desc. Return `False` if it has exhausted its attempts.
+
+        """
+        return self._retries.push(msg_desc)
+
+    def wait(self):
+        """
+        Block until the backoff of the next message to retry expires.
+
+        """
+        self._retries.wait()
+
+    def next_large(self):
+        """
+        Get the next big message to fetch, or `None` if there are none right now. Big messages
+        are set aside as they are found while taking the chunks.
+
+        """
+        return self._large.popleft() if self._large else None
+
+    def done(self):
+        return self._exhausted and not self._retries and self._held is None and not self._large
+
+    def _next(self):
+        """
+        Get the next message to fetch, or `None` if there are none right now.
+
+        """
+        if self._held is not None:
+            msg_desc, self._held = self._held, None
+            return msg_desc
+        due = self._retries.pop_due(1)
+        if due:
+            return due[0]
+        if self._exhausted:
+            return None
+        msg_desc = next(self._msg_descs, None)
+        if msg_desc is None:
+            self._exhausted = True
+        elif self.on_listed is not None:
+            self.on_listed(msg_desc['id'])
+        return msg_desc
+
+
+class WindowProgress:
+    """
+    Progress of the synchronization of a window.
+
+    Messages can be stored out of the order in which they were listed, e.g. when some of them
+    have to be retried, so the upper bound of the window is only moved past a message once it
+    and all the messages listed before it have been stored or skipped.
+
+    :param mailbox: Mailbox where the messages are stored.
+
+    :param window: SyncWindow being synchronized.
+
+    """
+
+    _PENDING = object()
+    _SKIPPED = object()
+
+    def __init__(self, mailbox, window):
+        self.mailbox = mailbox
+        self.window = window
+        # Number of messages stored
+        self.total = 0
+        # Messages in listing order not committed yet: id -> timestamp, _PENDING or _SKIPPED
+        self._messages = OrderedDict()
+        # Messages are listed and stored by different threads
+        self._lock = threading.Lock()
+
+    def listed(self, msg_id):
+        with self._lock:
+            self._messages[msg_id] = self._PENDING
+
+    def stored(self, msg_id, timestamp):
+        with self._lock:
+            self._messages[msg_id] = timestamp
+            self.total += 1
+        self._advance()
+
+    def skipped(self, msg_id):
+        with self._lock:
+            self._messages[msg_id] = self._SKIPPED
+        self._advance()
+
+    def _advance(self):
+        timestamp = None
+        with self._lock:
+            while self._messages:
+                value = next(iter(self._messages.values()))
+                if value is self._PENDING:
+                    break
+                self._messages.popitem(last=False)
+                if value is not self._SKIPPED:
+                    timestamp = value if timestamp is None else min(timestamp, value)
+
+        if timestamp is not None:
+            self.mailbox.advance_window(self.window, timestamp)
+
+
+class RetryQueue:
+    """
+    Messages that failed to be fetched, each one waiting for its own exponential backoff
+    before being retried.
+
+    :param max_attempts: max attempts to fetch a message, including the first one.
+
+    """
+
+    def __init__(self, max_attempts=MAX_ATTEMPTS):
+        self.max_attempts = max_attempts
+        self._attempts = {}
+        self._queue = []
+        self._counter = itertools.count()
+
+    def push(self, msg_desc):
+        """
+        Schedule a retry of :param msg_desc.
+
+        Return `False` if the message has already been attempted `max_attempts` times.
+
+        """
+        attempts = self._attempts.get(msg_desc['id'], 1)
+        if attempts >= self.max_attempts:
+            return False
+        self._attempts[msg_desc['id']] = attempts + 1
+
+        # Exponential Backoff with Jitter
+        delay = min(2 ** attempts, MAX_RETRY_DELAY) + secrets.SystemRandom().uniform(0, 1)
+        log.debug('Retrying message %s in %.2f seconds (%s/%s)', msg_desc['id'], delay, attempts, self.max_attempts)
+        heapq.heappush(self._queue, (time.monotonic() + delay, next(self._counter), msg_desc))
+        return True
+
+    def pop_due(self, size):
+        """
+        Get up to :param size messages whose backoff has expired.
+
+        """
+        now = time.monotonic()
+        due = []
+        while self._queue and len(due) < size and self._queue[0][0] <= now:
+            due.append(heapq.heappop(self._queue)[2])
+        return due
+
+    def wait(self):
+        """
+        Block until the backoff of the next message expires.
+
+        """
+        if self._queue:
+            delay = self._queue[0][0] - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+    def __len__(self):
+        return len(self._queue)
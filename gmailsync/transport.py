@@ -0,0 +1,134 @@
+"""
+HTTP transports of the Gmail API client.
+"""
+import threading
+
+
+TRANSPORTS = ('httplib2', 'session')
+
+# Max connections kept open by the session transport, shared by all the threads
+DEFAULT_POOL_SIZE = 10
+
+# Seconds to wait for a connection or a response, as the Google API client: a stalled connection
+# must not block a worker forever
+DEFAULT_HTTP_TIMEOUT = 60
+
+
+class Httplib2Transport:
+    """
+    Transport of the Google API client by default: each thread has its own httplib2 connection.
+
+    :param timeout: timeout of the connections, in seconds.
+
+    """
+
+    def __init__(self, timeout=DEFAULT_HTTP_TIMEOUT):
+        self.timeout = timeout
+
+    def http(self, credentials):
+        """
+        Get an HTTP object authorized with :param credentials to build a service.
+
+        """
+        # Imported here, as in `build_service`
+        from google_auth_httplib2 import AuthorizedHttp
+        from googleapiclient.http import build_http
+
+        # The same connection the Google API client builds by default, without following 308 redirects
+        http = build_http()
+        http.timeout = self.timeout
+        return AuthorizedHttp(credentials, http=http)
+
+    def close(self):
+        pass
+
+
+class SessionTransport:
+    """
+    Transport based on a requests session authorized with google-auth, shared by all the threads.
+
+    The session keeps a pool of keep-alive connections, so the batches of all the workers reuse
+    the same connections instead of opening a new one, with its TLS handshake, per thread.
+
+    Responses are requested compressed with gzip. The Google API client already does it for
+    single requests, but not for batches, whose responses carry the raw messages.
+
+    :param pool_size: max connections kept open.
+
+    :param timeout: timeout of the requests, in seconds.
+
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_HTTP_TIMEOUT):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._session = None
+        self._lock = threading.Lock()
+
+    def http(self, credentials):
+        """
+        Get an HTTP object authorized with :param credentials to build a service.
+
+        """
+        with self._lock:
+            if self._session is None:
+                self._session = self._create_session(credentials)
+        return SessionHttp(self._session, timeout=self.timeout)
+
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+    def _create_session(self, credentials):
+        from google.auth.transport.requests import AuthorizedSession
+        from requests.adapters import HTTPAdapter
+
+        session = AuthorizedSession(credentials)
+        session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size))
+        return session
+
+
+class SessionHttp:
+    """
+    Adapter of a requests session to the httplib2 interface expected by the Google API client.
+
+    :param session: AuthorizedSession that sends the requests.
+
+    :param timeout: timeout of the requests, in seconds. requests waits forever without it.
+
+    """
+
+    def __init__(self, session, timeout=DEFAULT_HTTP_TIMEOUT):
+        self.session = session
+        self.timeout = timeout
+        # Used by the Google API client to authorize the requests of a batch
+        self.credentials = session.credentials
+
+    def request(self, uri, method='GET', body=None, headers=None, redirections=5, connection_type=None):
+        import httplib2
+
+        headers = {key.lower(): value for key, value in (headers or {}).items()}
+        headers['accept-encoding'] = 'gzip'
+        # Google only compresses the responses of the clients whose user agent contains gzip
+        user_agent = headers.get('user-agent', '')
+        if 'gzip' not in user_agent:
+            headers['user-agent'] = (user_agent + ' (gzip)').lstrip()
+
+        response = self.session.request(method, uri, data=body, headers=headers, allow_redirects=redirections > 0,
+                                        timeout=self.timeout)
+
+        info = {key.lower(): value for key, value in response.headers.items()}
+        info['status'] = str(response.status_code)
+        # The content is already decompressed, as httplib2 does
+        if 'content-encoding' in info:
+            info['-content-encoding'] = info.pop('content-encoding')
+            info['content-length'] = str(len(response.content))
+        resp = httplib2.Response(info)
+        resp.reason = response.reason
+        return resp, response.content
+
+    def close(self):
+        # The session is shared, it is closed by its transport
+        pass
@@ -1,5 +1,8 @@
 import itertools
 import os
+import queue
+import tempfile
+import threading
 
 
 def chunked(iterable, size):
@@ -11,6 +14,169 @@ def chunked(iterable, size):
         yield chunk
 
 
+def prefetch(iterable, size):
+    """
+    Consume :param iterable in a background thread while the caller processes the items already
+    produced.
+
+    At most :param size items are buffered, so a slow consumer throttles the producer. Exceptions
+    raised by the producer are re-raised in the consumer once the buffered items are consumed.
+
+    :param iterable: iterable to be consumed in background.
+
+    :param size: max number of items buffered.
+
+    """
+    buffer = queue.Queue(maxsize=size)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except BaseException as e:
+            put(_EndOfStream(e))
+        else:
+            put(_EndOfStream())
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = buffer.get()
+            if isinstance(item, _EndOfStream):
+                if item.error is not None:
+                    raise item.error
+                break
+            yield item
+    finally:
+        # Unblock the producer if the consumer stops early
+        stopped.set()
+
+
+def merge(iterables, size, concurrency):
+    """
+    Consume several iterables in background threads, :param concurrency of them at a time, while
+    the caller processes the items already produced.
+
+    Yield tuples (index of the iterable, item). The items of each iterable keep their order,
+    while the items of different iterables are yielded as they are produced. Iterables are
+    started in order as the previous ones are exhausted.
+
+    At most :param size items are buffered. Exceptions raised by a producer are re-raised in the
+    consumer once the buffered items before them are consumed.
+
+    :param iterables: list of iterables to be consumed in background.
+
+    :param size: max number of items buffered.
+
+    :param concurrency: max number of iterables consumed at the same time.
+
+    """
+    buffer = queue.Queue(maxsize=size)
+    stopped = threading.Event()
+    pending = iter(enumerate(iterables))
+    lock = threading.Lock()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            while True:
+                with lock:
+                    index, iterable = next(pending, (None, None))
+                if index is None:
+                    break
+                for item in iterable:
+                    if not put((index, item)):
+                        return
+        except BaseException as e:
+            put(_EndOfStream(e))
+        else:
+            put(_EndOfStream())
+
+    producers = [threading.Thread(target=produce, daemon=True) for _ in range(concurrency)]
+    for producer in producers:
+        producer.start()
+    try:
+        running = len(producers)
+        while running:
+            item = buffer.get()
+            if isinstance(item, _EndOfStream):
+                if item.error is not None:
+                    raise item.error
+                running -= 1
+                continue
+            yield item
+    finally:
+        # Unblock the producers if the consumer stops early
+        stopped.set()
+
+
+class _EndOfStream:
+
+    def __init__(self, error=None):
+        self.error = error
+
+
+def write_atomically(path, data, fsync=False):
+    """
+    Replace the content of the file :param path with :param data (bytes) atomically.
+
+    The data is written to a temporary file in the same directory which then replaces the file,
+    so readers and crashes never see an empty or half-written file.
+
+    :param fsync: if True, the file and its directory are flushed to the disk, so the new content
+    also survives power failures.
+
+    """
+    directory = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + '.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+    if fsync:
+        # The rename itself is only durable once the directory is flushed
+        fsync_path(directory)
+
+
+def fsync_path(path):
+    """
+    Flush the file or directory :param path to the disk.
+
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
 def expand_path(path):
     """
     Convert relative paths to absolute paths expanding environment variables, and '~' to
@@ -31,6 +31,9 @@ setup(
     include_package_data=True,
     zip_safe=False,
     install_requires=requires,
+    extras_require={
+        'zstd': ['zstandard'],
+    },
     entry_points={
         'console_scripts': [
             'gmailsync = gmailsync.__main__:main'
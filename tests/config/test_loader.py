@@ -52,7 +52,31 @@ class ConfigLoaderTestCase(unittest.TestCase):
             'general': {
                 'credentials': '/etc/gmailsync/credentials.json',
                 'token': '/etc/gmailsync/token.pickle',
-                'box_type': 'mbox'
+                'box_type': 'mbox',
+                'sync_mode': 'history',
+                'backfill': 'year',
+                'durability': 'message',
+                'maildir_shards': 'month',
+                'maildir_shard_size': 5000,
+                'sqlite_compress': True,
+                'sqlite_full_text': True,
+                'compression': 'zstd',
+                'workers': 4,
+                'max_inflight_bytes': 1024,
+                'batch_max_bytes': 1048576,
+                'large_message_size': 8388608,
+                'transport': 'session',
+                'http_pool_size': 4,
+                'http_timeout': 30,
+                'routing': 'shared',
+                'cache': '/var/cache/gmailsync',
+                'cache_max_bytes': 2048,
+                'blob_store': '/var/lib/gmailsync/blobs',
+                'blob_min_size': 4096,
+                'hardlinks': True,
+                'checkpoint_messages': 10,
+                'checkpoint_interval': 2,
+                'fsync_state': True,
             }
         })
         loader = ConfigLoader(parser, 'fake_config_dir')
@@ -60,6 +84,30 @@ class ConfigLoaderTestCase(unittest.TestCase):
         self.assertEqual(config.credentials, '/etc/gmailsync/credentials.json')
         self.assertEqual(config.token, '/etc/gmailsync/token.pickle')
         self.assertEqual(config.box_type, 'mbox')
+        self.assertEqual(config.sync_mode, 'history')
+        self.assertEqual(config.backfill, 'year')
+        self.assertEqual(config.durability, 'message')
+        self.assertEqual(config.maildir_shards, 'month')
+        self.assertEqual(config.maildir_shard_size, 5000)
+        self.assertTrue(config.sqlite_compress)
+        self.assertTrue(config.sqlite_full_text)
+        self.assertEqual(config.compression, 'zstd')
+        self.assertEqual(config.workers, 4)
+        self.assertEqual(config.max_inflight_bytes, 1024)
+        self.assertEqual(config.batch_max_bytes, 1048576)
+        self.assertEqual(config.large_message_size, 8388608)
+        self.assertEqual(config.transport, 'session')
+        self.assertEqual(config.http_pool_size, 4)
+        self.assertEqual(config.http_timeout, 30)
+        self.assertEqual(config.routing, 'shared')
+        self.assertEqual(config.cache, '/var/cache/gmailsync')
+        self.assertEqual(config.cache_max_bytes, 2048)
+        self.assertEqual(config.blob_store, '/var/lib/gmailsync/blobs')
+        self.assertEqual(config.blob_min_size, 4096)
+        self.assertTrue(config.hardlinks)
+        self.assertEqual(config.checkpoint_messages, 10)
+        self.assertEqual(config.checkpoint_interval, 2)
+        self.assertTrue(config.fsync_state)
 
     def test_load_default_general_config(self):
         parser = FakeParser(dict())
@@ -68,13 +116,43 @@ class ConfigLoaderTestCase(unittest.TestCase):
         self.assertEqual(config.credentials, 'fake_config_dir/credentials.json')
         self.assertEqual(config.token, 'fake_config_dir/token.pickle')
         self.assertEqual(config.box_type, 'maildir')
+        self.assertEqual(config.sync_mode, 'query')
+        self.assertEqual(config.backfill, 'none')
+        self.assertEqual(config.durability, 'batch')
+        self.assertEqual(config.maildir_shards, 'none')
+        self.assertEqual(config.maildir_shard_size, 100000)
+        self.assertFalse(config.sqlite_compress)
+        self.assertFalse(config.sqlite_full_text)
+        self.assertEqual(config.compression, 'none')
+        self.assertIsNone(config.compression_dictionary)
+        self.assertEqual(config.workers, 1)
+        self.assertEqual(config.max_inflight_bytes, 67108864)
+        self.assertIsNone(config.batch_max_bytes)
+        self.assertIsNone(config.large_message_size)
+        self.assertEqual(config.transport, 'httplib2')
+        self.assertEqual(config.http_pool_size, 10)
+        self.assertEqual(config.http_timeout, 60)
+        self.assertEqual(config.routing, 'channel')
+        self.assertIsNone(config.cache)
+        self.assertEqual(config.cache_max_bytes, 1073741824)
+        self.assertIsNone(config.blob_store)
+        self.assertEqual(config.blob_min_size, 65536)
+        self.assertFalse(config.hardlinks)
+        self.assertEqual(config.checkpoint_messages, 100)
+        self.assertEqual(config.checkpoint_interval, 5)
+        self.assertFalse(config.fsync_state)
 
     def test_load_channels_config(self):
         parser = FakeParser({
             'channel-ch1': {
                 'mailbox': '~/mail/ch1',
                 'query': 'label:ch1',
-                'box_type': 'mbox'
+                'box_type': 'mbox',
+                'sync_mode': 'history',
+                'backfill': 'month',
+                'durability': 'none',
+                'maildir_shards': 'hash',
+                'compression': 'gzip',
             },
             'channel-ch2': {
                 'mailbox': '/var/mail/ch2',
@@ -88,6 +166,16 @@ class ConfigLoaderTestCase(unittest.TestCase):
         self.assertTrue('ch2' in config.channels)
         self._verify_channel(config.channels['ch1'], 'ch1', '~/mail/ch1', 'label:ch1', 'mbox')
         self._verify_channel(config.channels['ch2'], 'ch2', '/var/mail/ch2', 'label:ch2', None)
+        self.assertEqual(config.channels['ch1'].sync_mode, 'history')
+        self.assertIsNone(config.channels['ch2'].sync_mode)
+        self.assertEqual(config.channels['ch1'].backfill, 'month')
+        self.assertIsNone(config.channels['ch2'].backfill)
+        self.assertEqual(config.channels['ch1'].durability, 'none')
+        self.assertIsNone(config.channels['ch2'].durability)
+        self.assertEqual(config.channels['ch1'].maildir_shards, 'hash')
+        self.assertIsNone(config.channels['ch2'].maildir_shards)
+        self.assertEqual(config.channels['ch1'].compression, 'gzip')
+        self.assertIsNone(config.channels['ch2'].compression)
 
     def test_load_groups_config(self):
         parser = FakeParser({
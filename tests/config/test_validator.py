@@ -1,4 +1,5 @@
 import unittest
+from unittest.mock import patch
 
 from gmailsync.config.validator import ConfigValidator, ConfigurationError
 from gmailsync.config.models import Config, ChannelConfig, GroupConfig
@@ -26,3 +27,76 @@ class ConfigValidationTestCase(unittest.TestCase):
         config = Config(channels={'ch1': channel1}, groups={'gr1': group1})
         with self.assertRaisesRegex(ConfigurationError, "Channel 'other' in group 'gr1' is not defined"):
             self.validator.validate(config)
+
+    def test_invalid_sync_mode(self):
+        channel1 = ChannelConfig(name='ch1', mailbox_path='/var/mail/ch1', query='label:ch1')
+        config = Config(sync_mode='invalid', channels={'ch1': channel1})
+        with self.assertRaisesRegex(ConfigurationError, "Invalid sync_mode: 'invalid'"):
+            self.validator.validate(config)
+
+    def test_invalid_channel_sync_mode(self):
+        channel1 = ChannelConfig(name='ch1', mailbox_path='/var/mail/ch1', query='label:ch1', sync_mode='invalid')
+        config = Config(channels={'ch1': channel1})
+        with self.assertRaisesRegex(ConfigurationError, "Invalid sync_mode in channel 'ch1': 'invalid'"):
+            self.validator.validate(config)
+
+    def test_invalid_backfill(self):
+        channel1 = ChannelConfig(name='ch1', mailbox_path='/var/mail/ch1', query='label:ch1', backfill='week')
+        config = Config(channels={'ch1': channel1})
+        with self.assertRaisesRegex(ConfigurationError, "Invalid backfill in channel 'ch1': 'week'"):
+            self.validator.validate(config)
+
+    def test_invalid_channel_durability(self):
+        channel1 = ChannelConfig(name='ch1', mailbox_path='/var/mail/ch1', query='label:ch1', durability='always')
+        config = Config(channels={'ch1': channel1})
+        with self.assertRaisesRegex(ConfigurationError, "Invalid durability in channel 'ch1': 'always'"):
+            self.validator.validate(config)
+
+    def test_invalid_channel_maildir_shards(self):
+        channel1 = ChannelConfig(name='ch1', mailbox_path='/var/mail/ch1', query='label:ch1', maildir_shards='year')
+        config = Config(channels={'ch1': channel1})
+        with self.assertRaisesRegex(ConfigurationError, "Invalid maildir_shards in channel 'ch1': 'year'"):
+            self.validator.validate(config)
+
+    def test_invalid_maildir_shard_size(self):
+        channel1 = ChannelConfig(name='ch1', mailbox_path='/var/mail/ch1', query='label:ch1')
+        config = Config(maildir_shard_size=0, channels={'ch1': channel1})
+        with self.assertRaisesRegex(ConfigurationError, 'Invalid maildir_shard_size: 0. It must be greater than 0'):
+            self.validator.validate(config)
+
+    def test_invalid_compression(self):
+        channel1 = ChannelConfig(name='ch1', mailbox_path='/var/mail/ch1', query='label:ch1', compression='lzma')
+        config = Config(channels={'ch1': channel1})
+        with self.assertRaisesRegex(ConfigurationError, "Invalid compression in channel 'ch1': 'lzma'"):
+            self.validator.validate(config)
+
+    @patch('gmailsync.config.validator.zstandard', None)
+    def test_zstd_compression_not_installed(self):
+        channel1 = ChannelConfig(name='ch1', mailbox_path='/var/mail/ch1', query='label:ch1')
+        config = Config(compression='zstd', channels={'ch1': channel1})
+        with self.assertRaisesRegex(ConfigurationError, 'zstd compression requires the zstandard package'):
+            self.validator.validate(config)
+
+    def test_invalid_routing(self):
+        channel1 = ChannelConfig(name='ch1', mailbox_path='/var/mail/ch1', query='label:ch1')
+        config = Config(routing='invalid', channels={'ch1': channel1})
+        with self.assertRaisesRegex(ConfigurationError, "Invalid routing: 'invalid'"):
+            self.validator.validate(config)
+
+    def test_invalid_transport(self):
+        channel1 = ChannelConfig(name='ch1', mailbox_path='/var/mail/ch1', query='label:ch1')
+        config = Config(transport='invalid', channels={'ch1': channel1})
+        with self.assertRaisesRegex(ConfigurationError, "Invalid transport: 'invalid'"):
+            self.validator.validate(config)
+
+    def test_invalid_http_timeout(self):
+        channel1 = ChannelConfig(name='ch1', mailbox_path='/var/mail/ch1', query='label:ch1')
+        config = Config(http_timeout=0, channels={'ch1': channel1})
+        with self.assertRaisesRegex(ConfigurationError, 'Invalid http_timeout: 0. It must be greater than 0'):
+            self.validator.validate(config)
+
+    def test_invalid_workers(self):
+        channel1 = ChannelConfig(name='ch1', mailbox_path='/var/mail/ch1', query='label:ch1')
+        config = Config(workers=0, channels={'ch1': channel1})
+        with self.assertRaisesRegex(ConfigurationError, 'Invalid workers: 0. It must be greater than 0'):
+            self.validator.validate(config)
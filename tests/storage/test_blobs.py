@@ -0,0 +1,72 @@
+import unittest
+from email.message import EmailMessage
+from email import policy
+import email
+import os
+import tempfile
+
+from gmailsync.storage import BlobStore
+
+
+def build_message(attachment, text='Hello\n'):
+    message = EmailMessage()
+    message['From'] = 'John Doe <jdoe@machine.example>'
+    message['Subject'] = 'Hello'
+    message.set_content(text)
+    message.add_attachment(attachment, maintype='application', subtype='pdf', filename='doc.pdf')
+    return message
+
+
+class BlobStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.store = BlobStore(os.path.join(tmp_dir.name, 'blobs'), min_size=1024)
+
+    def test_split_and_rehydrate(self):
+        raw = build_message(os.urandom(4096)).as_bytes(policy=policy.SMTP)
+
+        split = self.store.split(raw)
+
+        self.assertLess(len(split), 1024)
+        self.assertTrue(split.startswith(b'X-Gmailsync-Blob: '))
+        self.assertEqual(email.message_from_bytes(split)['Subject'], 'Hello')
+        self.assertEqual(self.store.rehydrate(split), raw)
+
+    def test_store_each_attachment_once(self):
+        attachment = os.urandom(4096)
+        raw1 = build_message(attachment, text='One\n').as_bytes(policy=policy.SMTP)
+        raw2 = build_message(attachment, text='Two\n').as_bytes(policy=policy.SMTP)
+
+        split1 = self.store.split(raw1)
+        split2 = self.store.split(raw2)
+
+        blobs = [name for _, _, names in os.walk(self.store.path) for name in names]
+        self.assertEqual(len(blobs), 1)
+        self.assertEqual(self.store.rehydrate(split1), raw1)
+        self.assertEqual(self.store.rehydrate(split2), raw2)
+
+    def test_split_nested_parts(self):
+        inner = build_message(os.urandom(4096))
+        outer = build_message(os.urandom(2048))
+        outer.add_attachment(inner)
+        # Line endings of POSIX
+        raw = outer.as_bytes(policy=policy.default)
+
+        split = self.store.split(raw)
+
+        self.assertEqual(split.count(b'X-Gmailsync-Blob: '), 2)
+        self.assertNotIn(b'\r\n', split)
+        self.assertEqual(self.store.rehydrate(split), raw)
+
+    def test_keep_small_and_text_parts(self):
+        raw = build_message(os.urandom(100), text='Long text\n' * 500).as_bytes(policy=policy.SMTP)
+
+        self.assertEqual(self.store.split(raw), raw)
+
+    def test_keep_message_without_mime(self):
+        raw = b'From: John Doe <jdoe@machine.example>\r\nSubject: Hello\r\n\r\n' + b'Hello\r\n' * 1000
+
+        self.assertEqual(self.store.split(raw), raw)
+        self.assertEqual(self.store.rehydrate(raw), raw)
@@ -0,0 +1,55 @@
+import unittest
+from unittest.mock import patch
+import gzip
+
+from gmailsync.storage import Compressor
+from gmailsync.storage.compression import zstandard
+
+
+MESSAGE1 = b'From: John Doe <jdoe@machine.example>\r\nSubject: Hello\r\n\r\nHello\r\n'
+MESSAGE2 = b'From: Mary Smith <mary@example.net>\r\nSubject: Bye\r\n\r\nBye\r\n'
+
+
+class CompressorTestCase(unittest.TestCase):
+
+    def test_gzip(self):
+        compressor = Compressor('gzip')
+        data = compressor.compress(MESSAGE1)
+
+        self.assertEqual(gzip.decompress(data), MESSAGE1)
+        self.assertEqual(compressor.decompress(data), MESSAGE1)
+
+    def test_gzip_members_can_be_concatenated(self):
+        compressor = Compressor('gzip')
+        data = compressor.compress(MESSAGE1) + compressor.compress(MESSAGE2)
+
+        self.assertEqual(gzip.decompress(data), MESSAGE1 + MESSAGE2)
+
+    def test_compress_by_chunks(self):
+        compressor = Compressor('gzip')
+        compressobj = compressor.compressobj()
+        data = compressobj.compress(MESSAGE1[:10]) + compressobj.compress(MESSAGE1[10:]) + compressobj.flush()
+
+        self.assertEqual(compressor.decompress(data), MESSAGE1)
+
+    @unittest.skipIf(zstandard is None, 'zstandard is not installed')
+    def test_zstd(self):
+        compressor = Compressor('zstd')
+        compressobj = compressor.compressobj()
+        data = compressor.compress(MESSAGE1) + compressobj.compress(MESSAGE2) + compressobj.flush()
+
+        self.assertEqual(compressor.decompress(data[:len(compressor.compress(MESSAGE1))]), MESSAGE1)
+        self.assertEqual(zstandard.ZstdDecompressor().decompressobj().decompress(data), MESSAGE1 + MESSAGE2)
+
+    @patch('gmailsync.storage.compression.zstandard', None)
+    def test_zstd_not_installed(self):
+        with self.assertRaisesRegex(ImportError, 'zstandard'):
+            Compressor('zstd')
+
+    def test_dictionary_only_for_zstd(self):
+        with self.assertRaises(ValueError):
+            Compressor('gzip', dictionary='/path/to/dictionary')
+
+    def test_unsupported_compression(self):
+        with self.assertRaises(ValueError):
+            Compressor('bzip2')
@@ -0,0 +1,201 @@
+import unittest
+from unittest.mock import Mock, call, patch
+import base64
+import gzip
+import mailbox
+import os
+import tempfile
+
+from gmailsync.message import EncodedMessage
+from gmailsync.storage import AppendOnlyMaildir, Compressor, MessageLinker, ShardedMaildir
+
+
+MESSAGE = b'From: John Doe <jdoe@machine.example>\r\nSubject: Hello\r\n\r\nHello\r\n'
+
+
+class AppendOnlyMaildirTestCase(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.path = os.path.join(tmp_dir.name, 'box')
+
+    def test_add_bytes(self):
+        writer = AppendOnlyMaildir(self.path)
+        key = writer.add(MESSAGE)
+        writer.flush()
+
+        self.assertEqual(os.listdir(os.path.join(self.path, 'new')), [key])
+        self.assertEqual(os.listdir(os.path.join(self.path, 'tmp')), [])
+        self.assertEqual(mailbox.Maildir(self.path).get_bytes(key), MESSAGE)
+        with open(os.path.join(self.path, 'new', key), 'rb') as f:
+            self.assertEqual(f.read(), MESSAGE)
+
+    def test_add_encoded_message(self):
+        writer = AppendOnlyMaildir(self.path)
+        message = EncodedMessage(base64.urlsafe_b64encode(MESSAGE).decode('ASCII'))
+        key = writer.add(message)
+        writer.flush()
+
+        with open(os.path.join(self.path, 'new', key), 'rb') as f:
+            self.assertEqual(f.read(), MESSAGE)
+
+    def test_add_compressed(self):
+        writer = AppendOnlyMaildir(self.path, compressor=Compressor('gzip'))
+        key1 = writer.add(MESSAGE)
+        key2 = writer.add(EncodedMessage(base64.urlsafe_b64encode(MESSAGE).decode('ASCII')))
+        writer.flush()
+
+        for key in (key1, key2):
+            with open(os.path.join(self.path, 'new', key), 'rb') as f:
+                self.assertEqual(gzip.decompress(f.read()), MESSAGE)
+
+    def test_link_source(self):
+        other = AppendOnlyMaildir(self.path + '2', durability='none')
+        source = other.message_path(other.add(MESSAGE))
+
+        writer = AppendOnlyMaildir(self.path)
+        key = writer.add(b'not written', source=source)
+        self.assertEqual(writer.message_path(key), os.path.join(self.path, 'tmp', key))
+        writer.flush()
+
+        path = writer.message_path(key)
+        self.assertEqual(path, os.path.join(self.path, 'new', key))
+        self.assertTrue(os.path.samefile(path, source))
+        self.assertEqual(os.listdir(os.path.join(self.path, 'tmp')), [])
+
+    def test_write_message_if_source_cannot_be_linked(self):
+        writer = AppendOnlyMaildir(self.path)
+        key = writer.add(MESSAGE, source=os.path.join(self.path, 'missing'))
+        writer.flush()
+
+        with open(writer.message_path(key), 'rb') as f:
+            self.assertEqual(f.read(), MESSAGE)
+
+    def test_same_output_as_standard_library(self):
+        key1 = AppendOnlyMaildir(self.path, durability='none').add(MESSAGE)
+        key2 = mailbox.Maildir(self.path).add(MESSAGE)
+
+        with open(os.path.join(self.path, 'new', key1), 'rb') as f1, \
+                open(os.path.join(self.path, 'new', key2), 'rb') as f2:
+            self.assertEqual(f1.read(), f2.read())
+
+    def test_keep_messages_in_tmp_until_flush(self):
+        writer = AppendOnlyMaildir(self.path)
+        key = writer.add(MESSAGE)
+
+        self.assertEqual(os.listdir(os.path.join(self.path, 'tmp')), [key])
+        self.assertEqual(os.listdir(os.path.join(self.path, 'new')), [])
+
+        with patch('gmailsync.storage.maildir.fsync_path') as mock_fsync_path:
+            writer.flush()
+
+        mock_fsync_path.assert_has_calls([call(os.path.join(self.path, 'tmp', key)),
+                                          call(os.path.join(self.path, 'new'))])
+        self.assertEqual(os.listdir(os.path.join(self.path, 'tmp')), [])
+        self.assertEqual(os.listdir(os.path.join(self.path, 'new')), [key])
+
+    def test_deliver_each_message_with_message_durability(self):
+        writer = AppendOnlyMaildir(self.path, durability='message')
+        with patch('gmailsync.storage.maildir.os.fsync') as mock_fsync, \
+                patch('gmailsync.storage.maildir.fsync_path') as mock_fsync_path:
+            key = writer.add(MESSAGE)
+
+        mock_fsync.assert_called_once()
+        mock_fsync_path.assert_called_once_with(os.path.join(self.path, 'new'))
+        self.assertEqual(os.listdir(os.path.join(self.path, 'new')), [key])
+
+    def test_deliver_without_sync_with_no_durability(self):
+        writer = AppendOnlyMaildir(self.path, durability='none')
+        with patch('gmailsync.storage.maildir.os.fsync') as mock_fsync, \
+                patch('gmailsync.storage.maildir.fsync_path') as mock_fsync_path:
+            key = writer.add(MESSAGE)
+            writer.flush()
+
+        mock_fsync.assert_not_called()
+        mock_fsync_path.assert_not_called()
+        self.assertEqual(os.listdir(os.path.join(self.path, 'new')), [key])
+
+    def test_remove_temporary_file_if_write_fails(self):
+        writer = AppendOnlyMaildir(self.path)
+        message = EncodedMessage('not base64!')
+
+        with self.assertRaises(ValueError):
+            writer.add(message)
+
+        self.assertEqual(os.listdir(os.path.join(self.path, 'tmp')), [])
+        self.assertEqual(os.listdir(os.path.join(self.path, 'new')), [])
+
+
+class ShardedMaildirTestCase(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.path = os.path.join(tmp_dir.name, 'box')
+
+    def test_shard_by_month(self):
+        writer = ShardedMaildir(self.path, shards='month')
+        key1 = writer.add(MESSAGE, timestamp=1533081600)  # 2018-08-01
+        key2 = writer.add(MESSAGE, timestamp=1535759999)  # 2018-08-31
+        key3 = writer.add(MESSAGE, timestamp=1535760000)  # 2018-09-01
+        writer.flush()
+
+        self.assertTrue(key1.startswith('2018.08/'))
+        self.assertTrue(key2.startswith('2018.08/'))
+        self.assertTrue(key3.startswith('2018.09/'))
+        root = mailbox.Maildir(self.path)
+        self.assertEqual(sorted(root.list_folders()), ['2018.08', '2018.09'])
+        self.assertEqual(len(root.get_folder('2018.08')), 2)
+        self.assertEqual(root.get_folder('2018.09').get_bytes(key3.split('/')[1]), MESSAGE)
+
+    def test_shard_by_hash(self):
+        writer = ShardedMaildir(self.path, shards='hash')
+        key1 = writer.add(MESSAGE, msg_id='msg1')
+        key2 = writer.add(MESSAGE, msg_id='msg1')
+        writer.flush()
+
+        shard = key1.split('/')[0]
+        self.assertEqual(len(shard), 2)
+        self.assertEqual(key2.split('/')[0], shard)
+        self.assertEqual(len(mailbox.Maildir(self.path).get_folder(shard)), 2)
+
+    def test_rotate_full_shards(self):
+        writer = ShardedMaildir(self.path, shards='month', shard_size=2)
+        keys = [writer.add(MESSAGE, timestamp=1533081600) for _ in range(5)]
+        writer.flush()
+
+        self.assertEqual([k.split('/')[0] for k in keys], ['2018.08', '2018.08', '2018.08-1', '2018.08-1', '2018.08-2'])
+
+    def test_resume_last_rotated_shard(self):
+        writer = ShardedMaildir(self.path, shards='month', shard_size=2)
+        for _ in range(3):
+            writer.add(MESSAGE, timestamp=1533081600)
+        writer.flush()
+
+        writer = ShardedMaildir(self.path, shards='month', shard_size=2)
+        keys = [writer.add(MESSAGE, timestamp=1533081600) for _ in range(2)]
+
+        self.assertEqual([k.split('/')[0] for k in keys], ['2018.08-1', '2018.08-2'])
+
+
+class MessageLinkerTestCase(unittest.TestCase):
+
+    def test_find_registered_message(self):
+        writer = Mock()
+        writer.message_path.return_value = '/mail/box/new/key1'
+        linker = MessageLinker()
+        linker.register('msg1', writer, 'key1')
+
+        self.assertEqual(linker.find('msg1'), '/mail/box/new/key1')
+        writer.message_path.assert_called_once_with('key1')
+        self.assertIsNone(linker.find('msg2'))
+        self.assertIsNone(linker.find('msg1', group=('gzip', None)))
+
+    def test_forget_oldest_messages(self):
+        linker = MessageLinker(max_entries=2)
+        for msg_id in ('msg1', 'msg2', 'msg3'):
+            linker.register(msg_id, Mock(), 'key')
+
+        self.assertIsNone(linker.find('msg1'))
+        self.assertIsNotNone(linker.find('msg3'))
@@ -0,0 +1,172 @@
+import unittest
+from unittest.mock import ANY, patch
+import errno
+import gzip
+import mailbox
+import os
+import tempfile
+
+from gmailsync.storage import AppendOnlyMbox, AppendOnlyMMDF, Compressor, TruncatedMailboxError
+
+
+MESSAGE1 = b'From: John Doe <jdoe@machine.example>\r\nSubject: Hello\r\n\r\nHello\r\nFrom now on, bye'
+MESSAGE2 = b'From: Mary Smith <mary@example.net>\r\nSubject: Bye\r\n\r\nBye\r\n'
+
+
+class AppendOnlyMboxTestCase(unittest.TestCase):
+
+    writer_class = AppendOnlyMbox
+    reader_class = mailbox.mbox
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.path = os.path.join(tmp_dir.name, 'box')
+        self.offset_path = self.path + '.gmailsyncoffset'
+
+    def test_readable_by_standard_library(self):
+        writer = self.writer_class(self.path, self.offset_path)
+        writer.add(MESSAGE1)
+        writer.add(MESSAGE2)
+        writer.flush()
+
+        messages = [m.as_bytes() for m in self.reader_class(self.path)]
+
+        self.assertEqual(len(messages), 2)
+        self.assertIn(b'Subject: Hello', messages[0])
+        self.assertIn(b'>From now on, bye', messages[0])
+        self.assertIn(b'Subject: Bye', messages[1])
+
+    def test_append_to_existing_mailbox(self):
+        writer = self.writer_class(self.path, self.offset_path)
+        writer.add(MESSAGE1)
+        writer.close()
+
+        writer = self.writer_class(self.path, self.offset_path)
+        key = writer.add(MESSAGE2)
+        writer.close()
+
+        self.assertEqual(len(self.reader_class(self.path)), 2)
+        self.assertGreater(key, 0)
+
+    def test_do_not_read_existing_messages(self):
+        writer = self.writer_class(self.path, self.offset_path)
+        writer.add(MESSAGE1)
+        writer.close()
+
+        writer = self.writer_class(self.path, self.offset_path)
+        with patch('gmailsync.storage.mbox.open', wraps=open) as mock_open:
+            writer.add(MESSAGE2)
+
+        self.assertEqual(mock_open.call_args_list[0][0], (self.path, 'ab'))
+        writer.close()
+
+    def test_detect_truncated_mailbox(self):
+        writer = self.writer_class(self.path, self.offset_path)
+        writer.add(MESSAGE1)
+        writer.add(MESSAGE2)
+        writer.close()
+        with open(self.path, 'r+b') as f:
+            f.truncate(10)
+
+        writer = self.writer_class(self.path, self.offset_path)
+        with self.assertRaises(TruncatedMailboxError):
+            writer.add(MESSAGE1)
+
+    def test_accept_mailbox_grown_by_others(self):
+        writer = self.writer_class(self.path, self.offset_path)
+        writer.add(MESSAGE1)
+        writer.close()
+        other = self.reader_class(self.path)
+        other.add(MESSAGE2)
+        other.close()
+
+        writer = self.writer_class(self.path, self.offset_path)
+        writer.add(MESSAGE1)
+        writer.close()
+
+        self.assertEqual(len(self.reader_class(self.path)), 3)
+
+    @patch('gmailsync.storage.mbox.os.fsync')
+    def test_sync_on_flush(self, mock_fsync):
+        writer = self.writer_class(self.path, self.offset_path)
+        writer.add(MESSAGE1)
+        writer.add(MESSAGE2)
+        mock_fsync.assert_not_called()
+
+        writer.flush()
+        mock_fsync.assert_called()
+
+    @patch('gmailsync.storage.mbox.os.fsync')
+    def test_sync_each_message_with_message_durability(self, mock_fsync):
+        writer = self.writer_class(self.path, self.offset_path, durability='message')
+        writer.add(MESSAGE1)
+        writer.add(MESSAGE2)
+
+        self.assertEqual(mock_fsync.call_count, 2)
+        writer.close()
+
+    def test_compressed_mailbox(self):
+        compressor = Compressor('gzip')
+        writer = self.writer_class(self.path, self.offset_path, compressor=compressor)
+        writer.add(MESSAGE1)
+        start, stop = writer.last_span
+        writer.add(MESSAGE2)
+        writer.close()
+
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        uncompressed = os.path.join(os.path.dirname(self.path), 'uncompressed')
+        with open(uncompressed, 'wb') as f:
+            f.write(gzip.decompress(data))
+        self.assertEqual(len(self.reader_class(uncompressed)), 2)
+        self.assertIn(b'Subject: Hello', compressor.decompress(data[start:stop]))
+
+    @patch('mailbox.fcntl')
+    def test_lock_until_flush(self, mock_fcntl):
+        writer = self.writer_class(self.path, self.offset_path)
+        writer.add(MESSAGE1)
+        writer.add(MESSAGE2)
+
+        mock_fcntl.lockf.assert_called_once_with(ANY, mock_fcntl.LOCK_EX | mock_fcntl.LOCK_NB)
+        self.assertTrue(os.path.exists(self.path + '.lock'))
+
+        writer.flush()
+        mock_fcntl.lockf.assert_called_with(ANY, mock_fcntl.LOCK_UN)
+        self.assertFalse(os.path.exists(self.path + '.lock'))
+
+    @patch('mailbox.fcntl')
+    def test_locked_by_another_program(self, mock_fcntl):
+        mock_fcntl.lockf.side_effect = [BlockingIOError(errno.EAGAIN, 'Resource temporarily unavailable'), None]
+
+        writer = self.writer_class(self.path, self.offset_path)
+        with self.assertRaises(mailbox.ExternalClashError):
+            writer.add(MESSAGE1)
+
+    def test_dot_locked_by_another_program(self):
+        open(self.path + '.lock', 'wb').close()
+
+        writer = self.writer_class(self.path, self.offset_path)
+        with self.assertRaises(mailbox.ExternalClashError):
+            writer.add(MESSAGE1)
+        # The lock of the other program is kept
+        self.assertTrue(os.path.exists(self.path + '.lock'))
+
+    def test_keep_from_line_of_message(self):
+        writer = self.writer_class(self.path, self.offset_path)
+        writer.add(b'From jdoe@machine.example Fri Nov 21 09:55:06 1997\r\n' + MESSAGE1)
+        writer.add(MESSAGE2)
+        writer.flush()
+
+        messages = list(self.reader_class(self.path))
+
+        self.assertEqual(len(messages), 2)
+        self.assertEqual(messages[0].get_from(), 'jdoe@machine.example Fri Nov 21 09:55:06 1997')
+        self.assertIn(b'Subject: Hello', messages[0].as_bytes())
+        self.assertIn(b'Subject: Bye', messages[1].as_bytes())
+
+
+class AppendOnlyMMDFTestCase(AppendOnlyMboxTestCase):
+
+    writer_class = AppendOnlyMMDF
+    reader_class = mailbox.MMDF
@@ -0,0 +1,63 @@
+import unittest
+from unittest.mock import call, patch
+import mailbox
+import os
+import tempfile
+
+from gmailsync.storage import AppendOnlyMH
+
+
+MESSAGE = b'From: John Doe <jdoe@machine.example>\r\nSubject: Hello\r\n\r\nHello\r\n'
+
+
+class AppendOnlyMHTestCase(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.path = os.path.join(tmp_dir.name, 'box')
+
+    def test_readable_by_standard_library(self):
+        writer = AppendOnlyMH(self.path)
+        self.assertEqual(writer.add(MESSAGE), 1)
+        self.assertEqual(writer.add(MESSAGE), 2)
+
+        reader = mailbox.MH(self.path)
+        self.assertEqual(sorted(reader.keys()), [1, 2])
+        self.assertIn(b'Subject: Hello', reader.get_bytes(1))
+
+    def test_list_folder_only_once(self):
+        mailbox.MH(self.path).add(MESSAGE)
+
+        writer = AppendOnlyMH(self.path)
+        with patch.object(writer, 'iterkeys', wraps=writer.iterkeys) as mock_iterkeys:
+            keys = [writer.add(MESSAGE) for _ in range(3)]
+
+        self.assertEqual(keys, [2, 3, 4])
+        mock_iterkeys.assert_called_once()
+
+    def test_skip_keys_taken_by_others(self):
+        writer = AppendOnlyMH(self.path)
+        writer.add(MESSAGE)
+        mailbox.MH(self.path).add(MESSAGE)
+
+        self.assertEqual(writer.add(MESSAGE), 3)
+        self.assertEqual(sorted(mailbox.MH(self.path).keys()), [1, 2, 3])
+
+    @patch('gmailsync.storage.mh.fsync_path')
+    def test_sync_folder_on_flush(self, mock_fsync_path):
+        writer = AppendOnlyMH(self.path)
+        writer.add(MESSAGE)
+        writer.add(MESSAGE)
+        mock_fsync_path.assert_not_called()
+
+        writer.flush()
+        mock_fsync_path.assert_has_calls([call(os.path.join(self.path, '1')), call(os.path.join(self.path, '2')),
+                                          call(self.path)])
+
+    def test_remove_message_if_write_fails(self):
+        writer = AppendOnlyMH(self.path)
+        with self.assertRaises(TypeError):
+            writer.add(object())
+
+        self.assertEqual(mailbox.MH(self.path).keys(), [])
@@ -0,0 +1,109 @@
+import unittest
+import mailbox
+import os
+import tempfile
+
+from gmailsync.mailbox import Mailbox
+from gmailsync.storage import OffsetIndex, OffsetRecord
+from gmailsync.storage.offsets import MAGIC, RECORD
+
+
+MESSAGE = b'From: John Doe <jdoe@machine.example>\r\nSubject: Hello\r\n\r\nHello\r\n'
+
+
+class OffsetIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.path = os.path.join(tmp_dir.name, 'box.gmailsyncoffsets')
+
+    def test_fixed_size_records(self):
+        offsets = OffsetIndex(self.path)
+        offsets.append('msg1', 0, 100, 1577060763)
+        offsets.append('msg2', 101, 50, 1577060764)
+        offsets.close()
+
+        self.assertEqual(os.path.getsize(self.path), len(MAGIC) + 2 * RECORD.size)
+        offsets = OffsetIndex(self.path)
+        self.assertEqual(len(offsets), 2)
+        self.assertEqual(offsets[1], OffsetRecord('msg2', 101, 50, 1577060764))
+        self.assertEqual(offsets[-1], offsets[1])
+        self.assertEqual(list(offsets), [OffsetRecord('msg1', 0, 100, 1577060763),
+                                         OffsetRecord('msg2', 101, 50, 1577060764)])
+
+    def test_read_records_not_flushed(self):
+        offsets = OffsetIndex(self.path)
+        offsets.append('msg1', 0, 100, 1577060763)
+
+        self.assertEqual(offsets[0], OffsetRecord('msg1', 0, 100, 1577060763))
+
+    def test_drop_half_written_record(self):
+        offsets = OffsetIndex(self.path)
+        offsets.append('msg1', 0, 100, 1577060763)
+        offsets.close()
+        with open(self.path, 'ab') as f:
+            f.write(b'half')
+
+        offsets = OffsetIndex(self.path)
+
+        self.assertEqual(len(offsets), 1)
+        self.assertEqual(os.path.getsize(self.path), len(MAGIC) + RECORD.size)
+
+    def test_rewrite(self):
+        offsets = OffsetIndex(self.path)
+        offsets.append('msg1', 0, 100, 1577060763)
+        offsets.rewrite([OffsetRecord('msg2', 10, 20, 1577060764)])
+
+        self.assertEqual(list(OffsetIndex(self.path)), [OffsetRecord('msg2', 10, 20, 1577060764)])
+
+    def test_invalid_file(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'something else')
+
+        with self.assertRaises(ValueError):
+            OffsetIndex(self.path)
+
+    def test_id_too_long(self):
+        with self.assertRaises(ValueError):
+            OffsetIndex(self.path).append('a' * 17, 0, 100, 1577060763)
+
+
+class MailboxOffsetIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.path = os.path.join(tmp_dir.name, 'box')
+
+    def test_offsets_of_stored_messages(self):
+        for box_type, reader_class in (('mbox', mailbox.mbox), ('mmdf', mailbox.MMDF), ('babyl', mailbox.Babyl)):
+            with self.subTest(box_type=box_type):
+                path = self.path + box_type
+                self._store(box_type, path)
+
+                offsets = OffsetIndex(path + '.gmailsyncoffsets')
+                reader = reader_class(path)
+                self.assertEqual([r.msg_id for r in offsets], ['msg1', 'msg2'])
+                with open(path, 'rb') as f:
+                    data = f.read()
+                for record, key in zip(offsets, reader.keys()):
+                    self.assertEqual((record.offset, record.offset + record.length), reader._toc[key])
+                    self.assertIn(b'Subject: Hello', data[record.offset:record.offset + record.length])
+                    self.assertEqual(record.timestamp, 1577060763)
+
+    def test_rebuild_missing_offset_index(self):
+        self._store('mbox', self.path)
+        expected = list(OffsetIndex(self.path + '.gmailsyncoffsets'))
+        os.remove(self.path + '.gmailsyncoffsets')
+
+        box = Mailbox('mbox', self.path)
+        self.addCleanup(box.close)
+
+        self.assertEqual(list(box.offsets), expected)
+
+    def _store(self, box_type, path):
+        box = Mailbox(box_type, path)
+        for msg_id in ('msg1', 'msg2'):
+            box.store({'message': MESSAGE, 'timestamp': 1577060763}, msg_id=msg_id)
+        box.close()
@@ -0,0 +1,80 @@
+import unittest
+import base64
+import os
+import sqlite3
+import tempfile
+
+from gmailsync.message import EncodedMessage
+from gmailsync.storage import SQLiteMailbox
+
+
+MESSAGE = (b'From: John Doe <jdoe@machine.example>\r\nTo: Mary Smith <mary@example.net>\r\n'
+           b'Subject: =?utf-8?q?Caf=C3=A9?=\r\nMessage-ID: <1234@local.machine.example>\r\n\r\n'
+           b'See you at the station\r\n')
+
+OTHER_MESSAGE = b'From: Mary Smith <mary@example.net>\r\nSubject: Bye\r\n\r\nBye\r\n'
+
+
+class SQLiteMailboxTestCase(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.path = os.path.join(tmp_dir.name, 'box')
+
+    def test_store_raw_message_and_headers(self):
+        box = SQLiteMailbox(self.path)
+        key = box.add(MESSAGE, timestamp=1577060763, msg_id='msg1')
+        box.close()
+
+        connection = sqlite3.connect(self.path)
+        row = connection.execute('SELECT msg_id, timestamp, message_id, sender, recipients, subject, size, raw '
+                                 'FROM messages WHERE key = ?', (key,)).fetchone()
+        self.assertEqual(row, ('msg1', 1577060763, '<1234@local.machine.example>', 'John Doe <jdoe@machine.example>',
+                               'Mary Smith <mary@example.net>', 'Café', len(MESSAGE), MESSAGE))
+        self.assertEqual(connection.execute('PRAGMA journal_mode').fetchone(), ('wal',))
+
+    def test_compress_messages(self):
+        box = SQLiteMailbox(self.path, compress=True)
+        key = box.add(MESSAGE)
+
+        self.assertEqual(box.get_bytes(key), MESSAGE)
+        raw, = box._connection.execute('SELECT raw FROM messages WHERE key = ?', (key,)).fetchone()
+        self.assertNotEqual(raw, MESSAGE)
+
+    def test_add_encoded_message(self):
+        box = SQLiteMailbox(self.path)
+        key = box.add(EncodedMessage(base64.urlsafe_b64encode(MESSAGE).decode('ASCII')))
+
+        self.assertEqual(box.get_bytes(key), MESSAGE)
+
+    def test_commit_on_flush(self):
+        box = SQLiteMailbox(self.path)
+        box.add(MESSAGE)
+
+        self.assertEqual(len(SQLiteMailbox(self.path)), 0)
+        box.flush()
+        self.assertEqual(len(SQLiteMailbox(self.path)), 1)
+
+    def test_commit_each_message_with_message_durability(self):
+        box = SQLiteMailbox(self.path, durability='message')
+        box.add(MESSAGE)
+
+        self.assertEqual(len(SQLiteMailbox(self.path)), 1)
+
+    def test_search(self):
+        box = SQLiteMailbox(self.path, full_text=True)
+        if not box.full_text:
+            self.skipTest('SQLite without FTS5')
+        key1 = box.add(MESSAGE)
+        key2 = box.add(OTHER_MESSAGE)
+        box.flush()
+
+        self.assertEqual(box.search('station'), [key1])
+        self.assertEqual(box.search('sender:mary'), [key2])
+        self.assertEqual(box.search('nothing'), [])
+
+    def test_search_without_full_text_index(self):
+        box = SQLiteMailbox(self.path)
+        with self.assertRaises(ValueError):
+            box.search('station')
@@ -0,0 +1,100 @@
+import unittest
+import base64
+import os
+import tempfile
+import time
+from unittest.mock import patch
+
+from gmailsync.cache import MessageCache
+
+
+RAW = b'From: John Doe <jdoe@machine.example>\r\n\r\nHello'
+
+
+def api_message(msg_id, raw=RAW):
+    return {'id': msg_id, 'raw': base64.urlsafe_b64encode(raw).decode('ASCII'),
+            'internalDate': '1577060763000', 'labelIds': ['INBOX']}
+
+
+class MessageCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.path = tmp_dir.name
+
+    def test_get_missing_message(self):
+        cache = MessageCache(self.path)
+        self.assertIsNone(cache.get('id1'))
+
+    def test_put_and_get_decoded_message(self):
+        cache = MessageCache(self.path)
+        cache.put(api_message('id1'))
+
+        message = cache.get('id1')
+
+        self.assertEqual(message, {'id': 'id1', 'decoded': RAW, 'internalDate': '1577060763000',
+                                   'labelIds': ['INBOX']})
+
+    def test_messages_are_compressed(self):
+        cache = MessageCache(self.path)
+        raw = b'Subject: Hello\r\n\r\n' + b'Hello ' * 1000
+        cache.put(api_message('id1', raw))
+
+        self.assertLess(os.path.getsize(os.path.join(self.path, 'id1')), len(raw) // 10)
+        self.assertEqual(cache.get('id1')['decoded'], raw)
+
+    def test_persistent(self):
+        MessageCache(self.path).put(api_message('id1'))
+
+        cache = MessageCache(self.path)
+
+        self.assertIn('id1', cache)
+        self.assertEqual(cache.get('id1')['decoded'], RAW)
+
+    def test_evict_least_recently_used(self):
+        cache = MessageCache(self.path)
+        cache.put(api_message('id1'))
+        cache.put(api_message('id2'))
+        cache.max_bytes = cache.size
+
+        cache.get('id1')
+        cache.put(api_message('id3'))
+
+        self.assertIn('id1', cache)
+        self.assertNotIn('id2', cache)
+        self.assertIn('id3', cache)
+        self.assertFalse(os.path.exists(os.path.join(self.path, 'id2')))
+
+    def test_evict_least_recently_used_on_load(self):
+        cache = MessageCache(self.path)
+        cache.put(api_message('id1'))
+        cache.put(api_message('id2'))
+        size = cache.size
+        # Least recently used first
+        os.utime(os.path.join(self.path, 'id2'), (time.time() - 10, time.time() - 10))
+
+        cache = MessageCache(self.path, max_bytes=size // 2)
+
+        self.assertIn('id1', cache)
+        self.assertNotIn('id2', cache)
+
+    def test_discard_corrupted_message(self):
+        cache = MessageCache(self.path)
+        cache.put(api_message('id1'))
+        with open(os.path.join(self.path, 'id1'), 'wb') as f:
+            f.write(b'corrupted')
+
+        with patch('gmailsync.cache.log'):
+            self.assertIsNone(cache.get('id1'))
+        self.assertNotIn('id1', cache)
+        self.assertEqual(cache.size, 0)
+
+    def test_remove_interrupted_writes(self):
+        with open(os.path.join(self.path, '.tmp-1234'), 'wb') as f:
+            f.write(b'partial')
+
+        cache = MessageCache(self.path)
+
+        self.assertEqual(len(cache), 0)
+        self.assertFalse(os.path.exists(os.path.join(self.path, '.tmp-1234')))
@@ -3,16 +3,20 @@ from unittest.mock import patch, call
 
 from gmailsync.config.models import Config, ChannelConfig
 from gmailsync.channel import Channel, channel_factory
+from gmailsync.storage import MessageLinker
 
 
 class ChannelTestCase(unittest.TestCase):
 
     @patch('gmailsync.channel.Mailbox')
     def test_channel_factory(self, mock_mailbox):
-        ch1 = ChannelConfig(name='ch1', mailbox_path='/mail/ch1', box_type='maildir', query='label:STARRED')
+        ch1 = ChannelConfig(name='ch1', mailbox_path='/mail/ch1', box_type='maildir', query='label:STARRED',
+                            maildir_shards='hash')
         ch2 = ChannelConfig(name='ch2', mailbox_path='/mail/ch2', box_type='maildir', query='label:INBOX')
-        ch3 = ChannelConfig(name='ch3', mailbox_path='/mail/ch3', box_type='mbox', query='other query')
-        config = Config(channels=[ch1, ch2, ch3])
+        ch3 = ChannelConfig(name='ch3', mailbox_path='/mail/ch3', box_type='mbox', query='other query',
+                            sync_mode='history', backfill='month', durability='message', compression='gzip')
+        config = Config(channels=[ch1, ch2, ch3], checkpoint_messages=10, checkpoint_interval=2, maildir_shard_size=50,
+                        backfill='year')
 
         channels_to_sync = ['ch1', 'ch3']
 
@@ -21,12 +25,35 @@ class ChannelTestCase(unittest.TestCase):
         self.assertEqual(len(channels), 2)
         self._verify_channel(channels[0], 'ch1', 'label:STARRED')
         self._verify_channel(channels[1], 'ch3', 'other query')
+        self.assertEqual(channels[0].sync_mode, 'query')
+        self.assertEqual(channels[1].sync_mode, 'history')
+        self.assertEqual(channels[0].backfill, 'year')
+        self.assertEqual(channels[1].backfill, 'month')
 
         mock_mailbox.assert_has_calls([
-            call('maildir', '/mail/ch1'),
-            call('mbox', '/mail/ch3')
+            call('maildir', '/mail/ch1', checkpoint_messages=10, checkpoint_interval=2, fsync_state=False,
+                 durability='batch', maildir_shards='hash', maildir_shard_size=50, sqlite_compress=False,
+                 sqlite_full_text=False, compression='none', compression_dictionary=None, blob_store=None,
+                 linker=None),
+            call('mbox', '/mail/ch3', checkpoint_messages=10, checkpoint_interval=2, fsync_state=False,
+                 durability='message', maildir_shards='none', maildir_shard_size=50, sqlite_compress=False,
+                 sqlite_full_text=False, compression='gzip', compression_dictionary=None, blob_store=None,
+                 linker=None)
         ])
 
+    @patch('gmailsync.channel.Mailbox')
+    def test_share_linker_between_mailboxes(self, mock_mailbox):
+        ch1 = ChannelConfig(name='ch1', mailbox_path='/mail/ch1', query='label:STARRED')
+        ch2 = ChannelConfig(name='ch2', mailbox_path='/mail/ch2', query='label:INBOX')
+        config = Config(channels=[ch1, ch2], hardlinks=True)
+
+        channel_factory(config, [])
+
+        linker1 = mock_mailbox.call_args_list[0][1]['linker']
+        linker2 = mock_mailbox.call_args_list[1][1]['linker']
+        self.assertIsInstance(linker1, MessageLinker)
+        self.assertIs(linker1, linker2)
+
     @patch('gmailsync.channel.log')
     def test_create_channel_with_query_with_after(self, mock_log):
         channel = Channel('ch1', 'fake_mailbox', 'label:INBOX after:2018-05-01')
@@ -0,0 +1,315 @@
+import json
+import unittest
+import threading
+from unittest.mock import Mock, ANY, patch, call
+
+from googleapiclient.errors import HttpError
+
+from gmailsync.client import Client, MessageFetcher, HistoryExpired, LIST_PAGE_SIZE, LIST_FIELDS, HISTORY_FIELDS
+from gmailsync.client import build_service
+from gmailsync.ratelimit import QUOTA_UNITS
+
+
+class ClientTestCase(unittest.TestCase):
+
+    def setUp(self):
+        authenticate_patcher = patch('gmailsync.client.Client._authenticate')
+        build_patcher = patch('gmailsync.client.build_service')
+
+        self.addCleanup(authenticate_patcher.stop)
+        self.addCleanup(build_patcher.stop)
+
+        self.mock_authenticate = authenticate_patcher.start()
+        self.mock_build = build_patcher.start()
+
+        self.service = self.mock_build.return_value
+        self.limiter = Mock()
+        self.client = Client('credentials.json', 'token.pickle', limiter=self.limiter)
+
+    def test_service_per_thread(self):
+        services = []
+        thread = threading.Thread(target=lambda: services.append(self.client.service))
+        thread.start()
+        thread.join()
+
+        self.assertIs(self.client.service, self.client.service)
+        self.assertEqual(self.mock_build.call_count, 2)
+        self.assertEqual(len(services), 1)
+
+    def test_build_service_with_transport(self):
+        transport = Mock()
+        client = Client('credentials.json', 'token.pickle', limiter=self.limiter, transport=transport)
+        client.service
+
+        self.mock_build.assert_called_once_with(self.mock_authenticate.return_value, transport=transport)
+
+    def test_list_is_lazy(self):
+        list_request = self.service.users.return_value.messages.return_value.list
+        list_request.return_value.execute.side_effect = [
+            {'messages': [{'id': 'id1'}, {'id': 'id2'}], 'nextPageToken': 'page2'},
+            {'messages': [{'id': 'id3'}]},
+        ]
+
+        msg_descs = self.client.list(query='label:foo', since=100, until=200)
+        self.assertEqual(next(msg_descs), {'id': 'id1'})
+        list_request.assert_called_once_with(userId='me', q='label:foo AND after:100 AND before:200',
+                                             maxResults=LIST_PAGE_SIZE, fields=LIST_FIELDS, pageToken=None)
+
+        self.assertEqual(list(msg_descs), [{'id': 'id2'}, {'id': 'id3'}])
+        list_request.assert_has_calls([
+            call(userId='me', q='label:foo AND after:100 AND before:200', maxResults=LIST_PAGE_SIZE,
+                 fields=LIST_FIELDS, pageToken='page2')
+        ])
+
+    def test_list_empty(self):
+        list_request = self.service.users.return_value.messages.return_value.list
+        list_request.return_value.execute.return_value = {'resultSizeEstimate': 0}
+
+        self.assertEqual(list(self.client.list()), [])
+        list_request.assert_called_once_with(userId='me', q='!in:chat', maxResults=LIST_PAGE_SIZE,
+                                             fields=LIST_FIELDS, pageToken=None)
+
+    def test_history(self):
+        history_request = self.service.users.return_value.history.return_value.list
+        history_request.return_value.execute.side_effect = [
+            {
+                'history': [
+                    {'messagesAdded': [{'message': {'id': 'id1'}}, {'message': {'id': 'id2'}}]},
+                    {'messagesAdded': [{'message': {'id': 'id1'}}]},
+                ],
+                'historyId': '200',
+                'nextPageToken': 'page2',
+            },
+            {'history': [{'messagesAdded': [{'message': {'id': 'id3'}}]}], 'historyId': '201'},
+        ]
+
+        msg_ids, history_id = self.client.history('100')
+
+        self.assertEqual(msg_ids, {'id1', 'id2', 'id3'})
+        self.assertEqual(history_id, '201')
+        history_request.assert_has_calls([
+            call(userId='me', startHistoryId='100', historyTypes=['messageAdded'], maxResults=LIST_PAGE_SIZE,
+                 fields=HISTORY_FIELDS, pageToken=None),
+            call().execute(),
+            call(userId='me', startHistoryId='100', historyTypes=['messageAdded'], maxResults=LIST_PAGE_SIZE,
+                 fields=HISTORY_FIELDS, pageToken='page2'),
+            call().execute(),
+        ])
+
+    def test_history_expired(self):
+        history_request = self.service.users.return_value.history.return_value.list
+        history_request.return_value.execute.side_effect = HttpError(Mock(status=404), b'Not Found')
+
+        with self.assertRaises(HistoryExpired):
+            self.client.history('100')
+
+    def test_requests_go_through_limiter(self):
+        labels_request = self.service.users.return_value.labels.return_value.list
+        labels_request.return_value.execute.return_value = {'labels': []}
+
+        self.client.labels()
+
+        self.limiter.acquire.assert_called_once_with(QUOTA_UNITS['labels.list'])
+        self.limiter.success.assert_called_once_with()
+
+    def test_retry_rate_limited_request(self):
+        labels_request = self.service.users.return_value.labels.return_value.list
+        labels_request.return_value.execute.side_effect = [
+            HttpError(Mock(status=429, get=lambda key: '7'), b'Too Many Requests'),
+            {'labels': [{'name': 'INBOX'}]},
+        ]
+
+        labels = self.client.labels()
+
+        self.assertEqual(labels, [{'name': 'INBOX'}])
+        self.limiter.throttled.assert_called_once_with(7)
+        self.assertEqual(self.limiter.acquire.call_count, 2)
+
+    def test_do_not_retry_other_errors(self):
+        labels_request = self.service.users.return_value.labels.return_value.list
+        labels_request.return_value.execute.side_effect = HttpError(Mock(status=403), b'Forbidden')
+
+        with self.assertRaises(HttpError):
+            self.client.labels()
+        self.limiter.throttled.assert_not_called()
+
+    def test_fetch_charges_each_request_of_the_batch(self):
+        batch = self.service.new_batch_http_request.return_value
+
+        def execute():
+            callback = self.service.new_batch_http_request.call_args[1]['callback']
+            callback('1', {'id': 'id1', 'raw': 'cmF3'}, None)
+            callback('2', {'id': 'id2', 'raw': 'cmF3'}, None)
+
+        batch.execute.side_effect = execute
+
+        messages, failed = self.client.fetch(({'id': 'id1'}, {'id': 'id2'}))
+
+        self.assertEqual(messages, [{'id': 'id1', 'raw': 'cmF3'}, {'id': 'id2', 'raw': 'cmF3'}])
+        self.assertEqual(failed, [])
+        self.limiter.acquire.assert_called_once_with(2 * QUOTA_UNITS['messages.get'])
+
+    def test_fetch_reports_failures_per_message(self):
+        batch = self.service.new_batch_http_request.return_value
+
+        def execute():
+            callback = self.service.new_batch_http_request.call_args[1]['callback']
+            callback('id1', {'id': 'id1', 'raw': 'cmF3'}, None)
+            callback('id2', None, HttpError(Mock(status=429, get=lambda key: None), b'Too Many Requests'))
+            callback('id3', None, HttpError(Mock(status=404), b'Not Found'))
+
+        batch.execute.side_effect = execute
+
+        with patch('gmailsync.client.log'):
+            messages, failed = self.client.fetch(({'id': 'id1'}, {'id': 'id2'}, {'id': 'id3'}))
+
+        self.assertEqual(messages, [{'id': 'id1', 'raw': 'cmF3'}])
+        self.assertEqual(failed, [{'id': 'id2'}])
+        batch.add.assert_has_calls([call(ANY, request_id='id1'), call(ANY, request_id='id2'),
+                                    call(ANY, request_id='id3')])
+        self.limiter.throttled.assert_called_once_with(None)
+
+    def test_fetch_skips_cached_messages(self):
+        cached = {'id': 'id1', 'decoded': b'raw', 'internalDate': '1000', 'labelIds': []}
+        self.client.cache = Mock()
+        self.client.cache.get.side_effect = lambda msg_id: cached if msg_id == 'id1' else None
+        batch = self.service.new_batch_http_request.return_value
+
+        def execute():
+            callback = self.service.new_batch_http_request.call_args[1]['callback']
+            callback('id2', {'id': 'id2', 'raw': 'cmF3'}, None)
+
+        batch.execute.side_effect = execute
+
+        messages, failed = self.client.fetch(({'id': 'id1'}, {'id': 'id2'}))
+
+        self.assertEqual(messages, [cached, {'id': 'id2', 'raw': 'cmF3'}])
+        self.assertEqual(failed, [])
+        batch.add.assert_called_once_with(ANY, request_id='id2')
+        self.limiter.acquire.assert_called_once_with(QUOTA_UNITS['messages.get'])
+        self.client.cache.put.assert_called_once_with({'id': 'id2', 'raw': 'cmF3'})
+
+    def test_fetch_all_cached_messages(self):
+        cached = {'id': 'id1', 'decoded': b'raw', 'internalDate': '1000', 'labelIds': []}
+        self.client.cache = Mock()
+        self.client.cache.get.return_value = cached
+
+        messages, failed = self.client.fetch(({'id': 'id1'},))
+
+        self.assertEqual(messages, [cached])
+        self.assertEqual(failed, [])
+        self.service.new_batch_http_request.assert_not_called()
+        self.limiter.acquire.assert_not_called()
+
+    def test_fetch_one(self):
+        get_request = self.service.users.return_value.messages.return_value.get
+        get_request.return_value.execute.return_value = {'id': 'id1', 'raw': 'cmF3'}
+
+        messages, failed = self.client.fetch_one({'id': 'id1'})
+
+        self.assertEqual(messages, [{'id': 'id1', 'raw': 'cmF3'}])
+        self.assertEqual(failed, [])
+        get_request.assert_called_once_with(userId='me', id='id1', format='raw')
+        self.service.new_batch_http_request.assert_not_called()
+
+    def test_fetch_one_cached_message(self):
+        cached = {'id': 'id1', 'decoded': b'raw', 'internalDate': '1000', 'labelIds': []}
+        self.client.cache = Mock()
+        self.client.cache.get.return_value = cached
+
+        self.assertEqual(self.client.fetch_one({'id': 'id1'}), ([cached], []))
+        self.limiter.acquire.assert_not_called()
+
+    def test_fetch_one_missing_message(self):
+        get_request = self.service.users.return_value.messages.return_value.get
+        get_request.return_value.execute.side_effect = HttpError(Mock(status=404), b'Not Found')
+
+        with patch('gmailsync.client.log'):
+            self.assertEqual(self.client.fetch_one({'id': 'id1'}), ([], []))
+
+    def test_estimate_sizes(self):
+        batch = self.service.new_batch_http_request.return_value
+        get_request = self.service.users.return_value.messages.return_value.get
+
+        def execute():
+            callback = self.service.new_batch_http_request.call_args[1]['callback']
+            callback('id1', {'id': 'id1', 'sizeEstimate': 1024}, None)
+            callback('id2', None, HttpError(Mock(status=429, get=lambda key: '2'), b'Too Many Requests'))
+
+        batch.execute.side_effect = execute
+        msg_descs = [{'id': 'id1'}, {'id': 'id2'}]
+
+        with patch('gmailsync.client.log'):
+            self.client.estimate_sizes(msg_descs)
+
+        self.assertEqual(msg_descs, [{'id': 'id1', 'sizeEstimate': 1024}, {'id': 'id2'}])
+        get_request.assert_called_with(userId='me', id='id2', format='minimal', fields='id,sizeEstimate')
+        self.limiter.acquire.assert_called_once_with(2 * QUOTA_UNITS['messages.get'])
+        self.limiter.throttled.assert_called_once_with(2)
+
+    def test_do_not_estimate_sizes_of_cached_messages(self):
+        self.client.cache = Mock()
+        self.client.cache.__contains__ = Mock(return_value=True)
+        msg_descs = [{'id': 'id1'}]
+
+        self.client.estimate_sizes(msg_descs)
+
+        self.assertEqual(msg_descs, [{'id': 'id1'}])
+        self.service.new_batch_http_request.assert_not_called()
+        self.limiter.acquire.assert_not_called()
+
+
+class MessageFetcherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        log_patcher = patch('gmailsync.client.log')
+        self.addCleanup(log_patcher.stop)
+        log_patcher.start()
+
+    def test_rate_limited_request(self):
+        fetcher = MessageFetcher()
+        exception = HttpError(Mock(status=403, get=lambda key: '3'), b'{"reason": "userRateLimitExceeded"}')
+        fetcher.fetch_message('1', None, exception)
+
+        self.assertTrue(fetcher.rate_limited)
+        self.assertEqual(fetcher.retry_after, 3)
+        self.assertEqual(fetcher.messages, [])
+        self.assertEqual(fetcher.failed, {'1'})
+
+    def test_missing_message(self):
+        fetcher = MessageFetcher()
+        fetcher.fetch_message('1', None, HttpError(Mock(status=404), b'Not Found'))
+
+        self.assertFalse(fetcher.rate_limited)
+        self.assertEqual(fetcher.failed, set())
+        self.assertEqual(fetcher.missing, {'1'})
+
+    def test_malformed_response(self):
+        fetcher = MessageFetcher()
+        fetcher.fetch_message('1', {'id': '1'}, None)
+        self.assertEqual(fetcher.failed, {'1'})
+
+
+class BuildServiceTestCase(unittest.TestCase):
+
+    @patch('googleapiclient.discovery.build')
+    @patch('googleapiclient.discovery.build_from_document')
+    def test_build_from_packaged_discovery_document(self, mock_build_from_document, mock_build):
+        build_service(Mock())
+        build_service(Mock())
+
+        self.assertEqual(mock_build_from_document.call_count, 2)
+        document1 = mock_build_from_document.call_args_list[0][0][0]
+        document2 = mock_build_from_document.call_args_list[1][0][0]
+        # Each service parses its own copy of the document
+        self.assertIsInstance(document1, str)
+        self.assertEqual(json.loads(document1)['name'], 'gmail')
+        self.assertEqual(document1, document2)
+        mock_build.assert_not_called()
+
+    @patch('gmailsync.client._discovery_document', None)
+    @patch('googleapiclient.discovery_cache.get_static_doc', return_value=None)
+    @patch('googleapiclient.discovery.build')
+    def test_discover_service_without_packaged_document(self, mock_build, mock_get_static_doc):
+        self.assertIs(build_service(Mock()), mock_build.return_value)
+        mock_build.assert_called_once_with('gmail', 'v1', http=ANY)
@@ -0,0 +1,47 @@
+import unittest
+import os
+import tempfile
+
+from gmailsync.index import MessageIndex
+
+
+class MessageIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.path = os.path.join(tmp_dir.name, '.gmailsyncindex')
+
+    def test_add_and_get(self):
+        index = MessageIndex(self.path)
+        index.add('id1', 'key1', 100, 1577060763)
+
+        self.assertEqual(index.get('id1'), ('key1', 100, 1577060763))
+        self.assertIsNone(index.get('id2'))
+        self.assertIn('id1', index)
+        self.assertNotIn('id2', index)
+        self.assertEqual(len(index), 1)
+        index.close()
+
+    def test_persist_committed_messages(self):
+        index = MessageIndex(self.path)
+        index.add('id1', 'key1', 100, 1577060763)
+        index.commit()
+        index.add('id2', 'key2', 200, 1577060764)
+        # Simulate a crash: the last addition is never committed
+        index._connection.rollback()
+        index._connection.close()
+
+        index = MessageIndex(self.path)
+        self.assertIn('id1', index)
+        self.assertNotIn('id2', index)
+        index.close()
+
+    def test_replace_existing_message(self):
+        index = MessageIndex(self.path)
+        index.add('id1', 'key1', 100, 1577060763)
+        index.add('id1', 'key2', 100, 1577060763)
+
+        self.assertEqual(index.get('id1'), ('key2', 100, 1577060763))
+        self.assertEqual(len(index), 1)
+        index.close()
@@ -1,13 +1,15 @@
 import unittest
-from unittest.mock import Mock, MagicMock, patch
+from unittest.mock import ANY, Mock, MagicMock, patch
 import contextlib
-import os
+import json
 
 from gmailsync.mailbox import Mailbox
 
 
 TIMESTAMP = 1577060763
 
+MESSAGE = {'id': 'msg_id1', 'raw': 'cmF3'}
+
 
 class MailBoxFactoryTestCase(unittest.TestCase):
 
@@ -15,33 +17,90 @@ class MailBoxFactoryTestCase(unittest.TestCase):
         self.load_state_patcher = patch('gmailsync.mailbox.Mailbox._load_state')
         self.load_state_patcher.start()
 
+        self.index_patcher = patch('gmailsync.mailbox.MessageIndex')
+        self.mock_index_class = self.index_patcher.start()
+
+        self.offsets_patcher = patch('gmailsync.mailbox.OffsetIndex')
+        self.mock_offsets_class = self.offsets_patcher.start()
+
     def tearDown(self):
         self.load_state_patcher.stop()
+        self.index_patcher.stop()
+        self.offsets_patcher.stop()
+
+    @patch('gmailsync.mailbox.AppendOnlyMaildir')
+    def test_create_index_inside_directory_mailbox(self, mock_maildir):
+        Mailbox('maildir', '/mail/box')
+        self.mock_index_class.assert_called_with('/mail/box/.gmailsyncindex', durable=True)
+
+    @patch('gmailsync.mailbox.AppendOnlyMbox')
+    def test_create_index_next_to_file_mailbox(self, mock_mbox):
+        mailbox = Mailbox('mbox', '/mail/box')
+        self.mock_index_class.assert_called_with('/mail/box.gmailsyncindex', durable=True)
+        self.assertEqual(mailbox.state_file, '/mail/box.gmailsyncstate')
 
-    @patch('gmailsync.mailbox.Maildir')
+    @patch('gmailsync.mailbox.AppendOnlyMaildir')
     def test_create_maildir_mailbox(self, mock_maildir):
         Mailbox('maildir', '/mail/box')
-        mock_maildir.assert_called_with('/mail/box')
+        mock_maildir.assert_called_with('/mail/box', durability='batch', compressor=None)
 
-    @patch('gmailsync.mailbox.mbox')
+    @patch('gmailsync.mailbox.AppendOnlyMbox')
     def test_create_mbox_mailbox(self, mock_mbox):
         Mailbox('mbox', '/mail/box')
-        mock_mbox.assert_called_with('/mail/box')
+        mock_mbox.assert_called_with('/mail/box', '/mail/box.gmailsyncoffset', durability='batch', compressor=None)
 
-    @patch('gmailsync.mailbox.MH')
+    @patch('gmailsync.mailbox.AppendOnlyMbox')
+    def test_create_offset_index_next_to_file_mailbox(self, mock_mbox):
+        Mailbox('mbox', '/mail/box')
+        self.mock_offsets_class.assert_called_with('/mail/box.gmailsyncoffsets', fsync=True)
+
+    @patch('gmailsync.mailbox.AppendOnlyMaildir')
+    def test_no_offset_index_in_directory_mailbox(self, mock_maildir):
+        mailbox = Mailbox('maildir', '/mail/box')
+        self.mock_offsets_class.assert_not_called()
+        self.assertIsNone(mailbox.offsets)
+
+    @patch('gmailsync.mailbox.Compressor')
+    @patch('gmailsync.mailbox.AppendOnlyMbox')
+    def test_create_compressed_mailbox(self, mock_mbox, mock_compressor):
+        Mailbox('mbox', '/mail/box', compression='zstd', compression_dictionary='/mail/dict')
+        mock_compressor.assert_called_once_with('zstd', dictionary='/mail/dict')
+        mock_mbox.assert_called_with('/mail/box', '/mail/box.gmailsyncoffset', durability='batch',
+                                     compressor=mock_compressor.return_value)
+
+    @patch('gmailsync.mailbox.Compressor')
+    @patch('gmailsync.mailbox.AppendOnlyMH')
+    def test_do_not_compress_unsupported_mailbox(self, mock_mh, mock_compressor):
+        Mailbox('mh', '/mail/box', compression='gzip')
+        mock_compressor.assert_not_called()
+        mock_mh.assert_called_with('/mail/box', durability='batch')
+
+    @patch('gmailsync.mailbox.AppendOnlyMH')
     def test_create_mh_mailbox(self, mock_mh):
         Mailbox('mh', '/mail/box')
-        mock_mh.assert_called_with('/mail/box')
+        mock_mh.assert_called_with('/mail/box', durability='batch')
 
     @patch('gmailsync.mailbox.Babyl')
     def test_create_babyl_mailbox(self, mock_babyl):
         Mailbox('babyl', '/mail/box')
         mock_babyl.assert_called_with('/mail/box')
 
-    @patch('gmailsync.mailbox.MMDF')
+    @patch('gmailsync.mailbox.AppendOnlyMaildir')
+    def test_create_mailbox_without_durability(self, mock_maildir):
+        Mailbox('maildir', '/mail/box', durability='none')
+        mock_maildir.assert_called_with('/mail/box', durability='none', compressor=None)
+        self.mock_index_class.assert_called_with('/mail/box/.gmailsyncindex', durable=False)
+
+    @patch('gmailsync.mailbox.SQLiteMailbox')
+    def test_create_sqlite_mailbox(self, mock_sqlite):
+        mailbox = Mailbox('sqlite', '/mail/box', sqlite_compress=True, sqlite_full_text=True)
+        mock_sqlite.assert_called_with('/mail/box', compress=True, full_text=True, durability='batch')
+        self.assertIsNone(mailbox.offsets)
+
+    @patch('gmailsync.mailbox.AppendOnlyMMDF')
     def test_create_mmdf_mailbox(self, mock_mmdf):
         Mailbox('mmdf', '/mail/box')
-        mock_mmdf.assert_called_with('/mail/box')
+        mock_mmdf.assert_called_with('/mail/box', '/mail/box.gmailsyncoffset', durability='batch', compressor=None)
 
     def test_invalid_box_type(self):
         with self.assertRaisesRegex(NotImplementedError, "Unsupported mailbox: 'invalid'"):
@@ -51,7 +110,7 @@ class MailBoxFactoryTestCase(unittest.TestCase):
 class MailboxOperationsTestCase(unittest.TestCase):
 
     def setUp(self):
-        self.maildir_patcher = patch('gmailsync.mailbox.Maildir')
+        self.maildir_patcher = patch('gmailsync.mailbox.AppendOnlyMaildir')
         self.mock_maildir_class = self.maildir_patcher.start()
         self.mock_maildir = self.mock_maildir_class.return_value
 
@@ -60,30 +119,158 @@ class MailboxOperationsTestCase(unittest.TestCase):
 
         self.isfile_patcher = patch('gmailsync.mailbox.os.path.isfile')
         self.mock_isfile = self.isfile_patcher.start()
+        self.mock_isfile.return_value = False
+
+        self.index_patcher = patch('gmailsync.mailbox.MessageIndex')
+        self.mock_index = self.index_patcher.start().return_value
+
+        self.state_writer_patcher = patch('gmailsync.mailbox.StateWriter')
+        self.mock_state_writer_class = self.state_writer_patcher.start()
+        self.mock_state_writer = self.mock_state_writer_class.return_value
+        self.mock_state_writer.changed.return_value = False
+        self.mock_state_writer.dirty = False
 
     def tearDown(self):
         self.maildir_patcher.stop()
         self.open_patcher.stop()
         self.isfile_patcher.stop()
+        self.index_patcher.stop()
+        self.state_writer_patcher.stop()
 
     def test_add_message(self):
         formatter = Mock()
         formatter.format.return_value = {'message': 'the message', 'timestamp': TIMESTAMP}
 
         mailbox = Mailbox('maildir', '/mail/box', formatter=formatter)
-        mailbox.add('message_entity')
+        mailbox.add(MESSAGE)
 
-        formatter.format.assert_called_with('message_entity')
+        formatter.format.assert_called_with(MESSAGE, lazy=True)
         self.mock_maildir.add.assert_called_with('the message')
 
+    def test_format_and_store_message(self):
+        formatter = Mock()
+        formatter.format.return_value = {'message': 'the message', 'timestamp': TIMESTAMP}
+
+        mailbox = Mailbox('maildir', '/mail/box', formatter=formatter)
+        formatted = mailbox.format('message_entity')
+        self.mock_maildir.add.assert_not_called()
+
+        self.assertEqual(mailbox.store(formatted), TIMESTAMP)
+        self.mock_maildir.add.assert_called_with('the message')
+
+    @patch('gmailsync.mailbox.ShardedMaildir')
+    def test_add_message_to_sharded_maildir(self, mock_sharded):
+        formatter = Mock()
+        formatter.format.return_value = {'message': b'the message', 'timestamp': TIMESTAMP}
+        mock_sharded.return_value.add.return_value = '2018.08/key1'
+
+        mailbox = Mailbox('maildir', '/mail/box', formatter=formatter, maildir_shards='month', maildir_shard_size=10)
+        mailbox.add(MESSAGE)
+
+        mock_sharded.assert_called_once_with('/mail/box', shards='month', shard_size=10, durability='batch',
+                                             compressor=None)
+        mock_sharded.return_value.add.assert_called_once_with(b'the message', timestamp=TIMESTAMP, msg_id='msg_id1')
+        self.mock_index.add.assert_called_once_with('msg_id1', '2018.08/key1', len(b'the message'), TIMESTAMP)
+
+    def test_move_attachments_to_blob_store(self):
+        formatter = Mock()
+        formatter.format.return_value = {'message': b'the message', 'timestamp': TIMESTAMP}
+        blob_store = Mock()
+        blob_store.split.return_value = b'the split message'
+
+        mailbox = Mailbox('maildir', '/mail/box', formatter=formatter, blob_store=blob_store)
+        mailbox.add(MESSAGE)
+
+        formatter.format.assert_called_with(MESSAGE, lazy=False)
+        blob_store.split.assert_called_once_with(b'the message')
+        self.mock_maildir.add.assert_called_with(b'the split message')
+        self.mock_index.add.assert_called_once_with('msg_id1', ANY, len(b'the message'), TIMESTAMP)
+
+    def test_link_message_stored_in_another_mailbox(self):
+        formatter = Mock()
+        formatter.format.return_value = {'message': b'the message', 'timestamp': TIMESTAMP}
+        linker = Mock()
+        linker.find.return_value = '/mail/other/new/key0'
+        self.mock_maildir.add.return_value = 'key1'
+
+        mailbox = Mailbox('maildir', '/mail/box', formatter=formatter, linker=linker)
+        mailbox.add(MESSAGE)
+
+        linker.find.assert_called_once_with('msg_id1', group=None)
+        self.mock_maildir.add.assert_called_with(b'the message', source='/mail/other/new/key0')
+        linker.register.assert_called_once_with('msg_id1', self.mock_maildir, 'key1', group=None)
+
+    def test_register_stored_message_in_index(self):
+        formatter = Mock()
+        formatter.format.return_value = {'message': b'the message', 'timestamp': TIMESTAMP}
+        self.mock_maildir.add.return_value = 'key1'
+
+        mailbox = Mailbox('maildir', '/mail/box', formatter=formatter)
+        mailbox.add(MESSAGE)
+
+        self.mock_index.add.assert_called_once_with('msg_id1', 'key1', len(b'the message'), TIMESTAMP)
+        self.mock_index.commit.assert_not_called()
+
+        self.mock_state_writer.dirty = True
+        mailbox.flush()
+        self.mock_index.commit.assert_called_once()
+
+    def test_contains(self):
+        self.mock_index.__contains__ = Mock(side_effect=lambda msg_id: msg_id == 'msg_id1')
+
+        mailbox = Mailbox('maildir', '/mail/box')
+
+        self.assertTrue(mailbox.contains('msg_id1'))
+        self.assertFalse(mailbox.contains('msg_id2'))
+
+    def test_add_message_returns_timestamp(self):
+        formatter = Mock()
+        formatter.format.return_value = {'message': 'the message', 'timestamp': TIMESTAMP}
+
+        mailbox = Mailbox('maildir', '/mail/box', formatter=formatter)
+        self.assertEqual(mailbox.add(MESSAGE), TIMESTAMP)
+
+    def test_advance_window(self):
+        mailbox = Mailbox('maildir', '/mail/box')
+        mailbox.state = TIMESTAMP
+        window = mailbox.open_window(TIMESTAMP - 1000)
+
+        self.mock_state_writer.changed.return_value = True
+        with self._verify_state_saved('/mail/box', TIMESTAMP, windows=[[TIMESTAMP - 1000, TIMESTAMP - 10]]):
+            mailbox.advance_window(window, TIMESTAMP - 10)
+        self.assertEqual(window.before, TIMESTAMP - 10)
+        self.mock_state_writer.changed.assert_called_once_with(0)
+
+    def test_open_windows(self):
+        mailbox = Mailbox('maildir', '/mail/box')
+
+        self.assertFalse(mailbox.is_backfilled())
+
+        with self._verify_state_saved('/mail/box', None, windows=[[TIMESTAMP, None], [None, TIMESTAMP]],
+                                      backfilled=True):
+            windows = mailbox.open_windows([(TIMESTAMP, None), (None, TIMESTAMP)])
+        self.assertEqual(mailbox.get_pending_windows(), [windows[1], windows[0]])
+        self.assertTrue(mailbox.is_backfilled())
+
+    def test_close_window(self):
+        mailbox = Mailbox('maildir', '/mail/box')
+        mailbox.state = TIMESTAMP
+        window = mailbox.open_window(TIMESTAMP)
+        self.assertEqual(mailbox.get_pending_windows(), [window])
+
+        with self._verify_state_saved('/mail/box', TIMESTAMP):
+            mailbox.close_window(window)
+        self.assertEqual(mailbox.get_pending_windows(), [])
+
     def test_update_state_after_adding_first_message(self):
         formatter = Mock()
         formatter.format.return_value = {'message': 'the message', 'timestamp': TIMESTAMP}
 
         mailbox = Mailbox('maildir', '/mail/box', formatter=formatter)
+        self.mock_state_writer.changed.return_value = True
 
         with self._verify_state_saved('/mail/box', TIMESTAMP):
-            mailbox.add('message_entity')
+            mailbox.add(MESSAGE)
         self.assertEqual(mailbox.get_last_timestamp(), TIMESTAMP)
 
     def test_update_state_after_adding_a_more_recent_message(self):
@@ -94,12 +281,47 @@ class MailboxOperationsTestCase(unittest.TestCase):
 
         mailbox = Mailbox('maildir', '/mail/box', formatter=formatter)
         mailbox.state = TIMESTAMP
+        self.mock_state_writer.changed.return_value = True
 
         with self._verify_state_saved('/mail/box', timestamp2):
-            mailbox.add('message_entity')
+            mailbox.add(MESSAGE)
 
         self.assertEqual(mailbox.get_last_timestamp(), timestamp2)
 
+    def test_write_state_only_in_checkpoints(self):
+        formatter = Mock()
+        formatter.format.return_value = {'message': 'the message', 'timestamp': TIMESTAMP}
+
+        mailbox = Mailbox('maildir', '/mail/box', formatter=formatter, checkpoint_messages=10, checkpoint_interval=2,
+                          fsync_state=True)
+        mailbox.add(MESSAGE)
+
+        self.mock_state_writer_class.assert_called_once_with('/mail/box/.gmailsyncstate', checkpoint_messages=10,
+                                                             checkpoint_interval=2, fsync=True)
+        self.mock_state_writer.changed.assert_called_once_with(1)
+        self.mock_state_writer.write.assert_not_called()
+
+    def test_flush_pending_changes(self):
+        mailbox = Mailbox('maildir', '/mail/box')
+        mailbox.state = TIMESTAMP
+
+        mailbox.flush()
+        self.mock_state_writer.write.assert_not_called()
+
+        self.mock_state_writer.dirty = True
+        with self._verify_state_saved('/mail/box', TIMESTAMP):
+            mailbox.flush()
+
+    def test_close(self):
+        mailbox = Mailbox('maildir', '/mail/box')
+        mailbox.state = TIMESTAMP
+        self.mock_state_writer.dirty = True
+
+        with self._verify_state_saved('/mail/box', TIMESTAMP):
+            mailbox.close()
+        self.mock_maildir.close.assert_called_once_with()
+        self.mock_index.close.assert_called_once_with()
+
     def test_get_last_timestamp_from_state_file(self):
         mock_file = MagicMock()
         mock_file.read.return_value = str(TIMESTAMP)
@@ -113,6 +335,20 @@ class MailboxOperationsTestCase(unittest.TestCase):
         self.mock_open.assert_called_once_with('/mail/box/.gmailsyncstate', 'r')
         mock_file.read.assert_called()
 
+    def test_load_state_with_pending_windows(self):
+        mock_file = MagicMock()
+        mock_file.read.return_value = json.dumps({'timestamp': TIMESTAMP, 'windows': [[None, TIMESTAMP - 100]]})
+        self.mock_open.return_value.__enter__.return_value = mock_file
+        self.mock_isfile.return_value = True
+
+        mailbox = Mailbox('maildir', '/mail/box')
+        windows = mailbox.get_pending_windows()
+
+        self.assertEqual(mailbox.get_last_timestamp(), TIMESTAMP)
+        self.assertEqual(len(windows), 1)
+        self.assertIsNone(windows[0].after)
+        self.assertEqual(windows[0].before, TIMESTAMP - 100)
+
     def test_get_last_timestamp_if_state_file_does_not_exist(self):
         self.mock_isfile.return_value = False
 
@@ -127,10 +363,12 @@ class MailboxOperationsTestCase(unittest.TestCase):
         self.assertEqual('Mailbox </mail/box>', str(mailbox))
 
     @contextlib.contextmanager
-    def _verify_state_saved(self, path, timestamp):
-        state_path = os.path.join(path, '.gmailsyncstate')
-        mock_file = MagicMock()
-        self.mock_open.return_value.__enter__.return_value = mock_file
+    def _verify_state_saved(self, path, timestamp, windows=None, backfilled=False):
+        self.mock_state_writer.write.reset_mock()
         yield
-        self.mock_open.assert_called_with(state_path, 'w')
-        mock_file.write.assert_called_once_with(str(timestamp))
+        state = {'timestamp': timestamp}
+        if windows:
+            state['windows'] = windows
+        if backfilled:
+            state['backfilled'] = True
+        self.mock_state_writer.write.assert_called_once_with(state)
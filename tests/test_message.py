@@ -3,7 +3,7 @@ from unittest.mock import patch
 import base64
 import datetime
 
-from gmailsync.message import MessageFormatter
+from gmailsync.message import MessageFormatter, EncodedMessage
 
 
 MAIL_MESSAGE = b'From: John Doe <jdoe@machine.example>\r\n' \
@@ -45,6 +45,25 @@ class MessageFormatterTestCase(unittest.TestCase):
         expected = {'message': MAIL_MESSAGE, 'timestamp': TIMESTAMP}
         self.assertEqual(formatted, expected)
 
+    def test_format_decoded_message(self):
+        message = {'id': 'id1', 'decoded': MAIL_MESSAGE, 'internalDate': str(TIMESTAMP * 1000), 'labelIds': []}
+        formatted = self.formatter.format(message)
+        expected = {'message': MAIL_MESSAGE, 'timestamp': TIMESTAMP}
+        self.assertEqual(formatted, expected)
+
+    def test_format_lazy_message(self):
+        message = self._create_message(MAIL_MESSAGE, DATE)
+        formatted = self.formatter.format(message, lazy=True)
+
+        self.assertIsInstance(formatted['message'], EncodedMessage)
+        self.assertEqual(formatted['message'].decode(), MAIL_MESSAGE)
+        self.assertEqual(formatted['timestamp'], TIMESTAMP)
+
+    def test_format_lazy_chat_message_is_decoded(self):
+        message = self._create_message(HANGOUTS_MESSAGE, DATE, 'CHAT')
+        formatted = self.formatter.format(message, lazy=True)
+        self.assertIsInstance(formatted['message'], bytes)
+
     def test_format_gtalk_message(self):
         message = self._create_message(GTALK_MESSAGE, DATE, 'CHAT')
         formatted = self.formatter.format(message)
@@ -89,3 +108,14 @@ class MessageFormatterTestCase(unittest.TestCase):
             'internalDate': str(int(date.timestamp()) * 1000),
             'labelIds': labels,
         }
+
+
+class EncodedMessageTestCase(unittest.TestCase):
+
+    def test_decode_by_chunks(self):
+        for data in (MAIL_MESSAGE, MAIL_MESSAGE[:-1], MAIL_MESSAGE[:-2]):
+            message = EncodedMessage(base64.urlsafe_b64encode(data).decode('ASCII'))
+
+            self.assertEqual(b''.join(message.chunks(size=8)), data)
+            self.assertEqual(message.decode(), data)
+            self.assertEqual(len(message), len(data))
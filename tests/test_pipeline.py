@@ -0,0 +1,114 @@
+import unittest
+import threading
+
+from gmailsync.pipeline import ByteBudget, Pipeline
+
+
+class ByteBudgetTestCase(unittest.TestCase):
+
+    def test_acquire_and_release(self):
+        budget = ByteBudget(100)
+        budget.acquire(60)
+        budget.acquire(40)
+        self.assertEqual(budget.used, 100)
+        budget.release(60)
+        self.assertEqual(budget.used, 40)
+
+    def test_block_until_released(self):
+        budget = ByteBudget(100)
+        budget.acquire(80)
+
+        acquired = threading.Event()
+
+        def acquire():
+            budget.acquire(50)
+            acquired.set()
+
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        self.assertFalse(acquired.wait(timeout=0.2))
+
+        budget.release(80)
+        self.assertTrue(acquired.wait(timeout=5))
+        thread.join()
+
+    def test_item_larger_than_budget(self):
+        budget = ByteBudget(100)
+        budget.acquire(500)
+        self.assertEqual(budget.used, 500)
+
+    def test_abort(self):
+        budget = ByteBudget(100)
+        budget.acquire(100)
+        abort = threading.Event()
+        abort.set()
+        budget.acquire(50, abort=abort)
+        self.assertEqual(budget.used, 100)
+
+
+class PipelineTestCase(unittest.TestCase):
+
+    def test_process_items_in_order(self):
+        results = []
+        with Pipeline([lambda x: x * 2, lambda x: x + 1, results.append], max_bytes=10) as pipeline:
+            for i in range(100):
+                pipeline.put(i, size=1)
+
+        self.assertEqual(results, [i * 2 + 1 for i in range(100)])
+        self.assertEqual(pipeline.budget.used, 0)
+
+    def test_backpressure(self):
+        release = threading.Event()
+        results = []
+
+        def slow_stage(item):
+            release.wait(timeout=5)
+            results.append(item)
+
+        pipeline = Pipeline([slow_stage], max_bytes=10)
+        pipeline.put('a', size=6)
+        pipeline.put('b', size=4)
+
+        blocked = threading.Thread(target=pipeline.put, args=('c', 1))
+        blocked.start()
+        blocked.join(timeout=0.2)
+        self.assertTrue(blocked.is_alive())
+
+        release.set()
+        blocked.join(timeout=5)
+        pipeline.close()
+        self.assertEqual(results, ['a', 'b', 'c'])
+
+    def test_stage_error_raised_in_close(self):
+        def fail(item):
+            raise OSError('disk full')
+
+        pipeline = Pipeline([fail], max_bytes=10)
+        pipeline.put('a', size=1)
+        with self.assertRaisesRegex(OSError, 'disk full'):
+            pipeline.close()
+        self.assertEqual(pipeline.budget.used, 0)
+
+    def test_stage_error_raised_in_put(self):
+        failed = threading.Event()
+
+        def fail(item):
+            failed.set()
+            raise OSError('disk full')
+
+        pipeline = Pipeline([fail], max_bytes=10)
+        pipeline.put('a')
+        failed.wait(timeout=5)
+
+        with self.assertRaisesRegex(OSError, 'disk full'):
+            for _ in range(100):
+                pipeline.put('b')
+        pipeline.abort()
+
+    def test_abort_on_error_in_context(self):
+        results = []
+        with self.assertRaisesRegex(ValueError, 'producer failed'):
+            with Pipeline([results.append], max_bytes=10) as pipeline:
+                raise ValueError('producer failed')
+        for thread in pipeline._threads:
+            self.assertFalse(thread.is_alive())
@@ -0,0 +1,82 @@
+import unittest
+from unittest.mock import Mock, patch
+
+from tests.utils import FakeClock
+
+from gmailsync.ratelimit import RateLimiter, MIN_RATE, RATE_INCREASE
+
+
+class RateLimiterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.mock_time = Mock(monotonic=self.clock.monotonic, sleep=Mock(side_effect=self.clock.sleep))
+
+        time_patcher = patch('gmailsync.ratelimit.time', self.mock_time)
+        rand_patcher = patch('gmailsync.ratelimit.secrets.SystemRandom', return_value=Mock(uniform=lambda a, b: 0))
+        log_patcher = patch('gmailsync.ratelimit.log')
+
+        self.addCleanup(time_patcher.stop)
+        self.addCleanup(rand_patcher.stop)
+        self.addCleanup(log_patcher.stop)
+
+        time_patcher.start()
+        rand_patcher.start()
+        log_patcher.start()
+
+    def test_burst_up_to_capacity(self):
+        limiter = RateLimiter(rate=100)
+        for _ in range(20):
+            limiter.acquire(5)
+        self.mock_time.sleep.assert_not_called()
+
+    def test_wait_when_bucket_is_empty(self):
+        limiter = RateLimiter(rate=100)
+        limiter.acquire(100)
+        limiter.acquire(50)
+        self.mock_time.sleep.assert_called_once_with(0.5)
+
+    def test_refill(self):
+        limiter = RateLimiter(rate=100)
+        limiter.acquire(100)
+        self.clock.now += 1
+        limiter.acquire(100)
+        self.mock_time.sleep.assert_not_called()
+
+    def test_request_larger_than_capacity(self):
+        limiter = RateLimiter(rate=100)
+        limiter.acquire(250)
+        self.mock_time.sleep.assert_called_once_with(1.5)
+
+    def test_throttled_with_retry_after(self):
+        limiter = RateLimiter(rate=100)
+        limiter.throttled(retry_after=10)
+        self.assertEqual(limiter.rate, 50)
+
+        limiter.acquire(25)
+        self.mock_time.sleep.assert_called_once_with(10.5)
+
+    def test_throttled_without_retry_after(self):
+        limiter = RateLimiter(rate=100)
+        limiter.throttled()
+        limiter.throttled()
+        self.assertEqual(limiter.rate, 25)
+
+        limiter.acquire(0)
+        self.mock_time.sleep.assert_called_once_with(4)
+
+    def test_min_rate(self):
+        limiter = RateLimiter(rate=100)
+        for _ in range(10):
+            limiter.throttled(retry_after=0)
+        self.assertEqual(limiter.rate, MIN_RATE)
+
+    def test_additive_increase(self):
+        limiter = RateLimiter(rate=100)
+        limiter.throttled(retry_after=0)
+        limiter.success()
+        self.assertEqual(limiter.rate, 50 + RATE_INCREASE)
+
+        for _ in range(100):
+            limiter.success()
+        self.assertEqual(limiter.rate, 100)
@@ -0,0 +1,70 @@
+import unittest
+from unittest.mock import patch
+import json
+import os
+import tempfile
+
+from tests.utils import FakeClock
+
+from gmailsync.state import StateWriter
+
+
+class StateWriterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.dir = tmp_dir.name
+        self.path = os.path.join(self.dir, '.gmailsyncstate')
+
+        self.clock = FakeClock()
+        patcher_time = patch('gmailsync.state.time', self.clock)
+        self.addCleanup(patcher_time.stop)
+        patcher_time.start()
+
+    def test_checkpoint_every_n_messages(self):
+        writer = StateWriter(self.path, checkpoint_messages=3, checkpoint_interval=60)
+
+        self.assertFalse(writer.changed())
+        self.assertFalse(writer.changed())
+        self.assertTrue(writer.changed())
+        self.assertTrue(writer.dirty)
+
+        writer.write({'timestamp': 1})
+        self.assertFalse(writer.dirty)
+        self.assertFalse(writer.changed())
+
+    def test_checkpoint_every_interval(self):
+        writer = StateWriter(self.path, checkpoint_messages=100, checkpoint_interval=5)
+
+        self.assertFalse(writer.changed())
+        self.clock.sleep(5)
+        self.assertTrue(writer.changed(messages=0))
+
+    def test_write_atomically(self):
+        writer = StateWriter(self.path)
+        writer.write({'timestamp': 1})
+        writer.write({'timestamp': 2})
+
+        with open(self.path) as f:
+            self.assertEqual(json.load(f), {'timestamp': 2})
+        self.assertEqual(os.listdir(self.dir), ['.gmailsyncstate'])
+
+    def test_keep_previous_state_if_write_fails(self):
+        writer = StateWriter(self.path)
+        writer.write({'timestamp': 1})
+
+        with self.assertRaises(TypeError):
+            writer.write({'timestamp': object()})
+
+        with open(self.path) as f:
+            self.assertEqual(json.load(f), {'timestamp': 1})
+        self.assertEqual(os.listdir(self.dir), ['.gmailsyncstate'])
+
+    @patch('gmailsync.utils.os.fsync')
+    def test_fsync(self, mock_fsync):
+        writer = StateWriter(self.path, fsync=True)
+        writer.write({'timestamp': 1})
+
+        # The file and its directory
+        self.assertEqual(mock_fsync.call_count, 2)
@@ -1,17 +1,51 @@
 import unittest
-from unittest.mock import Mock, patch, call
+import tempfile
+import threading
+from unittest.mock import Mock, ANY, patch, call
 
-from gmailsync.sync import Synchronizer
+from tests.utils import FakeClock
+
+from gmailsync.sync import Synchronizer, FetchQueue, WindowProgress, RetryQueue, backfill_bounds
 from gmailsync.channel import Channel
+from gmailsync.client import HistoryExpired
+from gmailsync.mailbox import Mailbox, SyncWindow
 
 
 CHANNEL1_NAME = 'channel1'
 QUERY1 = 'query1'
-TIMESTAMP1 = 'timestamp1'
+TIMESTAMP1 = 1577060763
 
 CHANNEL2_NAME = 'channel2'
 QUERY2 = 'query2'
-TIMESTAMP2 = 'timestamp1'
+TIMESTAMP2 = 1577060800
+
+
+def desc(n, size=None):
+    msg_desc = {'id': 'msg_id{}'.format(n)}
+    if size is not None:
+        msg_desc['sizeEstimate'] = size
+    return msg_desc
+
+
+def msg(n):
+    return {'id': 'msg_id{}'.format(n), 'raw': 'raw{}'.format(n), 'internalDate': str((TIMESTAMP1 + n) * 1000)}
+
+
+def create_mailbox(timestamp):
+    mailbox = Mock()
+    mailbox.get_last_timestamp.return_value = timestamp
+    mailbox.get_pending_windows.return_value = []
+    mailbox.open_window.side_effect = lambda after: SyncWindow(after)
+    mailbox.format.side_effect = lambda message: {'message': message,
+                                                  'timestamp': int(message['internalDate']) // 1000}
+    mailbox.store.side_effect = lambda formatted, msg_id=None: formatted['timestamp']
+    mailbox.contains.return_value = False
+    mailbox.is_backfilled.return_value = False
+    return mailbox
+
+
+def stored_messages(mailbox):
+    return [c[0][0]['message'] for c in mailbox.store.call_args_list]
 
 
 class SynchronizerTestCase(unittest.TestCase):
@@ -19,54 +53,674 @@ class SynchronizerTestCase(unittest.TestCase):
     def setUp(self):
         self.client = Mock()
 
-        self.mailbox1 = Mock()
-        self.mailbox1.get_last_timestamp.return_value = TIMESTAMP1
+        self.mailbox1 = create_mailbox(TIMESTAMP1)
         self.channel1 = Channel(CHANNEL1_NAME, self.mailbox1, QUERY1)
 
-        self.mailbox2 = Mock()
-        self.mailbox2.get_last_timestamp.return_value = TIMESTAMP2
+        self.mailbox2 = create_mailbox(TIMESTAMP2)
         self.channel2 = Channel(CHANNEL2_NAME, self.mailbox2, QUERY2)
 
-        patcher_sleep = patch('gmailsync.sync.time.sleep', return_value=None)
+        self.clock = FakeClock()
+        patcher_time = patch('gmailsync.sync.time', self.clock)
         patcher_rand = patch('gmailsync.sync.secrets.SystemRandom', return_value=Mock(uniform=lambda a, b: 0))
 
-        self.addCleanup(patcher_sleep.stop)
+        self.addCleanup(patcher_time.stop)
         self.addCleanup(patcher_rand.stop)
 
-        self.mock_sleep = patcher_sleep.start()
+        patcher_time.start()
         self.mock_rand = patcher_rand.start()
 
+    def test_sync_channel_on_its_own(self):
+        self.client.list.return_value = [desc(2), desc(1)]
+        self.client.fetch.return_value = ([msg(2), msg(1)], [])
+
+        synchronizer = Synchronizer(self.client, [self.channel1])
+        synchronizer.sync_channel(self.channel1)
+
+        self.assertEqual(stored_messages(self.mailbox1), [msg(2), msg(1)])
+        # The workers are stopped once the channel is synchronized
+        self.assertIsNone(synchronizer._executor)
+
+    def test_sync_shared_on_its_own(self):
+        self.client.list.return_value = [desc(1)]
+        self.client.fetch.return_value = ([msg(1)], [])
+
+        synchronizer = Synchronizer(self.client, [self.channel1, self.channel2], routing='shared')
+        synchronizer.sync_shared()
+
+        self.assertEqual(stored_messages(self.mailbox1), [msg(1)])
+        self.assertEqual(stored_messages(self.mailbox2), [msg(1)])
+
     def test_sync_one_channel(self):
-        self.client.list.return_value = ['msg_id1', 'msg_id2', 'msg_id3']
-        self.client.fetch.return_value = ['msg3', 'msg2', 'msg1']
+        self.client.list.return_value = [desc(3), desc(2), desc(1)]
+        self.client.fetch.return_value = ([msg(3), msg(2), msg(1)], [])
 
         synchronizer = Synchronizer(self.client, [self.channel1])
         synchronizer.sync()
 
-        self.client.list.assert_called_with(query=QUERY1, since=TIMESTAMP1)
-        self.client.fetch.assert_called_with(('msg_id3', 'msg_id2', 'msg_id1'))
-        self.mailbox1.add.assert_has_calls([call('msg3'), call('msg2'), call('msg1')])
+        self.client.list.assert_called_with(query=QUERY1, since=TIMESTAMP1, until=None)
+        self.client.fetch.assert_called_with((desc(3), desc(2), desc(1)))
+        self.assertEqual(stored_messages(self.mailbox1), [msg(3), msg(2), msg(1)])
 
     def test_sync_multiple_mailboxes(self):
-        self.client.list.side_effect = [['msg_id1', 'msg_id2', 'msg_id3'], ['msg_id4', 'msg_id5']]
-        self.client.fetch.side_effect = [['msg3', 'msg2', 'msg1'], ['msg5', 'msg4']]
+        self.client.list.side_effect = [[desc(3), desc(2), desc(1)], [desc(5), desc(4)]]
+        self.client.fetch.side_effect = [([msg(3), msg(2), msg(1)], []), ([msg(5), msg(4)], [])]
 
         synchronizer = Synchronizer(self.client, [self.channel1, self.channel2])
         synchronizer.sync()
 
-        self.client.list.assert_has_calls([call(query=QUERY1, since=TIMESTAMP1), call(query=QUERY2, since=TIMESTAMP2)])
-        self.client.fetch.assert_has_calls([call(('msg_id3', 'msg_id2', 'msg_id1')), call(('msg_id5', 'msg_id4'))])
-        self.mailbox1.add.assert_has_calls([call('msg3'), call('msg2'), call('msg1')])
-        self.mailbox2.add.assert_has_calls([call('msg5'), call('msg4')])
+        self.client.list.assert_has_calls([
+            call(query=QUERY1, since=TIMESTAMP1, until=None), call(query=QUERY2, since=TIMESTAMP2, until=None)
+        ])
+        self.client.fetch.assert_has_calls([call((desc(3), desc(2), desc(1))), call((desc(5), desc(4)))])
+        self.assertEqual(stored_messages(self.mailbox1), [msg(3), msg(2), msg(1)])
+        self.assertEqual(stored_messages(self.mailbox2), [msg(5), msg(4)])
+
+    @patch('gmailsync.sync.CHUNK_SIZE', 2)
+    def test_flush_state_after_each_batch(self):
+        self.client.list.return_value = [desc(3), desc(2), desc(1)]
+        self.client.fetch.side_effect = [([msg(3), msg(2)], []), ([msg(1)], [])]
+
+        synchronizer = Synchronizer(self.client, [self.channel1])
+        synchronizer.sync()
+
+        # One per batch and one at the end of the synchronization
+        self.assertEqual(self.mailbox1.flush.call_count, 3)
+
+    def test_flush_state_if_synchronization_fails(self):
+        self.client.list.return_value = [desc(1)]
+        self.client.fetch.return_value = ([msg(1)], [])
+        self.mailbox1.close_window.side_effect = OSError()
+
+        synchronizer = Synchronizer(self.client, [self.channel1, self.channel2])
+        with self.assertRaises(OSError):
+            synchronizer.sync()
+
+        self.mailbox1.flush.assert_called()
+        self.mailbox2.flush.assert_called_once()
+        self.mailbox1.close.assert_called_once()
+        self.mailbox2.close.assert_called_once()
+
+    def test_skip_messages_already_stored(self):
+        self.mailbox1.contains.side_effect = lambda msg_id: msg_id == 'msg_id1'
+        self.client.list.return_value = [desc(3), desc(2), desc(1)]
+        self.client.fetch.return_value = ([msg(3), msg(2)], [])
+
+        synchronizer = Synchronizer(self.client, [self.channel1])
+        synchronizer.sync()
+
+        self.client.fetch.assert_called_once_with((desc(3), desc(2)))
+        self.mailbox1.store.assert_has_calls([call(ANY, msg_id='msg_id3'), call(ANY, msg_id='msg_id2')])
 
     @patch('gmailsync.sync.CHUNK_SIZE', 2)
     def test_fetch_messages_in_chunks(self):
-        self.client.list.return_value = ['msg_id1', 'msg_id2', 'msg_id3']
-        self.client.fetch.side_effect = [['msg3', 'msg2'], ['msg1']]
+        self.client.list.return_value = [desc(3), desc(2), desc(1)]
+        self.client.fetch.side_effect = [([msg(3), msg(2)], []), ([msg(1)], [])]
+
+        synchronizer = Synchronizer(self.client, [self.channel1])
+        synchronizer.sync()
+
+        self.client.list.assert_called_with(query=QUERY1, since=TIMESTAMP1, until=None)
+        self.client.fetch.assert_has_calls([call((desc(3), desc(2))), call((desc(1),))])
+        self.assertEqual(stored_messages(self.mailbox1), [msg(3), msg(2), msg(1)])
+
+    def test_pack_batches_by_size(self):
+        sizes = {'msg_id4': 100, 'msg_id3': 950, 'msg_id2': 200, 'msg_id1': 300}
+
+        def estimate_sizes(msg_descs):
+            for msg_desc in msg_descs:
+                msg_desc['sizeEstimate'] = sizes[msg_desc['id']]
+
+        self.client.list.return_value = [desc(4), desc(3), desc(2), desc(1)]
+        self.client.estimate_sizes.side_effect = estimate_sizes
+        self.client.fetch.side_effect = [([msg(4)], []), ([msg(3)], []), ([msg(2), msg(1)], [])]
+
+        synchronizer = Synchronizer(self.client, [self.channel1], batch_max_bytes=1000)
+        synchronizer.sync()
+
+        self.client.fetch.assert_has_calls([
+            call((desc(4, 100),)), call((desc(3, 950),)), call((desc(2, 200), desc(1, 300)))
+        ])
+        self.assertEqual(stored_messages(self.mailbox1), [msg(4), msg(3), msg(2), msg(1)])
+
+    def test_fetch_messages_if_sizes_cannot_be_estimated(self):
+        self.client.list.return_value = [desc(2), desc(1)]
+        self.client.estimate_sizes.side_effect = OSError()
+        self.client.fetch.return_value = ([msg(2), msg(1)], [])
+
+        synchronizer = Synchronizer(self.client, [self.channel1], batch_max_bytes=1000)
+        with patch('gmailsync.sync.log'):
+            synchronizer.sync()
+
+        self.client.fetch.assert_called_once_with((desc(2), desc(1)))
+
+    def test_fetch_big_messages_on_their_own(self):
+        sizes = {'msg_id3': 100, 'msg_id2': 5000, 'msg_id1': 100}
+        small_stored = threading.Event()
+
+        def estimate_sizes(msg_descs):
+            for msg_desc in msg_descs:
+                msg_desc['sizeEstimate'] = sizes[msg_desc['id']]
+
+        def fetch_one(msg_desc):
+            # The big message is fetched after the small ones are stored: they do not wait for it
+            small_stored.wait(timeout=5)
+            return [msg(2)], []
+
+        def store(formatted, msg_id=None):
+            if msg_id == 'msg_id1':
+                small_stored.set()
+            return formatted['timestamp']
+
+        self.client.list.return_value = [desc(3), desc(2), desc(1)]
+        self.client.estimate_sizes.side_effect = estimate_sizes
+        self.client.fetch.return_value = ([msg(3), msg(1)], [])
+        self.client.fetch_one.side_effect = fetch_one
+        self.mailbox1.store.side_effect = store
+
+        synchronizer = Synchronizer(self.client, [self.channel1], large_message_size=1000)
+        synchronizer.sync()
+
+        self.client.fetch.assert_called_once_with((desc(3, 100), desc(1, 100)))
+        self.client.fetch_one.assert_called_once_with(desc(2, 5000))
+        self.assertEqual(stored_messages(self.mailbox1), [msg(3), msg(1), msg(2)])
+        # The window only advances past the big message once it is stored
+        self.mailbox1.advance_window.assert_has_calls([call(ANY, TIMESTAMP1 + 3), call(ANY, TIMESTAMP1 + 1)])
+        self.mailbox1.close_window.assert_called_once()
+
+    def test_do_not_estimate_sizes_without_byte_budget(self):
+        self.client.list.return_value = [desc(1)]
+        self.client.fetch.return_value = ([msg(1)], [])
 
         synchronizer = Synchronizer(self.client, [self.channel1])
         synchronizer.sync()
 
-        self.client.list.assert_called_with(query=QUERY1, since=TIMESTAMP1)
-        self.client.fetch.assert_has_calls([call(('msg_id3', 'msg_id2')), call(('msg_id1',))])
-        self.mailbox1.add.assert_has_calls([call('msg3'), call('msg2'), call('msg1')])
+        self.client.estimate_sizes.assert_not_called()
+
+    def test_retry_only_failed_messages(self):
+        self.client.list.return_value = [desc(3), desc(2), desc(1)]
+        self.client.fetch.side_effect = [([msg(3), msg(1)], [desc(2)]), ([msg(2)], [])]
+
+        synchronizer = Synchronizer(self.client, [self.channel1])
+        synchronizer.sync()
+
+        self.client.fetch.assert_has_calls([call((desc(3), desc(2), desc(1))), call((desc(2),))])
+        self.assertEqual(stored_messages(self.mailbox1), [msg(3), msg(1), msg(2)])
+        self.assertEqual(self.clock.slept, [2])
+
+    def test_retry_whole_chunk_if_batch_fails(self):
+        self.client.list.return_value = [desc(2), desc(1)]
+        self.client.fetch.side_effect = [Exception('connection reset'), ([msg(2), msg(1)], [])]
+
+        synchronizer = Synchronizer(self.client, [self.channel1])
+        with patch('gmailsync.sync.log'):
+            synchronizer.sync()
+
+        self.client.fetch.assert_has_calls([call((desc(2), desc(1))), call((desc(2), desc(1)))])
+        self.assertEqual(stored_messages(self.mailbox1), [msg(2), msg(1)])
+
+    def test_give_up_after_max_attempts(self):
+        self.client.list.return_value = [desc(2), desc(1)]
+        self.client.fetch.side_effect = [([msg(1)], [desc(2)])] + [([], [desc(2)])] * 4
+
+        synchronizer = Synchronizer(self.client, [self.channel1])
+        with patch('gmailsync.sync.log'):
+            synchronizer.sync()
+
+        self.assertEqual(self.client.fetch.call_count, 5)
+        self.assertEqual(stored_messages(self.mailbox1), [msg(1)])
+        self.mailbox1.close_window.assert_called_once()
+
+    def test_advance_window_in_listing_order(self):
+        self.client.list.return_value = [desc(3), desc(2), desc(1)]
+        self.client.fetch.side_effect = [([msg(3), msg(1)], [desc(2)]), ([msg(2)], [])]
+
+        synchronizer = Synchronizer(self.client, [self.channel1])
+        synchronizer.sync()
+
+        window = self.mailbox1.close_window.call_args[0][0]
+        self.mailbox1.advance_window.assert_has_calls([
+            call(window, TIMESTAMP1 + 3),
+            call(window, TIMESTAMP1 + 1),
+        ])
+        self.assertEqual(self.mailbox1.advance_window.call_count, 2)
+
+    @patch('gmailsync.sync.CHUNK_SIZE', 1)
+    def test_concurrent_workers_keep_order(self):
+        fetched = threading.Event()
+
+        def fetch(chunk):
+            # The first chunk is fetched last
+            if chunk == (desc(3),):
+                fetched.wait(timeout=5)
+            else:
+                fetched.set()
+            return [msg(int(chunk[0]['id'][-1]))], []
+
+        self.client.list.return_value = [desc(3), desc(2), desc(1)]
+        self.client.fetch.side_effect = fetch
+
+        synchronizer = Synchronizer(self.client, [self.channel1], workers=3)
+        synchronizer.sync()
+
+        self.assertEqual(stored_messages(self.mailbox1), [msg(3), msg(2), msg(1)])
+        window = self.mailbox1.close_window.call_args[0][0]
+        self.mailbox1.advance_window.assert_has_calls([
+            call(window, TIMESTAMP1 + 3), call(window, TIMESTAMP1 + 2), call(window, TIMESTAMP1 + 1)
+        ])
+
+    def test_close_window_after_storing_all_messages(self):
+        self.client.list.return_value = [desc(2), desc(1)]
+        self.client.fetch.return_value = ([msg(2), msg(1)], [])
+
+        synchronizer = Synchronizer(self.client, [self.channel1])
+        synchronizer.sync()
+
+        self.mailbox1.open_window.assert_called_once_with(TIMESTAMP1)
+        window = self.mailbox1.close_window.call_args[0][0]
+        self.assertEqual(window.after, TIMESTAMP1)
+
+    def test_resume_pending_window(self):
+        pending = SyncWindow(after=TIMESTAMP1 - 1000, before=TIMESTAMP1 - 100)
+        self.mailbox1.get_pending_windows.return_value = [pending]
+        self.client.list.side_effect = [[desc(2), desc(1)], [desc(3)]]
+        self.client.fetch.side_effect = [([msg(2), msg(1)], []), ([msg(3)], [])]
+
+        synchronizer = Synchronizer(self.client, [self.channel1])
+        synchronizer.sync()
+
+        self.client.list.assert_has_calls([
+            call(query=QUERY1, since=TIMESTAMP1 - 1000, until=TIMESTAMP1 - 99),
+            call(query=QUERY1, since=TIMESTAMP1, until=None),
+        ])
+        self.mailbox1.advance_window.assert_has_calls([call(pending, TIMESTAMP1 + 2), call(pending, TIMESTAMP1 + 1)])
+        self.mailbox1.close_window.assert_any_call(pending)
+
+
+# 2006-03-15 UTC
+BACKFILL_NOW = 1142380800
+# 2005-01-01 and 2006-01-01 UTC
+YEAR_2005 = 1104537600
+YEAR_2006 = 1136073600
+
+
+class BackfillSynchronizerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = Mock()
+        self.mailbox = create_mailbox(None)
+        self.mailbox.open_windows.side_effect = lambda bounds: [SyncWindow(after, before) for after, before in bounds]
+        self.channel = Channel(CHANNEL1_NAME, self.mailbox, QUERY1, backfill='year')
+
+        self.clock = FakeClock(now=BACKFILL_NOW)
+        patcher_time = patch('gmailsync.sync.time', self.clock)
+        self.addCleanup(patcher_time.stop)
+        patcher_time.start()
+
+    def test_backfill_bounds_by_year(self):
+        self.assertEqual(backfill_bounds('year', BACKFILL_NOW), [
+            (YEAR_2006 - 1, None), (YEAR_2005 - 1, YEAR_2006 - 1), (None, YEAR_2005 - 1)
+        ])
+
+    def test_backfill_bounds_by_month(self):
+        bounds = backfill_bounds('month', BACKFILL_NOW)
+        # From February 2004 to March 2006, plus the window with all the previous messages
+        self.assertEqual(len(bounds), 27)
+        self.assertEqual(bounds[0], (1141171199, None))
+        self.assertEqual(bounds[-1], (None, 1075593599))
+
+    def test_backfill_windows_in_parallel(self):
+        listings = {
+            YEAR_2006 - 1: [desc(6), desc(5)],
+            YEAR_2005 - 1: [desc(4), desc(3)],
+            None: [desc(2), desc(1)],
+        }
+        self.client.list.side_effect = lambda query, since, until: iter(listings[since])
+        self.client.fetch.side_effect = lambda chunk: ([msg(int(msg_desc['id'][-1])) for msg_desc in chunk], [])
+
+        synchronizer = Synchronizer(self.client, [self.channel])
+        synchronizer.sync()
+
+        self.mailbox.open_windows.assert_called_once_with(
+            [(YEAR_2006 - 1, None), (YEAR_2005 - 1, YEAR_2006 - 1), (None, YEAR_2005 - 1)])
+        self.mailbox.open_window.assert_not_called()
+        self.client.list.assert_has_calls([
+            call(query=QUERY1, since=YEAR_2006 - 1, until=None),
+            call(query=QUERY1, since=YEAR_2005 - 1, until=YEAR_2006),
+            call(query=QUERY1, since=None, until=YEAR_2005),
+        ], any_order=True)
+        self.assertCountEqual(stored_messages(self.mailbox), [msg(n) for n in range(1, 7)])
+
+        # Each window only advances with its own messages
+        windows = [c[0][0] for c in self.mailbox.close_window.call_args_list]
+        self.assertEqual(len(windows), 3)
+        for window, n in zip(windows, (5, 3, 1)):
+            self.mailbox.advance_window.assert_any_call(window, TIMESTAMP1 + n)
+        self.assertEqual(self.mailbox.advance_window.call_count, 6)
+
+    def test_message_listed_by_several_windows(self):
+        listings = {
+            YEAR_2006 - 1: [desc(6), desc(4)],
+            YEAR_2005 - 1: [desc(4), desc(3)],
+            None: [],
+        }
+        self.client.list.side_effect = lambda query, since, until: iter(listings[since])
+        self.client.fetch.side_effect = lambda chunk: ([msg(int(msg_desc['id'][-1])) for msg_desc in chunk], [])
+
+        synchronizer = Synchronizer(self.client, [self.channel])
+        synchronizer.sync()
+
+        self.assertCountEqual(stored_messages(self.mailbox), [msg(3), msg(4), msg(6)])
+        self.assertEqual(self.mailbox.close_window.call_count, 3)
+
+    @patch('gmailsync.sync.BACKFILL_LISTERS', 1)
+    def test_message_listed_by_windows_listed_one_after_another(self):
+        listings = {
+            YEAR_2006 - 1: [desc(6), desc(4)],
+            YEAR_2005 - 1: [desc(4), desc(3)],
+            None: [desc(3), desc(2)],
+        }
+        self.client.list.side_effect = lambda query, since, until: iter(listings[since])
+        self.client.fetch.side_effect = lambda chunk: ([msg(int(msg_desc['id'][-1])) for msg_desc in chunk], [])
+
+        synchronizer = Synchronizer(self.client, [self.channel])
+        synchronizer.sync()
+
+        self.assertCountEqual(stored_messages(self.mailbox), [msg(2), msg(3), msg(4), msg(6)])
+
+    def test_backfill_empty_channel_once(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.client.list.side_effect = lambda query, since, until: iter([])
+
+        # Each run opens the mailbox again
+        channel = Channel(CHANNEL1_NAME, Mailbox('maildir', tmp_dir.name), QUERY1, backfill='month')
+        Synchronizer(self.client, [channel]).sync()
+        self.assertEqual(self.client.list.call_count, len(backfill_bounds('month', BACKFILL_NOW)))
+
+        self.client.list.reset_mock()
+        channel = Channel(CHANNEL1_NAME, Mailbox('maildir', tmp_dir.name), QUERY1, backfill='month')
+        Synchronizer(self.client, [channel]).sync()
+        self.client.list.assert_called_once_with(query=QUERY1, since=None, until=None)
+
+    def test_backfill_empty_channel_once_with_history(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.client.list.side_effect = lambda query, since, until: iter([])
+        self.client.profile.return_value = {'historyId': 'history1'}
+        self.client.history.return_value = (set(), 'history2')
+
+        for _ in range(2):
+            self.client.list.reset_mock()
+            channel = Channel(CHANNEL1_NAME, Mailbox('maildir', tmp_dir.name), QUERY1, sync_mode='history',
+                              backfill='month')
+            Synchronizer(self.client, [channel]).sync()
+
+        self.client.history.assert_called_once_with('history1')
+        self.client.list.assert_not_called()
+
+    def test_backfill_only_first_synchronization(self):
+        self.mailbox.get_last_timestamp.return_value = TIMESTAMP1
+        self.client.list.return_value = [desc(1)]
+        self.client.fetch.return_value = ([msg(1)], [])
+
+        synchronizer = Synchronizer(self.client, [self.channel])
+        synchronizer.sync()
+
+        self.mailbox.open_windows.assert_not_called()
+        self.mailbox.open_window.assert_called_once_with(TIMESTAMP1)
+
+    def test_resume_backfill_in_parallel(self):
+        pending = [SyncWindow(None, YEAR_2005 - 1), SyncWindow(YEAR_2005 - 1, YEAR_2006 - 100)]
+        self.mailbox.get_pending_windows.return_value = pending
+        self.mailbox.get_last_timestamp.return_value = TIMESTAMP1
+        self.client.list.side_effect = lambda query, since, until: iter([desc(2)] if since is None else [])
+        self.client.fetch.return_value = ([msg(2)], [])
+
+        synchronizer = Synchronizer(self.client, [self.channel])
+        synchronizer.sync()
+
+        self.assertEqual(stored_messages(self.mailbox), [msg(2)])
+        self.mailbox.advance_window.assert_called_once_with(pending[0], TIMESTAMP1 + 2)
+        self.mailbox.close_window.assert_has_calls([call(pending[0]), call(pending[1])])
+
+
+class HistorySynchronizerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = Mock()
+
+        self.mailbox = create_mailbox(TIMESTAMP1)
+        self.channel = Channel(CHANNEL1_NAME, self.mailbox, QUERY1, sync_mode='history')
+
+    def test_first_sync_saves_history_id(self):
+        self.mailbox.get_history_id.return_value = None
+        self.client.profile.return_value = {'historyId': 'history2'}
+        self.client.list.return_value = [desc(1)]
+        self.client.fetch.return_value = ([msg(1)], [])
+
+        synchronizer = Synchronizer(self.client, [self.channel])
+        synchronizer.sync()
+
+        self.client.history.assert_not_called()
+        self.client.list.assert_called_once_with(query=QUERY1, since=TIMESTAMP1, until=None)
+        self.assertEqual(stored_messages(self.mailbox), [msg(1)])
+        self.mailbox.set_history_id.assert_called_once_with('history2')
+
+    def test_no_changes(self):
+        self.mailbox.get_history_id.return_value = 'history1'
+        self.client.history.return_value = (set(), 'history2')
+
+        synchronizer = Synchronizer(self.client, [self.channel])
+        synchronizer.sync()
+
+        self.client.history.assert_called_once_with('history1')
+        self.client.list.assert_not_called()
+        self.client.fetch.assert_not_called()
+        self.mailbox.set_history_id.assert_called_once_with('history2')
+
+    def test_fetch_only_added_messages(self):
+        self.mailbox.get_history_id.return_value = 'history1'
+        self.client.history.return_value = ({'msg_id3', 'msg_id2'}, 'history2')
+        self.client.list.return_value = [desc(3), desc(2), desc(1)]
+        self.client.fetch.return_value = ([msg(3), msg(2)], [])
+
+        synchronizer = Synchronizer(self.client, [self.channel])
+        synchronizer.sync()
+
+        self.client.list.assert_called_once_with(query=QUERY1, since=TIMESTAMP1, until=None)
+        self.client.fetch.assert_called_once_with((desc(3), desc(2)))
+        self.mailbox.set_history_id.assert_called_once_with('history2')
+
+    def test_fall_back_to_query_if_history_expired(self):
+        self.mailbox.get_history_id.return_value = 'history1'
+        self.client.history.side_effect = HistoryExpired()
+        self.client.profile.return_value = {'historyId': 'history2'}
+        self.client.list.return_value = [desc(1)]
+        self.client.fetch.return_value = ([msg(1)], [])
+
+        synchronizer = Synchronizer(self.client, [self.channel])
+        synchronizer.sync()
+
+        self.client.list.assert_called_once_with(query=QUERY1, since=TIMESTAMP1, until=None)
+        self.assertEqual(stored_messages(self.mailbox), [msg(1)])
+        self.mailbox.set_history_id.assert_called_once_with('history2')
+
+
+class SharedRoutingSynchronizerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = Mock()
+
+        self.mailbox1 = create_mailbox(TIMESTAMP1)
+        self.channel1 = Channel(CHANNEL1_NAME, self.mailbox1, QUERY1)
+
+        self.mailbox2 = create_mailbox(TIMESTAMP1)
+        self.channel2 = Channel(CHANNEL2_NAME, self.mailbox2, QUERY2)
+
+    def test_fetch_shared_messages_once(self):
+        self.client.list.side_effect = [[desc(3), desc(2)], [desc(3), desc(1)]]
+        self.client.fetch.return_value = ([msg(3), msg(2), msg(1)], [])
+
+        synchronizer = Synchronizer(self.client, [self.channel1, self.channel2], routing='shared')
+        synchronizer.sync()
+
+        self.client.list.assert_has_calls([
+            call(query=QUERY1, since=TIMESTAMP1, until=None), call(query=QUERY2, since=TIMESTAMP1, until=None)
+        ])
+        self.client.fetch.assert_called_once_with((desc(3), desc(2), desc(1)))
+        self.assertEqual(stored_messages(self.mailbox1), [msg(3), msg(2)])
+        self.assertEqual(stored_messages(self.mailbox2), [msg(3), msg(1)])
+
+    def test_advance_each_window_in_its_listing_order(self):
+        window1 = SyncWindow(TIMESTAMP1)
+        window2 = SyncWindow(TIMESTAMP1)
+        self.mailbox1.open_window.side_effect = None
+        self.mailbox1.open_window.return_value = window1
+        self.mailbox2.open_window.side_effect = None
+        self.mailbox2.open_window.return_value = window2
+        self.client.list.side_effect = [[desc(3), desc(2)], [desc(3), desc(1)]]
+        self.client.fetch.return_value = ([msg(3), msg(2), msg(1)], [])
+
+        synchronizer = Synchronizer(self.client, [self.channel1, self.channel2], routing='shared')
+        synchronizer.sync()
+
+        self.mailbox1.advance_window.assert_has_calls([call(window1, TIMESTAMP1 + 3), call(window1, TIMESTAMP1 + 2)])
+        self.mailbox2.advance_window.assert_has_calls([call(window2, TIMESTAMP1 + 3), call(window2, TIMESTAMP1 + 1)])
+        self.mailbox1.close_window.assert_called_once_with(window1)
+        self.mailbox2.close_window.assert_called_once_with(window2)
+
+    def test_skip_missing_message_in_all_channels(self):
+        self.client.list.side_effect = [[desc(2)], [desc(2), desc(1)]]
+        self.client.fetch.return_value = ([msg(1)], [])
+
+        synchronizer = Synchronizer(self.client, [self.channel1, self.channel2], routing='shared')
+        synchronizer.sync()
+
+        self.assertEqual(stored_messages(self.mailbox1), [])
+        self.assertEqual(stored_messages(self.mailbox2), [msg(1)])
+        self.mailbox1.close_window.assert_called_once()
+        self.mailbox2.close_window.assert_called_once()
+
+    def test_history_without_changes(self):
+        channel = Channel(CHANNEL2_NAME, self.mailbox2, QUERY2, sync_mode='history')
+        self.mailbox2.get_history_id.return_value = 'history1'
+        self.client.history.return_value = (set(), 'history2')
+        self.client.list.return_value = [desc(1)]
+        self.client.fetch.return_value = ([msg(1)], [])
+
+        synchronizer = Synchronizer(self.client, [self.channel1, channel], routing='shared')
+        synchronizer.sync()
+
+        self.client.list.assert_called_once_with(query=QUERY1, since=TIMESTAMP1, until=None)
+        self.assertEqual(stored_messages(self.mailbox1), [msg(1)])
+        self.mailbox2.open_window.assert_not_called()
+        self.mailbox2.set_history_id.assert_called_once_with('history2')
+
+
+class WindowProgressTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.mailbox = Mock()
+        self.window = SyncWindow(TIMESTAMP1)
+        self.progress = WindowProgress(self.mailbox, self.window)
+        for n in (3, 2, 1):
+            self.progress.listed('msg_id{}'.format(n))
+
+    def test_advance_in_order(self):
+        self.progress.stored('msg_id3', 300)
+        self.progress.stored('msg_id2', 200)
+        self.mailbox.advance_window.assert_has_calls([call(self.window, 300), call(self.window, 200)])
+
+    def test_wait_for_previous_messages(self):
+        self.progress.stored('msg_id2', 200)
+        self.progress.stored('msg_id1', 100)
+        self.mailbox.advance_window.assert_not_called()
+
+        self.progress.stored('msg_id3', 300)
+        self.mailbox.advance_window.assert_called_once_with(self.window, 100)
+
+    def test_skipped_messages(self):
+        self.progress.skipped('msg_id3')
+        self.mailbox.advance_window.assert_not_called()
+
+        self.progress.stored('msg_id2', 200)
+        self.mailbox.advance_window.assert_called_once_with(self.window, 200)
+
+
+class FetchQueueTestCase(unittest.TestCase):
+
+    def test_chunk_by_count(self):
+        queue = FetchQueue([desc(1), desc(2), desc(3)])
+        self.assertEqual(queue.next_chunk(2), (desc(1), desc(2)))
+        self.assertEqual(queue.next_chunk(2), (desc(3),))
+        self.assertEqual(queue.next_chunk(2), ())
+        self.assertTrue(queue.done())
+
+    def test_chunk_by_bytes(self):
+        queue = FetchQueue([desc(1, 400), desc(2, 500), desc(3, 200), desc(4, 2000), desc(5)])
+        self.assertEqual(queue.next_chunk(10, max_bytes=1000), (desc(1, 400), desc(2, 500)))
+        self.assertFalse(queue.done())
+        # Bigger than the budget: alone in its chunk
+        self.assertEqual(queue.next_chunk(10, max_bytes=1000), (desc(3, 200),))
+        self.assertEqual(queue.next_chunk(10, max_bytes=1000), (desc(4, 2000),))
+        self.assertEqual(queue.next_chunk(10, max_bytes=1000), (desc(5),))
+        self.assertTrue(queue.done())
+
+    def test_set_big_messages_aside(self):
+        queue = FetchQueue([desc(1, 100), desc(2, 5000), desc(3, 100)], large_size=1000)
+        self.assertEqual(queue.next_chunk(10), (desc(1, 100), desc(3, 100)))
+        self.assertFalse(queue.done())
+        self.assertEqual(queue.next_large(), desc(2, 5000))
+        self.assertIsNone(queue.next_large())
+        self.assertEqual(queue.next_chunk(10), ())
+        self.assertTrue(queue.done())
+
+    @patch('gmailsync.sync.MAX_PENDING_LARGE_MESSAGES', 1)
+    def test_stop_taking_messages_while_big_messages_wait(self):
+        queue = FetchQueue([desc(1, 5000), desc(2, 100)], large_size=1000)
+        self.assertEqual(queue.next_chunk(10), ())
+        self.assertEqual(queue.next_large(), desc(1, 5000))
+        self.assertEqual(queue.next_chunk(10), (desc(2, 100),))
+
+    def test_notify_listed_messages_once(self):
+        on_listed = Mock()
+        queue = FetchQueue([desc(1, 800), desc(2, 800)], on_listed=on_listed)
+        queue.next_chunk(10, max_bytes=1000)
+        queue.next_chunk(10, max_bytes=1000)
+
+        on_listed.assert_has_calls([call('msg_id1'), call('msg_id2')])
+        self.assertEqual(on_listed.call_count, 2)
+
+
+class RetryQueueTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        time_patcher = patch('gmailsync.sync.time', self.clock)
+        rand_patcher = patch('gmailsync.sync.secrets.SystemRandom', return_value=Mock(uniform=lambda a, b: 0))
+        self.addCleanup(time_patcher.stop)
+        self.addCleanup(rand_patcher.stop)
+        time_patcher.start()
+        rand_patcher.start()
+
+    def test_exponential_backoff_per_message(self):
+        retries = RetryQueue()
+        self.assertTrue(retries.push(desc(1)))
+        self.clock.now += 1
+        self.assertTrue(retries.push(desc(2)))
+
+        self.assertEqual(retries.pop_due(10), [])
+        self.clock.now += 1
+        self.assertEqual(retries.pop_due(10), [desc(1)])
+        self.assertTrue(retries.push(desc(1)))
+
+        self.clock.now += 1
+        self.assertEqual(retries.pop_due(10), [desc(2)])
+        self.clock.now += 3
+        self.assertEqual(retries.pop_due(10), [desc(1)])
+        self.assertEqual(len(retries), 0)
+
+    def test_max_attempts(self):
+        retries = RetryQueue(max_attempts=2)
+        self.assertTrue(retries.push(desc(1)))
+        self.assertFalse(retries.push(desc(1)))
@@ -0,0 +1,84 @@
+import unittest
+from unittest.mock import Mock, patch
+
+from gmailsync.transport import DEFAULT_HTTP_TIMEOUT, Httplib2Transport, SessionHttp, SessionTransport
+
+
+class SessionTransportTestCase(unittest.TestCase):
+
+    @patch('gmailsync.transport.SessionTransport._create_session')
+    def test_share_session(self, mock_create_session):
+        transport = SessionTransport(pool_size=4)
+        http1 = transport.http('credentials')
+        http2 = transport.http('credentials')
+
+        mock_create_session.assert_called_once_with('credentials')
+        self.assertIs(http1.session, http2.session)
+
+        transport.close()
+        mock_create_session.return_value.close.assert_called_once_with()
+
+    def test_create_session_with_pool(self):
+        session = SessionTransport(pool_size=4)._create_session(Mock())
+        self.assertEqual(session.get_adapter('https://gmail.googleapis.com')._pool_maxsize, 4)
+
+
+class SessionHttpTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.session = Mock()
+        self.response = self.session.request.return_value
+        self.response.status_code = 200
+        self.response.reason = 'OK'
+        self.response.headers = {'Content-Type': 'multipart/mixed; boundary=batch'}
+        self.response.content = b'the content'
+
+    def test_request_compressed_response(self):
+        http = SessionHttp(self.session)
+        http.request('https://www.googleapis.com/batch/gmail/v1', 'POST', body=b'the body',
+                     headers={'Content-Type': 'multipart/mixed'})
+
+        self.session.request.assert_called_once_with(
+            'POST', 'https://www.googleapis.com/batch/gmail/v1', data=b'the body',
+            headers={'content-type': 'multipart/mixed', 'accept-encoding': 'gzip', 'user-agent': '(gzip)'},
+            allow_redirects=True, timeout=DEFAULT_HTTP_TIMEOUT)
+
+    def test_keep_user_agent(self):
+        http = SessionHttp(self.session, timeout=30)
+        http.request('https://gmail.googleapis.com', headers={'user-agent': 'google-api-python-client/2.0 (gzip)'})
+
+        self.session.request.assert_called_once_with(
+            'GET', 'https://gmail.googleapis.com', data=None,
+            headers={'accept-encoding': 'gzip', 'user-agent': 'google-api-python-client/2.0 (gzip)'},
+            allow_redirects=True, timeout=30)
+
+    def test_httplib2_response(self):
+        resp, content = SessionHttp(self.session).request('https://gmail.googleapis.com')
+
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(resp['status'], '200')
+        self.assertEqual(resp.reason, 'OK')
+        self.assertEqual(resp['content-type'], 'multipart/mixed; boundary=batch')
+        self.assertEqual(content, b'the content')
+
+    def test_decompressed_response(self):
+        self.response.headers['Content-Encoding'] = 'gzip'
+        self.response.headers['Content-Length'] = '5'
+
+        resp, content = SessionHttp(self.session).request('https://gmail.googleapis.com')
+
+        self.assertNotIn('content-encoding', resp)
+        self.assertEqual(resp['-content-encoding'], 'gzip')
+        self.assertEqual(resp['content-length'], str(len(b'the content')))
+
+
+class Httplib2TransportTestCase(unittest.TestCase):
+
+    def test_default_timeout(self):
+        http = Httplib2Transport().http(Mock())
+        self.assertEqual(http.http.timeout, DEFAULT_HTTP_TIMEOUT)
+        self.assertNotIn(308, http.http.redirect_codes)
+
+    def test_timeout(self):
+        http = Httplib2Transport(timeout=30).http(Mock())
+        self.assertEqual(http.http.timeout, 30)
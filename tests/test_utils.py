@@ -1,8 +1,9 @@
 import unittest
+import itertools
 
 from tests.utils import override_environ
 
-from gmailsync.utils import chunked, expand_path
+from gmailsync.utils import chunked, merge, prefetch, expand_path
 
 
 class ChunkedTestCase(unittest.TestCase):
@@ -36,3 +37,47 @@ class ExpandPathTestCase(unittest.TestCase):
         with override_environ(gmailsynctest='foo'):
             path = expand_path('/opt/$gmailsynctest/bar/${gmailsynctest}')
             self.assertEqual(path, '/opt/foo/bar/foo')
+
+
+class PrefetchTestCase(unittest.TestCase):
+
+    def test_prefetch(self):
+        items = list(prefetch(iter(range(10)), 3))
+        self.assertEqual(items, list(range(10)))
+
+    def test_prefetch_propagates_errors(self):
+        def produce():
+            yield 1
+            raise ValueError('producer failed')
+
+        generator = prefetch(produce(), 3)
+        self.assertEqual(next(generator), 1)
+        with self.assertRaisesRegex(ValueError, 'producer failed'):
+            next(generator)
+
+    def test_prefetch_stop_early(self):
+        generator = prefetch(itertools.count(), 2)
+        self.assertEqual(next(generator), 0)
+        generator.close()
+
+
+class MergeTestCase(unittest.TestCase):
+
+    def test_merge(self):
+        items = list(merge([iter(range(5)), iter('abc'), iter([])], 3, 2))
+        self.assertEqual([item for i, item in items if i == 0], list(range(5)))
+        self.assertEqual([item for i, item in items if i == 1], list('abc'))
+        self.assertEqual(len(items), 8)
+
+    def test_merge_propagates_errors(self):
+        def produce():
+            yield 1
+            raise ValueError('producer failed')
+
+        with self.assertRaisesRegex(ValueError, 'producer failed'):
+            list(merge([produce(), iter(range(3))], 3, 2))
+
+    def test_merge_stop_early(self):
+        generator = merge([itertools.count(), itertools.count()], 2, 2)
+        self.assertIn(next(generator)[1], (0, 1))
+        generator.close()
@@ -15,3 +15,24 @@ def override_environ(**kwargs):
     finally:
         os.environ.clear()
         os.environ.update(save_env)
+
+
+class FakeClock:
+    """
+    Fake replacement of the `time` module whose `sleep` advances the clock instantly.
+
+    """
+
+    def __init__(self, now=1000.0):
+        self.now = now
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds